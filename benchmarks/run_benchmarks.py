@@ -0,0 +1,321 @@
+"""
+Benchmarks of the landsatutil pipeline stages (scene open, subimage reads,
+temporal reduction, segmentation, zonal statistics and model training) on
+synthetic archives of several sizes, and of the conversion of the pixel
+centers of a full scene to latitude and longitude. The timings are written to a JSON file
+so the results of two versions can be compared. Result files go to
+benchmarks/results/ by default, which git ignores.
+
+Run from the repository root:
+    python -m benchmarks.run_benchmarks --sizes 256 512 1024
+    python -m benchmarks.run_benchmarks --compare benchmarks/results/old.json benchmarks/results/new.json
+"""
+
+# Imports
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from os import cpu_count, makedirs
+from os.path import join, exists, dirname
+from time import perf_counter
+from numpy import array, arange, concatenate, isfinite, median, full, __version__ as numpy_version
+
+from landsatutil.classification import CropModel
+from landsatutil.earth_calc import utm_to_latlon
+from landsatutil.morphology import tiled_morphology
+from landsatutil.scene import LandsatScene
+from landsatutil.segmentation import separate_fields
+from landsatutil.synthetic import make_archive, make_series, field_layout, band_images
+from landsatutil.temporal import collect_bands, compress_temporal_image, find_archives
+from landsatutil.zonal import zonal_stats
+
+# Constants
+DEFAULT_SIZES = (256, 512, 1024)
+YEARS = (2008, 2009)
+SCENES_PER_YEAR = 2
+UL_CORNER = array([390000.0, 4200000.0])
+PIXEL_SIZE = 30.0
+# Edge length of a full Landsat scene, the pixel centers of one are converted to latitude and longitude
+SCENE_GRID_SIZE = 7000
+RESULTS_DIR = join(dirname(__file__), 'results')
+# A benchmark is reported as a regression when its median time grows by more than this factor
+REGRESSION_RATIO = 1.25
+
+
+def prepare(directory, size):
+    """
+    Writes the synthetic archives of one data size (unless they exist already)
+    and the inputs of the in memory benchmarks
+
+    :param directory: directory for the archives and the members extracted from them
+    :param size: edge length of the scenes in pixels
+    :return: dictionary of benchmark inputs
+    """
+
+    shape = (size, size)
+    series_dir = join(directory, 'series_{0:d}'.format(size))
+    if len(find_archives(YEARS, series_dir) if exists(series_dir) else []) < len(YEARS)*SCENES_PER_YEAR:
+        make_series(series_dir, YEARS, scenes_per_year=SCENES_PER_YEAR, shape=shape)
+    tar_dir = join(directory, 'tar_{0:d}'.format(size))
+    tar_path = join(tar_dir, 'LT50330342008130PAC01.tar')
+    if not exists(tar_path):
+        make_archive(tar_dir, shape=shape, compression=None)
+
+    # The region of interest is the middle of the scene
+    margin = size//8
+    nw = UL_CORNER + PIXEL_SIZE*array([margin, -margin])
+    se = UL_CORNER + PIXEL_SIZE*array([size - margin, -(size - margin)])
+
+    labels, crops = field_layout(shape)
+    band = band_images(labels, crops, day_of_year=180, bands=[4])[4]
+
+    return {
+        'size': size,
+        'series_dir': series_dir,
+        'series_paths': find_archives(YEARS, series_dir),
+        'tar_path': tar_path,
+        # Members of the compressed archives are extracted next to them, not in the working directory
+        'cache_dir': join(directory, 'members'),
+        'nw': nw,
+        'se': se,
+        'labels': labels,
+        'crops': crops,
+        'band': band,
+    }
+
+
+def bench_scene_open_tar(data):
+    LandsatScene(data['tar_path'], cache_dir=data['cache_dir'])
+
+
+def bench_scene_open_gz(data):
+    LandsatScene(data['series_paths'][0], cache_dir=data['cache_dir'])
+
+
+def bench_subimage_read_tar(data):
+    LandsatScene(data['tar_path'], cache_dir=data['cache_dir']).get_band_subimage(4, data['nw'], data['se'])
+
+
+def bench_subimage_read_gz(data):
+    LandsatScene(data['series_paths'][0], cache_dir=data['cache_dir']).get_band_subimage(4, data['nw'], data['se'], convert='reflectance')
+
+
+def bench_collect_bands(data):
+    collect_bands(4, data['nw'], data['se'], YEARS, data['series_dir'], cache_dir=data['cache_dir'])
+
+
+def bench_compress_temporal_image(data):
+    compress_temporal_image(data['band'].astype(float))
+
+
+def bench_morphology(data):
+    tiled_morphology(data['labels'] > 0, [('erosion', 5, 5), ('closing', 50, 50)])
+
+
+def bench_segmentation(data):
+    field_mask = data['labels'] > 0
+    separate_fields(data['labels'] == 0, field_mask, strides=[100, 200, 400], halo=20)
+
+
+def bench_zonal_stats(data):
+    zonal_stats(data['labels'], data['band'])
+
+
+def _training_set(data):
+    """
+    Field features of every scene of the series (as collate_crop_data.py
+    makes them), with the crop of each field as the outcome
+    """
+
+    if 'training_set' in data:
+        return data['training_set']
+
+    batches = []
+    region_se = UL_CORNER + PIXEL_SIZE*array([data['size'], -data['size']])
+    for path in data['series_paths']:
+        scene = LandsatScene(path, cache_dir=data['cache_dir'])
+        batch = {}
+        for band in range(1, 8):
+            image = scene.get_band_subimage(band, UL_CORNER, region_se, convert='dn')
+            stats = zonal_stats(data['labels'], image, valid=image != 0)
+            batch['b{0:d}_ref'.format(band)] = stats['mean']
+            batch['b{0:d}_var'.format(band)] = stats['var']
+        batch['label'] = stats['label']
+        batch['month'] = full(stats.size, scene.month)
+        batches.append(batch)
+
+    # Fields without valid pixels in a scene are left out
+    columns = dict((name, concatenate([batch[name] for batch in batches])) for name in batches[0])
+    complete = isfinite(columns['b1_ref'])
+    columns = dict((name, value[complete]) for name, value in columns.items())
+    outcomes = data['crops'][columns['label']]
+    data['training_set'] = (columns, outcomes)
+    return columns, outcomes
+
+
+def bench_model_training(data):
+    columns, outcomes = _training_set(data)
+    features = ['month'] + ['b{0:d}_{1}'.format(band, stat) for band in range(1, 8) for stat in ('ref', 'var')]
+    CropModel(features).fit(columns, outcomes)
+
+
+def bench_utm_to_latlon(data):
+    # The easting and northing axes of the grid, broadcast to every pixel center
+    centers = PIXEL_SIZE*(arange(data['size']) + 0.5)
+    utm_to_latlon(13, UL_CORNER[0] + centers[None, :], UL_CORNER[1] - centers[:, None])
+
+
+BENCHMARKS = [
+    ('scene_open_tar', bench_scene_open_tar),
+    ('scene_open_gz', bench_scene_open_gz),
+    ('subimage_read_tar', bench_subimage_read_tar),
+    ('subimage_read_gz', bench_subimage_read_gz),
+    ('collect_bands', bench_collect_bands),
+    ('compress_temporal_image', bench_compress_temporal_image),
+    ('morphology', bench_morphology),
+    ('segmentation', bench_segmentation),
+    ('zonal_stats', bench_zonal_stats),
+    ('model_training', bench_model_training),
+]
+
+# Benchmarks run once at a fixed size, whatever the sizes of the synthetic archives
+FIXED_BENCHMARKS = [
+    ('utm_to_latlon', bench_utm_to_latlon, SCENE_GRID_SIZE),
+]
+
+
+def time_benchmark(function, data, repeat):
+    """
+    Runs a benchmark once to warm up (caches, indexes) and then times it
+
+    :return: list of run times in seconds
+    """
+
+    function(data)
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function(data)
+        times.append(perf_counter() - start)
+    return times
+
+
+def git_revision():
+    """
+    :return: commit hash of the working tree, or None outside a git checkout
+    """
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=dirname(__file__) or '.',
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, repeat, directory, names=None):
+    """
+    Runs the benchmarks at every size
+
+    :param sizes: list of scene edge lengths in pixels
+    :param repeat: number of timed runs of each benchmark
+    :param directory: directory for the synthetic archives
+    :param names: optional list of benchmark names to run
+    :return: results dictionary
+    """
+
+    runs = [(name, function, size, None) for size in sizes for name, function in BENCHMARKS]
+    runs += [(name, function, size, {'size': size}) for name, function, size in FIXED_BENCHMARKS]
+
+    results = []
+    prepared = {}
+    for name, function, size, data in runs:
+        if names and name not in names:
+            continue
+        if data is None:
+            if size not in prepared:
+                prepared = {size: prepare(directory, size)}
+            data = prepared[size]
+        times = time_benchmark(function, data, repeat)
+        results.append({
+            'benchmark': name,
+            'size': size,
+            'times': times,
+            'min': min(times),
+            'median': float(median(times)),
+            'mean': sum(times)/len(times),
+        })
+        print('{0:>26} {1:6d}  median {2:9.4f} s  min {3:9.4f} s'.format(name, size, results[-1]['median'],
+                                                                     results[-1]['min']))
+
+    return {
+        'created': datetime.now().isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': numpy_version,
+        'machine': platform.machine(),
+        'cpu_count': cpu_count(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(old_path, new_path, ratio=REGRESSION_RATIO):
+    """
+    Prints the change of the median times between two result files
+
+    :return: list of (benchmark, size) pairs that got slower than the ratio allows
+    """
+
+    with open(old_path) as old_file:
+        old = dict(((r['benchmark'], r['size']), r) for r in json.load(old_file)['results'])
+    with open(new_path) as new_file:
+        new = dict(((r['benchmark'], r['size']), r) for r in json.load(new_file)['results'])
+
+    regressions = []
+    for key in sorted(set(old) & set(new)):
+        change = new[key]['median'] / old[key]['median']
+        flag = ''
+        if change > ratio:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        print('{0:>26} {1:6d}  {2:9.4f} s -> {3:9.4f} s  x{4:.2f}{5}'.format(
+            key[0], key[1], old[key]['median'], new[key]['median'], change, flag
+        ))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the landsatutil pipeline on synthetic archives')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help='scene edge lengths in pixels')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of each benchmark')
+    parser.add_argument('--data-dir', help='directory to keep the synthetic archives in '
+                                           '(default: a temporary directory removed afterwards)')
+    parser.add_argument('--only', nargs='+', help='names of the benchmarks to run')
+    parser.add_argument('--output', help='result file (default: benchmarks/results/<date>_<revision>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare) else 0)
+
+    # Synthetic archives are kept in the given directory, or in a temporary one removed afterwards
+    if args.data_dir:
+        makedirs(args.data_dir, exist_ok=True)
+        report = run(args.sizes, args.repeat, args.data_dir, args.only)
+    else:
+        with tempfile.TemporaryDirectory(prefix='landsat_benchmarks_') as data_dir:
+            report = run(args.sizes, args.repeat, data_dir, args.only)
+
+    output = args.output
+    if output is None:
+        makedirs(RESULTS_DIR, exist_ok=True)
+        output = join(RESULTS_DIR, '{0}_{1}.json'.format(datetime.now().strftime('%Y%m%dT%H%M%S'),
+                                                        (report['revision'] or 'unknown')[:10]))
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print('Results written to {0}'.format(output))
@@ -0,0 +1,50 @@
+"""
+Classifies the crop type of every collated field with a trained model and
+creates a crop type image aligned with the field mask
+"""
+
+from numpy import array, uint16
+from skimage.io import imread, imsave, use_plugin
+
+from landsatutil.classification import load_model, predict_fields, burn_predictions
+from landsatutil.features import FeatureStore
+
+# Change skimage plugin
+use_plugin('freeimage')
+
+# Very small area
+nw_corner = array([396210, 4175310])
+se_corner = array([404460, 4167150])
+
+# Calculate file names
+fname_post = '_{0}_{1}_{2}_{3}.'.format(nw_corner[0], nw_corner[1], se_corner[0], se_corner[1])
+fname_template = 'tmp/{0}' + fname_post + '{1}'
+
+# Open the model trained by predict_crops.py and the collated field features
+model = load_model(fname_template.format('crop_model', 'pkl'))
+store = FeatureStore(fname_template.format('field_data', 'features'))
+
+# Classify the fields, each field gets the crop predicted for most of its scenes
+print('Classifying Fields')
+field_labels, field_class, fraction = predict_fields(model, store)
+
+# Write the crop of each field to a csv file
+out_file = open(fname_template.format('field_crops', 'csv'), 'w')
+print('label,crop,fraction', file=out_file)
+for field_label, class_index, field_fraction in zip(field_labels, field_class, fraction):
+    crop = model.classes[class_index] if class_index >= 0 else ''
+    print(','.join([str(x) for x in [field_label, crop, field_fraction]]), file=out_file)
+out_file.close()
+
+# Burn the crops into an image aligned with the field mask, pixels hold the
+# position of the crop in the model classes plus one (zero is not classified)
+field_mask = imread(fname_template.format('field_mask', 'png'))
+crop_image = burn_predictions(field_mask, field_labels, field_class + 1, dtype=uint16)
+imsave(fname_template.format('crop_type', 'png'), crop_image)
+
+# Write the legend of the crop type image
+legend_file = open(fname_template.format('crop_type_legend', 'csv'), 'w')
+print('value,crop', file=legend_file)
+for n, crop in enumerate(model.classes):
+    print('{0},{1}'.format(n + 1, crop), file=legend_file)
+legend_file.close()
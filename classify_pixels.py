@@ -0,0 +1,43 @@
+"""
+Classifies the crop type of every pixel of an area, for areas where the
+fields can not be segmented
+"""
+
+from os import cpu_count
+from numpy import array, uint16, int16
+from numpy.lib.format import open_memmap
+from skimage.io import imsave, use_plugin
+
+from landsatutil.catalog import SceneCatalog
+from landsatutil.classification import load_model, classify_pixels, region_shape
+
+# Change skimage plugin
+use_plugin('freeimage')
+
+# Very small area
+nw_corner = array([396210, 4175310])
+se_corner = array([404460, 4167150])
+
+# Calculate file names
+fname_post = '_{0}_{1}_{2}_{3}.'.format(nw_corner[0], nw_corner[1], se_corner[0], se_corner[1])
+fname_template = 'tmp/{0}' + fname_post + '{1}'
+
+# Open the pixel model trained by train_pixel_model.py on the features of
+# pixel_feature_names for the scenes of one season in order of acquisition
+model = load_model('tmp/pixel_crop_model.pkl')
+
+# Scenes of the season covering the area
+catalog = SceneCatalog('tmp/scenes.sqlite')
+catalog.update('tmp/')
+archive_list = catalog.archive_paths(years=[2011], months=range(5, 10), nw_coords=nw_corner, se_coords=se_corner)
+
+# Classify the pixels tile by tile into a memory mapped image
+print('Classifying Pixels')
+_, shape = region_shape(archive_list, nw_corner, se_corner)
+pixel_classes = open_memmap(fname_template.format('pixel_classes', 'npy'), mode='w+', dtype=int16, shape=shape)
+classify_pixels(model, archive_list, nw_corner, se_corner, memory_budget=1 << 30, workers=cpu_count(),
+                out=pixel_classes)
+
+# Save the crop type image, pixels hold the position of the crop in the model
+# classes plus one (zero is not classified)
+imsave(fname_template.format('pixel_crop_type', 'png'), uint16(pixel_classes + 1))
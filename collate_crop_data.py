@@ -2,13 +2,15 @@
 Collates crop data and creates a descriptive csv file
 """
 
-from numpy import array, where, mean, var
+from numpy import array, full
 from skimage.io import imread, use_plugin
-from os import listdir
-from pandas import read_csv
 import matplotlib.pyplot as plt
 
-from landsatutil.scene import LandsatScene
+from landsatutil.catalog import SceneCatalog
+from landsatutil.cube import open_cube
+from landsatutil.features import FeatureStore
+from landsatutil.fields import load_registry
+from landsatutil.zonal import zonal_stats
 
 # Change skimage plugin
 use_plugin('freeimage')
@@ -25,62 +27,62 @@ fname_template = 'tmp/{0}' + fname_post + '{1}'
 fname_field_mask = fname_template.format('field_mask', 'png')
 field_mask = imread(fname_field_mask)
 
-# Open the field properties file
-fname_field_props = fname_template.format('field_props', 'csv')
-field_props = read_csv(fname_field_props)
+# Open the field registry
+registry = load_registry(fname_template.format('field_registry', 'npz'))
 
-# Create an output file
-result = open(fname_template.format('field_data', 'csv'), 'w')
-print(','.join(['label', 'year', 'month', 'day', 'hour',
-                'b1_ref', 'b1_var',
+# Open the feature store, fields and scenes collated by an earlier (interrupted) run are kept
+store = FeatureStore(fname_template.format('field_data', 'features'))
+band_columns = ['b1_ref', 'b1_var',
                 'b2_ref', 'b2_var',
                 'b3_ref', 'b3_var',
                 'b4_ref', 'b4_var',
                 'b5_ref', 'b5_var',
                 'b6_ref', 'b6_var',
-                'b7_ref', 'b7_var'
-                ]), file=result)
+                'b7_ref', 'b7_var']
 
 
 # Open a landsat scene for the specified years and write data to csv
-# Convert year list items to stings
-year_list = ['2008', '2009', '2010', '2011']
-# Get list of archives in directory
-archive_list = listdir('tmp/')
-# Get all files with the year specified
-archive_list = [file for file in archive_list if file[9:13] in year_list]
+year_list = [2008, 2009, 2010, 2011]
+# Find the scenes covering the area in the catalog, only new archives are opened
+catalog = SceneCatalog('tmp/scenes.sqlite')
+catalog.update('tmp/')
+archive_list = catalog.archive_paths(years=year_list, nw_coords=nw_corner, se_coords=se_corner)
 
-for line in field_props.iterrows():
-    props = line[1]
-    field_label = int(props['label'])
-    print('Collecting Data for Field: {0:d}'.format(field_label))
-    field_indices = where(field_mask == field_label)
-    nw_corner_field = array([nw_corner[0] + 30*(props['nw_row']),
-                             nw_corner[1] - 30*(props['nw_col'])])
-    se_corner_field = array([nw_corner[0] + 30*(props['se_row']),
-                             nw_corner[1] - 30*(props['se_col'])])
-    for archive_name in archive_list:
-        fscene = LandsatScene(archive_name)
-        year = fscene.year
-        month = fscene.month
-        day = fscene.day
-        hour = fscene.hour
-        reflectance = []
-        for band in range(1, 8):
-            field_reflectance = fscene.get_band_subimage(band, nw_corner_field, se_corner_field)
-            single_field_mask = field_mask[props['nw_col']:props['se_col'],
-                                           props['nw_row']:props['se_row']]/field_label
-            field_reflectance2 = field_reflectance * single_field_mask
-            reflectance.append(mean(field_reflectance2[where(field_reflectance2 != 0)]))
-            reflectance.append(var(field_reflectance2[where(field_reflectance2 != 0)]))
+# The scenes are ingested into a data cube of top of atmosphere reflectance (brightness
+# temperature for the thermal band) once, later runs read from it
+cube = open_cube('tmp/cube' + fname_post.rstrip('.'), archive_list, nw_corner, se_corner, product='reflectance')
+reflectance_cube, valid = cube.select()
+rows = min(cube.shape[2], field_mask.shape[0])
+cols = min(cube.shape[3], field_mask.shape[1])
 
-            # Plots
-            #f, ax = plt.subplots(1, 3)
-            #ax[0].imshow(field_reflectance)
-            #ax[1].imshow(single_field_mask)
-            #ax[2].imshow(field_reflectance2)
-            #plt.show()
+# The statistics of all the fields are computed from each band in one pass,
+# each scene is appended to the store as one batch
+field_labels = registry.labels
 
-        data_list = [field_label, year, month, day, hour] + reflectance
-        data_list = [str(x) for x in data_list]
-        print(','.join(data_list), file=result)
\ No newline at end of file
+for t, scene_id in enumerate(cube.scene_ids):
+    labels = store.missing(field_labels, scene_id)
+    if labels.size == 0:
+        continue
+    print('Collecting Data for Scene: {0}'.format(scene_id))
+    acquired = cube.times[t].astype(object)
+    batch = {
+        'label': labels,
+        'scene_id': full(labels.size, scene_id, dtype='U32'),
+        'year': full(labels.size, acquired.year),
+        'month': full(labels.size, acquired.month),
+        'day': full(labels.size, acquired.day),
+        'hour': full(labels.size, acquired.hour),
+    }
+    for b in range(len(cube.bands)):
+        field_stats = zonal_stats(field_mask[0:rows, 0:cols],
+                                  reflectance_cube[t, b, 0:rows, 0:cols],
+                                  valid=valid[t, 0:rows, 0:cols],
+                                  label_list=labels)
+        batch[band_columns[2*b]] = field_stats['mean']
+        batch[band_columns[2*b + 1]] = field_stats['var']
+    store.append(batch)
+
+# Merge the batches and write the rows grouped by field
+store.compact()
+store.to_csv(fname_template.format('field_data', 'csv'),
+             columns=['label', 'year', 'month', 'day', 'hour'] + band_columns, sort_by='label')
@@ -0,0 +1,90 @@
+"""
+Runs the crop prediction workflow (field mask -> features -> labels -> model
+-> predictions) as an incremental pipeline. Only the stages whose inputs or
+settings changed since the last run are recomputed, e.g. when the scenes of a
+new season arrive only their features and the stages after them are.
+
+Examples:
+    python crop_pipeline.py
+    python crop_pipeline.py --config area.json --jobs 2 --workers 4 model
+    python crop_pipeline.py --dry-run
+"""
+
+import argparse
+import json
+import shutil
+from os import cpu_count, makedirs
+from os.path import join, isfile
+
+from landsatutil.stages import DEFAULT_CONFIG, TARGETS, build_pipeline
+
+# Artifact files copied out by --export, with the names the scripts give them
+EXPORTS = [
+    ('mask', 'field_mask.npy', 'field_mask', 'npy'),
+    ('mask', 'field_props.csv', 'field_props', 'csv'),
+    ('mask', 'field_registry.npz', 'field_registry', 'npz'),
+    ('features', 'field_data.csv', 'field_data', 'csv'),
+    ('phenology', 'field_phenology.csv', 'field_phenology', 'csv'),
+    ('labels', 'field_data_truth.csv', 'field_data_truth', 'csv'),
+    ('model', 'crop_model.pkl', 'crop_model', 'pkl'),
+    ('predictions', 'field_crops.csv', 'field_crops', 'csv'),
+    ('predictions', 'crop_type.npy', 'crop_type', 'npy'),
+]
+
+parser = argparse.ArgumentParser(description='Incremental crop prediction pipeline')
+parser.add_argument('targets', nargs='*', default=['predictions'],
+                    help='stages to bring up to date: {0} (default: predictions)'.format(', '.join(TARGETS)))
+parser.add_argument('--config', help='JSON file of settings overriding the defaults')
+parser.add_argument('--nw', type=float, nargs=2, metavar=('X', 'Y'), help='north west corner (UTM meters)')
+parser.add_argument('--se', type=float, nargs=2, metavar=('X', 'Y'), help='south east corner (UTM meters)')
+parser.add_argument('--years', type=int, nargs='+', help='years of the scenes to collate')
+parser.add_argument('--store', default='pipeline_store',
+                    help='artifact store directory, outside of the archive directories (default: pipeline_store)')
+parser.add_argument('--jobs', type=int, default=2, help='stages run at once (default: 2)')
+parser.add_argument('--workers', type=int,
+                    help='processes per stage (default: the processors divided between the jobs)')
+parser.add_argument('--force', nargs='+', default=[], help='stages to recompute even if they are up to date')
+parser.add_argument('--dry-run', action='store_true', help='only print which stages would run')
+parser.add_argument('--export', metavar='DIR', help='copy the main outputs to a directory')
+parser.add_argument('--prune', action='store_true', help='delete artifacts that are no longer current')
+args = parser.parse_args()
+
+# Stages running at once share the processors, jobs x workers processes run at most
+jobs = max(args.jobs, 1)
+workers = args.workers if args.workers is not None else max(cpu_count()//jobs, 1)
+
+# Settings
+config = {}
+if args.config:
+    with open(args.config) as config_file:
+        config.update(json.load(config_file))
+if args.nw:
+    config['nw_corner'] = args.nw
+if args.se:
+    config['se_corner'] = args.se
+if args.years:
+    config['years'] = args.years
+
+pipeline = build_pipeline(config, args.store, workers=workers)
+for target in args.targets + args.force:
+    if target not in pipeline.stages:
+        parser.error('unknown stage {0}'.format(target))
+
+if args.dry_run:
+    for name, needed in pipeline.plan(args.targets, force=args.force):
+        print('{0:<8} {1}'.format('run' if needed else 'cached', name))
+else:
+    pipeline.run(args.targets, workers=jobs, force=args.force)
+
+if args.export and not args.dry_run:
+    settings = dict(DEFAULT_CONFIG, **config)
+    fname_post = '_{0:.0f}_{1:.0f}_{2:.0f}_{3:.0f}.'.format(settings['nw_corner'][0], settings['nw_corner'][1],
+                                                            settings['se_corner'][0], settings['se_corner'][1])
+    makedirs(args.export, exist_ok=True)
+    for stage, file_name, export_name, extension in EXPORTS:
+        source = join(pipeline.artifact_path(stage), file_name)
+        if stage in pipeline.dependencies(args.targets) and isfile(source):
+            shutil.copyfile(source, join(args.export, export_name + fname_post + extension))
+
+if args.prune:
+    print('Removed {0:d} old artifacts'.format(pipeline.prune()))
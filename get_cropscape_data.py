@@ -1,7 +1,7 @@
 from numpy import array
 from skimage.io import imsave
 
-from landsatutil.cropscape_tools import get_crop_data
+from landsatutil.cropscape_tools import CropscapeFetcher, get_crop_data_years
 
 # Very small area
 nw_corner = array([396210, 4175310])
@@ -13,5 +13,8 @@ fname_template = 'tmp/{0}' + fname_post + '{1}'
 
 field_shape = (300,300)
 
-for year in [2008, 2009, 2010, 2011, 2012]:
-    crops = get_crop_data(fname_template.format(str(year), 'png'), field_shape, 13, nw_corner, se_corner, year)
\ No newline at end of file
+# All the years are requested at once, earlier downloads are read from the cache
+fetcher = CropscapeFetcher(cache_dir='tmp/cdl_cache', max_connections=4)
+crops = get_crop_data_years(field_shape, 13, nw_corner, se_corner, [2008, 2009, 2010, 2011, 2012], fetcher=fetcher)
+for year, crop_data in crops.items():
+    imsave(fname_template.format(str(year), 'png'), crop_data, check_contrast=False)
@@ -0,0 +1,46 @@
+"""
+Labels the collated fields with their crop from the Cropland Data Layer and
+creates the truth csv file used by predict_crops.py
+"""
+
+from numpy import array, unique
+from pandas import DataFrame
+from skimage.io import imread, use_plugin
+
+from landsatutil.cropscape_tools import CropscapeFetcher, get_crop_data_years
+from landsatutil.features import FeatureStore
+from landsatutil.truth import align_to_mask, encode_colors, majority_labels, join_truth
+
+# Change skimage plugin
+use_plugin('freeimage')
+
+# Very small area
+nw_corner = array([396210, 4175310])
+se_corner = array([404460, 4167150])
+
+# Calculate file names
+fname_post = '_{0}_{1}_{2}_{3}.'.format(nw_corner[0], nw_corner[1], se_corner[0], se_corner[1])
+fname_template = 'tmp/{0}' + fname_post + '{1}'
+
+# Open the field mask and the collated field features
+field_mask = imread(fname_template.format('field_mask', 'png'))
+store = FeatureStore(fname_template.format('field_data', 'features'))
+features = store.read()
+years = [int(year) for year in unique(features['year'])]
+
+# Get the crop data of every year on the field mask grid
+fetcher = CropscapeFetcher(cache_dir='tmp/cdl_cache')
+crops = get_crop_data_years((field_mask.shape[1], field_mask.shape[0]), 13, nw_corner, se_corner, years,
+                            fetcher=fetcher)
+
+# The crop of each field is the most common crop color of its pixels (black is no data)
+truth_tables = {}
+for year, crop_data in crops.items():
+    crop_keys = encode_colors(align_to_mask(crop_data, field_mask.shape))
+    truth_tables[year] = majority_labels(field_mask, crop_keys, ignore=[0])
+
+# Join the truth to the features and keep the fields that are mostly one crop
+labeled = join_truth(features, truth_tables, min_purity=0.75, min_count=20)
+keep = labeled.pop('has_truth')
+data_set = DataFrame(dict((name, value[keep]) for name, value in labeled.items()), columns=list(labeled.keys()))
+data_set.to_csv(fname_template.format('field_data_truth', 'csv'), index=False)
@@ -0,0 +1,316 @@
+"""
+Member level access to Landsat data product archives
+"""
+
+# Imports
+import bz2
+import gzip
+import json
+import lzma
+import tarfile
+import threading
+from os import listdir, makedirs, replace, getpid, stat
+from os.path import basename, dirname, join, isdir, isfile
+
+from . import profiling
+from .tiff import TiffImage
+
+# Constants
+INDEX_DIR = '.landsat_index'
+INDEX_SUFFIX = '.index.json'
+INDEX_VERSION = 1
+# Members of compressed archives are extracted here the first time they are read
+DEFAULT_CACHE_DIR = join('tmp', 'members')
+
+# Magic bytes -> stream opener for compressed archives
+COMPRESSED_OPENERS = [
+    (b'\x1f\x8b', gzip.open),
+    (b'BZh', bz2.open),
+    (b'\xfd7zXZ\x00', lzma.open),
+]
+
+
+def archive_stem(archive_path):
+    """
+    Name of an archive without its directory and extensions
+
+    :param archive_path: path to the archive
+    :return: archive name (e.g. LT50330342008130PAC01)
+    """
+
+    return basename(archive_path.rstrip('/')).split('.')[0]
+
+
+class ExtractedArchive(object):
+
+    def __init__(self, directory):
+        """
+        Archive backend for a directory that an archive was already extracted to
+
+        :param directory: directory containing the archive members
+        :return: ExtractedArchive object
+        """
+
+        self.directory = directory
+        self.name = archive_stem(directory)
+
+    def members(self):
+        """
+        :return: list of member names
+        """
+
+        return sorted(listdir(self.directory))
+
+    def find_member(self, suffix):
+        """
+        Finds the member whose name ends with suffix
+
+        :param suffix: end of the member name (e.g. 'MTL.txt' or '_B4.TIF')
+        :return: member name
+        """
+
+        for name in self.members():
+            if name.endswith(suffix):
+                return name
+        raise KeyError('No member ending with {0} in {1}'.format(suffix, self.name))
+
+    def read_member(self, name):
+        """
+        Reads the contents of a member
+
+        :param name: member name
+        :return: bytes
+        """
+
+        with open(join(self.directory, name), 'rb') as member_file:
+            return member_file.read()
+
+    def open_tiff(self, name):
+        """
+        Opens a member as a TiffImage
+
+        :param name: member name
+        :return: TiffImage object
+        """
+
+        return TiffImage(join(self.directory, name))
+
+    def extract_members(self, names):
+        """
+        Makes sure members can be read from disk (nothing to do for an extracted archive)
+
+        :param names: member names
+        """
+
+        pass
+
+
+class LandsatArchive(ExtractedArchive):
+
+    def __init__(self, archive_path, cache_dir=DEFAULT_CACHE_DIR):
+        """
+        Archive backend reading members straight out of a tar archive. The
+        member offsets are indexed once and saved to a .index.json file in a
+        hidden directory next to the archive (or in cache_dir) so later opens
+        do not rescan the tar.
+
+        Members of uncompressed tars are read in place by seeking. Members of
+        compressed tars are extracted to cache_dir (atomically) the first time
+        they are needed so later reads are as cheap as for an uncompressed tar.
+        Without a cache_dir every read decompresses the stream up to the
+        member and holds the whole member in memory.
+
+        :param archive_path: path to the .tar, .tar.gz or .tar.bz2 archive
+        :param cache_dir: directory to extract members of compressed archives to (None to
+                          decompress them from the stream on every read)
+        :return: LandsatArchive object
+        """
+
+        self.archive_path = archive_path
+        self.name = archive_stem(archive_path)
+        self.cache_dir = cache_dir
+        self.directory = join(cache_dir, self.name) if cache_dir is not None else None
+
+        # Detect compression
+        with open(archive_path, 'rb') as archive_file:
+            magic = archive_file.read(6)
+        self._stream_opener = None
+        for prefix, opener in COMPRESSED_OPENERS:
+            if magic.startswith(prefix):
+                self._stream_opener = opener
+
+        self.index = self._load_index()
+
+    def _index_path(self):
+        """
+        :return: path of the member index file
+        """
+
+        index_name = basename(self.archive_path) + INDEX_SUFFIX
+        if self.cache_dir is not None:
+            return join(self.cache_dir, index_name)
+        return join(dirname(self.archive_path), INDEX_DIR, index_name)
+
+    def _load_index(self):
+        """
+        Loads the member index, rebuilding it if it is missing or the archive
+        has changed since it was written
+
+        :return: dictionary of member name -> (data offset, size)
+        """
+
+        archive_stat = stat(self.archive_path)
+        signature = [INDEX_VERSION, archive_stat.st_size, archive_stat.st_mtime]
+
+        index_path = self._index_path()
+        if isfile(index_path):
+            try:
+                with open(index_path, 'r') as index_file:
+                    saved = json.load(index_file)
+                if saved['signature'] == signature:
+                    return dict((name, tuple(entry)) for name, entry in saved['members'].items())
+            except (ValueError, KeyError):
+                pass
+
+        # Scan the archive headers
+        index = {}
+        with profiling.span('archive.index', archive=self.name), tarfile.open(self.archive_path) as archive:
+            for member in archive:
+                if member.isfile():
+                    index[basename(member.name)] = (member.offset_data, member.size)
+
+        # Save it, writing to a temporary file first so concurrent processes
+        # never see a partial index
+        try:
+            makedirs(dirname(index_path), exist_ok=True)
+            tmp_path = '{0}.{1:d}.tmp'.format(index_path, getpid())
+            with open(tmp_path, 'w') as index_file:
+                json.dump({'signature': signature, 'members': index}, index_file)
+            replace(tmp_path, index_path)
+        except OSError:
+            pass
+
+        return index
+
+    def members(self):
+        """
+        :return: list of member names
+        """
+
+        return sorted(self.index.keys())
+
+    def _extracted_path(self, name):
+        """
+        :param name: member name
+        :return: path the member is (or would be) extracted to
+        """
+
+        return join(self.directory, name)
+
+    def _read_stream(self, name):
+        """
+        Reads a member from the (possibly compressed) tar stream
+
+        :param name: member name
+        :return: bytes
+        """
+
+        offset, size = self.index[name]
+        opener = self._stream_opener or open
+        with profiling.span('archive.read_member', member=name) as stage, opener(self.archive_path, 'rb') as stream:
+            stream.seek(offset)
+            stage.add(bytes_read=size, bytes_skipped=offset)
+            return stream.read(size)
+
+    def _extract(self, name):
+        """
+        Extracts a member to the cache directory if it is not already there
+
+        :param name: member name
+        :return: path to the extracted member
+        """
+
+        path = self._extracted_path(name)
+        if not isfile(path):
+            self.extract_members([name])
+        return path
+
+    def extract_members(self, names):
+        """
+        Extracts the members of a compressed archive that are not in the cache
+        directory yet, in a single pass over the stream (reading the members one
+        at a time would decompress the archive from the start for each of them)
+
+        :param names: member names
+        """
+
+        if self._stream_opener is None or self.directory is None:
+            return
+        missing = sorted((name for name in set(names) if not isfile(self._extracted_path(name))),
+                         key=lambda name: self.index[name][0])
+        if not missing:
+            return
+
+        makedirs(self.directory, exist_ok=True)
+        with profiling.span('archive.extract', archive=self.name) as stage, \
+                self._stream_opener(self.archive_path, 'rb') as stream:
+            for name in missing:
+                offset, size = self.index[name]
+                stage.add(bytes_read=size, bytes_skipped=offset - stream.tell())
+                # Seeking forward decompresses the stream up to the member
+                stream.seek(offset)
+                path = self._extracted_path(name)
+                tmp_path = '{0}.{1:d}.{2:d}.tmp'.format(path, getpid(), threading.get_ident())
+                with open(tmp_path, 'wb') as member_file:
+                    remaining = size
+                    while remaining > 0:
+                        chunk = stream.read(min(remaining, 2**22))
+                        if not chunk:
+                            raise EOFError('Archive {0} ends inside member {1}'.format(self.archive_path, name))
+                        member_file.write(chunk)
+                        remaining -= len(chunk)
+                replace(tmp_path, path)
+
+    def read_member(self, name):
+        """
+        Reads the contents of a member
+
+        :param name: member name
+        :return: bytes
+        """
+
+        if self._stream_opener is not None and self.directory is not None:
+            with open(self._extract(name), 'rb') as member_file:
+                return member_file.read()
+        return self._read_stream(name)
+
+    def open_tiff(self, name):
+        """
+        Opens a member as a TiffImage without extracting the archive
+
+        :param name: member name
+        :return: TiffImage object
+        """
+
+        if self._stream_opener is None:
+            return TiffImage(self.archive_path, offset=self.index[name][0])
+        if self.directory is not None:
+            return TiffImage(self._extract(name))
+        return TiffImage(self._read_stream(name))
+
+
+def open_archive(archive_path, extracted_dir=None, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Picks the archive backend for a path
+
+    :param archive_path: path to an archive, or a directory it was extracted to
+    :param extracted_dir: directory to look for an earlier extraction of the archive
+    :param cache_dir: directory to extract members of compressed archives to (see LandsatArchive)
+    :return: ExtractedArchive or LandsatArchive object
+    """
+
+    if isdir(archive_path):
+        return ExtractedArchive(archive_path)
+    if extracted_dir is not None and isdir(join(extracted_dir, archive_stem(archive_path))):
+        return ExtractedArchive(join(extracted_dir, archive_stem(archive_path)))
+    return LandsatArchive(archive_path, cache_dir=cache_dir)
@@ -0,0 +1,131 @@
+"""
+Bounded memory cache for decoded band images
+"""
+
+# Imports
+from collections import OrderedDict
+from threading import Lock
+
+# Constants
+DEFAULT_MAX_BYTES = 2*1024**3
+
+
+class BandCache(object):
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Create a least recently used cache of decoded band images. Entries are
+        keyed by (scene_id, band, dtype, converted) and evicted oldest first
+        once the total size of the cached arrays exceeds max_bytes.
+
+        :param max_bytes: memory budget of the cache in bytes
+        :return: BandCache object
+        """
+
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Gets an entry from the cache and marks it as most recently used
+
+        :param key: (scene_id, band, dtype, converted) tuple
+        :return: cached array or None if the key is not in the cache
+        """
+
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Adds an entry to the cache, evicting the least recently used entries
+        until it fits. Arrays larger than the whole budget are not cached.
+
+        :param key: (scene_id, band, dtype, converted) tuple
+        :param value: numpy array to cache (made read only)
+        """
+
+        if value.nbytes > self.max_bytes:
+            return
+        value.flags.writeable = False
+
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key).nbytes
+            while self._entries and self.current_bytes + value.nbytes > self.max_bytes:
+                self.current_bytes -= self._entries.popitem(last=False)[1].nbytes
+                self.evictions += 1
+            self._entries[key] = value
+            self.current_bytes += value.nbytes
+
+    def get_or_load(self, key, loader):
+        """
+        Gets an entry from the cache, calling loader() to create it on a miss
+
+        :param key: (scene_id, band, dtype, converted) tuple
+        :param loader: function with no arguments returning the array
+        :return: cached array
+        """
+
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        """
+        Removes every entry from the cache and resets the counters
+        """
+
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def hit_rate(self):
+        """
+        Fraction of lookups that were served from the cache
+
+        :return: hit rate between 0 and 1 (0 if there were no lookups)
+        """
+
+        lookups = self.hits + self.misses
+        return self.hits/lookups if lookups else 0.0
+
+    def stats(self):
+        """
+        Summary of the cache usage
+
+        :return: dictionary of counters
+        """
+
+        return {
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate(),
+        }
@@ -0,0 +1,270 @@
+"""
+Persistent index of Landsat scenes so scenes can be found by date and
+footprint without opening every archive
+"""
+
+# Imports
+import json
+import sqlite3
+import tarfile
+from datetime import datetime
+from os import listdir, stat
+from os.path import join, isdir, abspath, basename
+
+from .scene import LandsatScene
+
+# Constants
+ARCHIVE_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+RADIOMETRIC_KEYS = {
+    'radiance_mult': 'RADIOMETRIC_RESCALING/RADIANCE_MULT_BAND_{0:d}',
+    'radiance_add': 'RADIOMETRIC_RESCALING/RADIANCE_ADD_BAND_{0:d}',
+    'reflectance_mult': 'RADIOMETRIC_RESCALING/REFLECTANCE_MULT_BAND_{0:d}',
+    'reflectance_add': 'RADIOMETRIC_RESCALING/REFLECTANCE_ADD_BAND_{0:d}',
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    archive_path TEXT PRIMARY KEY,
+    archive_size INTEGER,
+    archive_mtime REAL,
+    scene_id TEXT,
+    spacecraft TEXT,
+    acquired TEXT,
+    year INTEGER,
+    month INTEGER,
+    day INTEGER,
+    day_of_year INTEGER,
+    wrs_path INTEGER,
+    wrs_row INTEGER,
+    utm_zone INTEGER,
+    min_x REAL,
+    max_x REAL,
+    min_y REAL,
+    max_y REAL,
+    pixel_size REAL,
+    lines INTEGER,
+    samples INTEGER,
+    sun_azimuth REAL,
+    sun_elevation REAL,
+    radiometry TEXT
+);
+CREATE INDEX IF NOT EXISTS scenes_acquired ON scenes (acquired);
+CREATE INDEX IF NOT EXISTS scenes_year_month ON scenes (year, month);
+CREATE INDEX IF NOT EXISTS scenes_path_row ON scenes (wrs_path, wrs_row);
+CREATE INDEX IF NOT EXISTS scenes_footprint ON scenes (min_x, max_x, min_y, max_y);
+CREATE TABLE IF NOT EXISTS rejected (
+    archive_path TEXT PRIMARY KEY,
+    archive_size INTEGER,
+    archive_mtime REAL
+);
+"""
+
+
+def _is_archive(path):
+    """
+    :return: true if the path looks like an archive file or a directory an
+             archive was extracted to (holding the MTL file)
+    """
+
+    name = basename(path)
+    if name.startswith('.'):
+        return False
+    if isdir(path):
+        return any(member.endswith('_MTL.txt') for member in listdir(path))
+    return name.endswith(ARCHIVE_EXTENSIONS)
+
+
+def _optional(metadata, key, convert=float):
+    """
+    :return: the converted metadata value, or None if the key is missing
+    """
+
+    return convert(metadata[key]) if key in metadata else None
+
+
+def scene_record(archive_path):
+    """
+    Reads the catalog record of one archive (only the MTL file is read)
+
+    :param archive_path: path to the archive (or extracted directory)
+    :return: dictionary of catalog columns
+    """
+
+    scene = LandsatScene(archive_path)
+    metadata = scene.metadata
+    archive_stat = stat(archive_path)
+
+    # Radiometric coefficients of every band
+    radiometry = {}
+    band = 1
+    while RADIOMETRIC_KEYS['radiance_mult'].format(band) in metadata:
+        radiometry[band] = dict((name, _optional(metadata, key.format(band)))
+                                for name, key in RADIOMETRIC_KEYS.items())
+        band += 1
+
+    acquired = datetime(scene.year, scene.month, scene.day, scene.hour, scene.minute, scene.second)
+    corners = scene.coords*scene.pixel_size
+
+    return {
+        'archive_path': abspath(archive_path),
+        'archive_size': archive_stat.st_size,
+        'archive_mtime': archive_stat.st_mtime,
+        'scene_id': scene.scene_id,
+        'spacecraft': metadata.get('PRODUCT_METADATA/SPACECRAFT_ID'),
+        'acquired': acquired.isoformat(),
+        'year': int(scene.year),
+        'month': int(scene.month),
+        'day': int(scene.day),
+        'day_of_year': acquired.timetuple().tm_yday,
+        'wrs_path': _optional(metadata, 'PRODUCT_METADATA/WRS_PATH', int),
+        'wrs_row': _optional(metadata, 'PRODUCT_METADATA/WRS_ROW', int),
+        'utm_zone': _optional(metadata, 'PROJECTION_PARAMETERS/UTM_ZONE', int),
+        'min_x': float(corners[:, 0].min()),
+        'max_x': float(corners[:, 0].max()),
+        'min_y': float(corners[:, 1].min()),
+        'max_y': float(corners[:, 1].max()),
+        'pixel_size': scene.pixel_size,
+        'lines': int(scene.image_size[1]),
+        'samples': int(scene.image_size[0]),
+        'sun_azimuth': _optional(metadata, 'IMAGE_ATTRIBUTES/SUN_AZIMUTH'),
+        'sun_elevation': _optional(metadata, 'IMAGE_ATTRIBUTES/SUN_ELEVATION'),
+        'radiometry': json.dumps(radiometry),
+    }
+
+
+class SceneCatalog(object):
+
+    def __init__(self, db_path):
+        """
+        Open (or create) a scene catalog stored in an SQLite database
+
+        :param db_path: path to the database file
+        :return: SceneCatalog object
+        """
+
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM scenes').fetchone()[0]
+
+    def add(self, archive_path):
+        """
+        Adds (or refreshes) the record of one archive
+
+        :param archive_path: path to the archive
+        :return: the record that was stored
+        """
+
+        record = scene_record(archive_path)
+        columns = ', '.join(record.keys())
+        placeholders = ', '.join('?' for _ in record)
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO scenes ({0}) VALUES ({1})'.format(columns, placeholders),
+                list(record.values())
+            )
+        return record
+
+    def update(self, directory):
+        """
+        Adds every archive in a directory that is not in the catalog yet or
+        has changed since it was added. Unchanged archives are not opened, and
+        neither are files that could not be read before until they change.
+
+        :param directory: directory containing archives (or extracted archives)
+        :return: number of archives that were added or refreshed
+        """
+
+        known = {}
+        for table in ('scenes', 'rejected'):
+            known.update(
+                (row['archive_path'], (row['archive_size'], row['archive_mtime']))
+                for row in self.connection.execute(
+                    'SELECT archive_path, archive_size, archive_mtime FROM {0}'.format(table))
+            )
+
+        num_added = 0
+        for name in sorted(listdir(directory)):
+            path = join(directory, name)
+            if not _is_archive(path):
+                continue
+            archive_stat = stat(path)
+            if known.get(abspath(path)) == (archive_stat.st_size, archive_stat.st_mtime):
+                continue
+            try:
+                self.add(path)
+            except (OSError, KeyError, ValueError, AttributeError, tarfile.TarError):
+                # Not a Landsat archive, remember it so it is not retried until it changes
+                with self.connection:
+                    self.connection.execute('INSERT OR REPLACE INTO rejected VALUES (?, ?, ?)',
+                                            [abspath(path), archive_stat.st_size, archive_stat.st_mtime])
+                continue
+            with self.connection:
+                self.connection.execute('DELETE FROM rejected WHERE archive_path = ?', [abspath(path)])
+            num_added += 1
+
+        return num_added
+
+    def query(self, nw_coords=None, se_coords=None, start=None, end=None, years=None, months=None,
+              wrs_path=None, wrs_row=None):
+        """
+        Finds the scenes matching all of the given conditions
+
+        :param nw_coords: UTM coordinates (meters) of the north west corner of a box the scenes must intersect
+        :param se_coords: UTM coordinates (meters) of the south east corner of the box
+        :param start: earliest acquisition (datetime or ISO string)
+        :param end: latest acquisition (datetime or ISO string)
+        :param years: list of acquisition years
+        :param months: list of acquisition months (e.g. range(5, 10) for May to September)
+        :param wrs_path: WRS path
+        :param wrs_row: WRS row
+        :return: list of scene records (dictionaries) sorted by acquisition time
+        """
+
+        conditions = []
+        parameters = []
+        if nw_coords is not None and se_coords is not None:
+            conditions.append('min_x <= ? AND max_x >= ? AND min_y <= ? AND max_y >= ?')
+            parameters += [float(se_coords[0]), float(nw_coords[0]), float(nw_coords[1]), float(se_coords[1])]
+        if start is not None:
+            conditions.append('acquired >= ?')
+            parameters.append(start.isoformat() if hasattr(start, 'isoformat') else start)
+        if end is not None:
+            conditions.append('acquired <= ?')
+            parameters.append(end.isoformat() if hasattr(end, 'isoformat') else end)
+        for column, values in (('year', years), ('month', months)):
+            if values is not None:
+                values = [int(value) for value in values]
+                conditions.append('{0} IN ({1})'.format(column, ', '.join('?' for _ in values)))
+                parameters += values
+        for column, value in (('wrs_path', wrs_path), ('wrs_row', wrs_row)):
+            if value is not None:
+                conditions.append('{0} = ?'.format(column))
+                parameters.append(int(value))
+
+        sql = 'SELECT * FROM scenes'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY acquired, scene_id'
+
+        records = []
+        for row in self.connection.execute(sql, parameters):
+            record = dict(row)
+            record['radiometry'] = dict((int(band), value) for band, value in json.loads(record['radiometry']).items())
+            records.append(record)
+        return records
+
+    def archive_paths(self, **conditions):
+        """
+        Archive paths of the scenes matching the conditions of query()
+
+        :return: list of archive paths sorted by acquisition time
+        """
+
+        return [record['archive_path'] for record in self.query(**conditions)]
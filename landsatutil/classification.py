@@ -0,0 +1,370 @@
+"""
+Trained crop classifiers and batch inference of crop types for fields and
+for single pixels
+"""
+
+# Imports
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from os import replace
+from numpy import asarray, column_stack, isfinite, full, zeros, unique, searchsorted, argmax, bincount
+from numpy import array, sqrt, nan, float32, float64, int16, int64
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import SVC
+
+from . import profiling
+from .reducers import tile_bounds
+from .scene import open_scene
+from .temporal import NODATA, _ordered_map
+
+# Constants
+MODEL_VERSION = 1
+DEFAULT_CHUNK_ROWS = 65536
+DEFAULT_MEMORY_BUDGET = 1 << 30
+DEFAULT_BATCH_ROWS = 8192
+# Bytes held for each pixel and feature of a tile being classified: the
+# float32 stack and the float64 feature matrix and its scaled copy
+BYTES_PER_PIXEL_FEATURE = 4 + 8 + 8
+
+# Model used by the tiles of a worker process, set once by the pool initializer
+_worker_model = {}
+
+
+class CropModel(object):
+
+    def __init__(self, features, classifier=None, scale=True):
+        """
+        Create a crop classifier together with the features it uses and their scaling
+
+        :param features: list of the names of the explanatory variables, in order
+        :param classifier: scikit-learn classifier (default: SVC())
+        :param scale: if true the features are standardized before the classifier
+        :return: CropModel object
+        """
+
+        self.features = list(features)
+        self.classifier = SVC() if classifier is None else classifier
+        self.scaler = StandardScaler() if scale else None
+        self.classes = None
+
+    def matrix(self, columns):
+        """
+        Stacks the features of a set of rows into a matrix
+
+        :param columns: dictionary (or DataFrame) of column name -> 1D array
+        :return: (rows x features) float array
+        """
+
+        return column_stack([asarray(columns[name], dtype=float64) for name in self.features])
+
+    @profiling.profiled('classification.fit')
+    def fit(self, columns, outcomes):
+        """
+        Trains the model
+
+        :param columns: dictionary (or DataFrame) of column name -> 1D array
+        :param outcomes: array of the true classes of the rows
+        :return: the model
+        """
+
+        data = self.matrix(columns)
+        profiling.current().add(rows=data.shape[0])
+        if self.scaler is not None:
+            data = self.scaler.fit_transform(data)
+        self.classifier.fit(data, asarray(outcomes))
+        self.classes = self.classifier.classes_
+        return self
+
+    def predict_index(self, columns):
+        """
+        Predicts the class of a set of rows as an index into classes
+
+        :param columns: dictionary (or DataFrame) of column name -> 1D array
+        :return: int array of class indices, -1 for rows with missing (non finite) features
+        """
+
+        return self.predict_matrix_index(self.matrix(columns))
+
+    @profiling.profiled('classification.predict')
+    def predict_matrix_index(self, data, batch_rows=None):
+        """
+        Predicts the class of the rows of a feature matrix as an index into classes
+
+        :param data: (rows x features) array with the columns in the order of features
+        :param batch_rows: optional number of rows predicted at once (bounds the
+                           memory the classifier uses, e.g. for SVC kernel values)
+        :return: int array of class indices, -1 for rows with missing (non finite) features
+        """
+
+        index = full(data.shape[0], -1, dtype=int64)
+        profiling.current().add(rows=data.shape[0])
+        batch_rows = data.shape[0] if batch_rows is None else batch_rows
+        for start in range(0, data.shape[0], max(batch_rows, 1)):
+            batch = asarray(data[start:start + batch_rows], dtype=float64)
+            complete = isfinite(batch).all(axis=1)
+            if complete.any():
+                batch = batch[complete]
+                if self.scaler is not None:
+                    batch = self.scaler.transform(batch)
+                index[start:start + batch_rows][complete] = searchsorted(self.classes, self.classifier.predict(batch))
+        return index
+
+    def predict(self, columns):
+        """
+        Predicts the class of a set of rows
+
+        :param columns: dictionary (or DataFrame) of column name -> 1D array
+        :return: array of classes
+        """
+
+        index = self.predict_index(columns)
+        if (index < 0).any():
+            raise ValueError('Rows with missing features can not be classified')
+        return self.classes[index]
+
+    def save(self, path):
+        """
+        Writes the model to a file
+
+        :param path: output file path
+        """
+
+        with open(path + '.tmp', 'wb') as model_file:
+            pickle.dump({'version': MODEL_VERSION, 'model': self}, model_file, protocol=pickle.HIGHEST_PROTOCOL)
+        replace(path + '.tmp', path)
+
+
+def crop_estimator(scale=True, **classifier_params):
+    """
+    scikit-learn estimator that scales and classifies a feature matrix the way
+    CropModel does, to cross validate the saved model (evaluation.evaluate)
+
+    :param scale: if true the features are standardized before the classifier
+    :param classifier_params: parameters of the SVC (e.g. C)
+    :return: SVC, or pipeline of a StandardScaler and an SVC
+    """
+
+    classifier = SVC(**classifier_params)
+    if not scale:
+        return classifier
+    return make_pipeline(StandardScaler(), classifier)
+
+
+def load_model(path):
+    """
+    Reads a model written by CropModel.save
+
+    :param path: model file path
+    :return: CropModel object
+    """
+
+    with open(path, 'rb') as model_file:
+        saved = pickle.load(model_file)
+    if saved.get('version') != MODEL_VERSION:
+        raise ValueError('Unsupported crop model version {0}'.format(saved.get('version')))
+    return saved['model']
+
+
+def predict_fields(model, store, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Classifies the fields of a feature store. The rows (one per field and
+    scene) are read from the memory mapped columns and classified a chunk at a
+    time, every field gets the class predicted for most of its scenes.
+
+    :param model: CropModel
+    :param store: FeatureStore holding the model features and a 'label' column
+    :param chunk_rows: number of rows classified at once
+    :return: (field labels, class index of each field (-1 if none of its rows
+             could be classified), fraction of the field's scenes voting for the class)
+    """
+
+    columns = store.read(['label'] + [name for name in model.features if name != 'label'])
+    row_labels = columns['label']
+    field_labels = unique(row_labels)
+
+    # Count the votes of the scenes of each field for each class
+    num_classes = len(model.classes)
+    votes = zeros(field_labels.size*num_classes, dtype=int64)
+    for start in range(0, row_labels.shape[0], chunk_rows):
+        chunk = dict((name, value[start:start + chunk_rows]) for name, value in columns.items())
+        class_index = model.predict_index(chunk)
+        voted = class_index >= 0
+        field_index = searchsorted(field_labels, chunk['label'][voted])
+        votes += bincount(field_index*num_classes + class_index[voted], minlength=votes.size)
+    votes = votes.reshape(field_labels.size, num_classes)
+
+    classified = votes.sum(axis=1)
+    field_class = argmax(votes, axis=1)
+    field_class[classified == 0] = -1
+    fraction = zeros(field_labels.size)
+    with_votes = classified > 0
+    fraction[with_votes] = votes[with_votes, field_class[with_votes]] / classified[with_votes]
+    return field_labels, field_class, fraction
+
+
+def burn_predictions(field_mask, labels, values, fill=0, chunk_rows=1024, out=None, dtype=int16):
+    """
+    Writes a value for each field into a raster aligned with the field mask,
+    a block of rows at a time
+
+    :param field_mask: 2D labeled field image (may be a memmap)
+    :param labels: array of field labels
+    :param values: array of the value of each field
+    :param fill: value of the pixels of other labels and the background
+    :param chunk_rows: number of rows processed at once
+    :param out: optional output array (e.g. a memmap), created if not given
+    :param dtype: data type of the created output array
+    :return: 2D raster of the field values
+    """
+
+    labels = asarray(labels, dtype=int64)
+    if out is None:
+        out = zeros(field_mask.shape, dtype=dtype)
+
+    # Lookup table from label to value
+    lookup = full(int(max(labels.max(initial=0), 0)) + 1, fill, dtype=out.dtype)
+    keep = labels >= 0
+    lookup[labels[keep]] = asarray(values)[keep]
+
+    for start in range(0, field_mask.shape[0], chunk_rows):
+        block = asarray(field_mask[start:start + chunk_rows], dtype=int64)
+        inside = (block >= 0) & (block < lookup.size)
+        out_block = full(block.shape, fill, dtype=out.dtype)
+        out_block[inside] = lookup[block[inside]]
+        out[start:start + chunk_rows] = out_block
+    return out
+
+
+def pixel_feature_names(num_dates, bands):
+    """
+    Names of the per pixel features, the value of each band on each date
+
+    :param num_dates: number of dates (scenes)
+    :param bands: list of bands
+    :return: list of feature names, date major
+    """
+
+    return ['d{0:d}_b{1:d}'.format(t, band) for t in range(num_dates) for band in bands]
+
+
+def _read_pixel_features(archive_paths, bands, nw_coords, se_coords, shape, product):
+    """
+    Reads the band stack of a window of a set of scenes as a feature matrix
+
+    :return: (pixels x features) float32 matrix with the features ordered as
+             pixel_feature_names, nan for nodata and pixels outside a scene
+    """
+
+    stack = full((shape[0], shape[1], len(archive_paths)*len(bands)), nan, dtype=float32)
+    for t, archive_path in enumerate(archive_paths):
+        scene = open_scene(archive_path)
+        for b, band in enumerate(bands):
+            image = scene.get_band_subimage(band, nw_coords, se_coords, convert=False)[0:shape[0], 0:shape[1]]
+            valid = image != NODATA
+            scene.calibrate(image, band, product, out=image)
+            image[~valid] = nan
+            stack[0:image.shape[0], 0:image.shape[1], t*len(bands) + b] = image
+    return stack.reshape(-1, stack.shape[2])
+
+
+def region_shape(archive_paths, nw_coords, se_coords):
+    """
+    :return: (pixel size, (rows, cols)) of a region in the first scene
+    """
+
+    scene = open_scene(archive_paths[0])
+    nw_pixel = scene.coords_to_pixel(nw_coords)
+    se_pixel = scene.coords_to_pixel(se_coords)
+    return scene.pixel_size, (int(se_pixel[1] - nw_pixel[1]), int(se_pixel[0] - nw_pixel[0]))
+
+
+def pixel_features(archive_paths, nw_coords, se_coords, bands=tuple(range(1, 8)), product='reflectance'):
+    """
+    Reads the per pixel features of a (small) region, e.g. to train a pixel model
+
+    :param archive_paths: list of archive paths, one per date
+    :param nw_coords: UTM coordinates (meters) of the north west corner of the region
+    :param se_coords: UTM coordinates (meters) of the south east corner of the region
+    :param bands: list of bands
+    :param product: radiometric product (see radiometry.calibrate)
+    :return: dictionary of feature name -> 2D image
+    """
+
+    _, shape = region_shape(archive_paths, nw_coords, se_coords)
+    data = _read_pixel_features(archive_paths, list(bands), nw_coords, se_coords, shape, product)
+    names = pixel_feature_names(len(archive_paths), list(bands))
+    return dict((name, data[:, n].reshape(shape)) for n, name in enumerate(names))
+
+
+def _init_worker(model):
+    _worker_model['model'] = model
+
+
+def _classify_tile(task):
+    """
+    Reads and classifies the pixels of one tile (run in worker processes)
+
+    :param task: (archive paths, bands, product, tile nw coords, tile se coords, tile shape, batch rows) tuple
+    :return: 2D array of class indices, -1 where the pixel could not be classified
+    """
+
+    archive_paths, bands, product, nw_coords, se_coords, shape, batch_rows = task
+    data = _read_pixel_features(archive_paths, bands, nw_coords, se_coords, shape, product)
+    return _worker_model['model'].predict_matrix_index(data, batch_rows).reshape(shape)
+
+
+def classify_pixels(model, archive_paths, nw_coords, se_coords, bands=tuple(range(1, 8)), product='reflectance',
+                    memory_budget=DEFAULT_MEMORY_BUDGET, batch_rows=DEFAULT_BATCH_ROWS, workers=1, out=None):
+    """
+    Classifies every pixel of a region from its band values on a set of dates.
+    The region is split into tiles small enough that the tiles being read and
+    classified at once fit in the memory budget, and each classified tile is
+    written to the output straight away, so the region can be a whole scene.
+
+    :param model: CropModel trained on the features named by pixel_feature_names
+    :param archive_paths: list of archive paths, one per date, in the order the model was trained with
+    :param nw_coords: UTM coordinates (meters) of the north west corner of the region
+    :param se_coords: UTM coordinates (meters) of the south east corner of the region
+    :param bands: list of bands
+    :param product: radiometric product (see radiometry.calibrate)
+    :param memory_budget: approximate number of bytes the tiles in flight may use
+    :param batch_rows: number of pixels the classifier predicts at once
+    :param workers: number of worker processes
+    :param out: optional int16 output array (e.g. a memmap), created if not given
+    :return: 2D array of class indices into model.classes, -1 where a pixel could not be classified
+    """
+
+    bands = list(bands)
+    nw_coords = asarray(nw_coords, dtype=float)
+    pixel_size, shape = region_shape(archive_paths, nw_coords, se_coords)
+    if out is None:
+        out = full(shape, -1, dtype=int16)
+
+    # Tile size from the memory budget
+    in_flight = 2*workers if workers > 1 else 1
+    num_features = len(archive_paths)*len(bands)
+    tile_pixels = memory_budget / (BYTES_PER_PIXEL_FEATURE*num_features*in_flight)
+    tile_size = max(int(sqrt(tile_pixels)), 16)
+
+    tiles = tile_bounds(shape, tile_size)
+    tasks = [
+        (archive_paths, bands, product,
+         nw_coords + pixel_size*array([col_start, -row_start]),
+         nw_coords + pixel_size*array([col_stop, -row_stop]),
+         (row_stop - row_start, col_stop - col_start), batch_rows)
+        for row_start, row_stop, col_start, col_stop in tiles
+    ]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(model,)) as executor:
+            for (row_start, row_stop, col_start, col_stop), classes in \
+                    zip(tiles, _ordered_map(executor, _classify_tile, tasks, in_flight)):
+                out[row_start:row_stop, col_start:col_stop] = classes
+    else:
+        _init_worker(model)
+        for (row_start, row_stop, col_start, col_stop), task in zip(tiles, tasks):
+            out[row_start:row_stop, col_start:col_stop] = _classify_tile(task)
+        _worker_model.clear()
+
+    return out
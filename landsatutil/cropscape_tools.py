@@ -2,14 +2,213 @@
 File with functions for extracting data from cropscape
 """
 
-from urllib.request import urlretrieve
-from skimage.io import imread
-from skimage.transform import resize
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs, replace, getpid
+from os.path import join, exists
+from time import sleep
+from urllib.error import URLError, HTTPError
+from urllib.request import urlopen
+from numpy import zeros
+from skimage.io import imread, imsave
 
 from .earth_calc import utm_to_latlon
 
+# Constants
+DEFAULT_ENDPOINT = 'http://129.174.131.7/cgi/wms_cdlall.cgi'
+DEFAULT_CACHE_DIR = join('tmp', 'cdl_cache')
+# Largest tile edge (pixels) requested at once, bigger images are mosaicked
+DEFAULT_TILE_SIZE = 2000
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
 
-def get_crop_data(filename, shape, zone, nw_corner, se_corner, year, n_hemisphere=True):
+
+def _split(start, stop, pixels, tile_size):
+    """
+    Splits a coordinate range sampled by a number of pixels into tiles
+
+    :return: list of (first pixel, number of pixels, tile start, tile stop) tuples
+    """
+
+    step = (stop - start) / pixels
+    return [
+        (first, min(tile_size, pixels - first), start + first*step, start + min(first + tile_size, pixels)*step)
+        for first in range(0, pixels, tile_size)
+    ]
+
+
+class CropscapeFetcher(object):
+
+    def __init__(self, endpoint=DEFAULT_ENDPOINT, cache_dir=DEFAULT_CACHE_DIR, max_connections=4, retries=3,
+                 timeout=60, tile_size=DEFAULT_TILE_SIZE):
+        """
+        Create a fetcher of Cropland Data Layer images from a WMS server. Every
+        request is cached on disk keyed by the year, bounding box and shape,
+        so repeated requests are read from the cache.
+
+        :param endpoint: URL of the WMS service
+        :param cache_dir: directory for the cached images
+        :param max_connections: maximum number of concurrent requests
+        :param retries: number of times a failed request is retried
+        :param timeout: request timeout in seconds
+        :param tile_size: largest tile edge in pixels requested at once
+        :return: CropscapeFetcher object
+        """
+
+        self.endpoint = endpoint
+        self.cache_dir = cache_dir
+        self.max_connections = max_connections
+        self.retries = retries
+        self.timeout = timeout
+        self.tile_size = tile_size
+        makedirs(cache_dir, exist_ok=True)
+
+    def request_url(self, year, bbox, width, height):
+        """
+        :param year: year of the data layer
+        :param bbox: (west, south, east, north) bounding box in degrees
+        :param width: image width in pixels
+        :param height: image height in pixels
+        :return: WMS GetMap request URL
+        """
+
+        return '{0}?SERVICE=WMS&VERSION=1.1.1&REQUEST=GetMap&LAYERS=cdl_{1:d}&STYLES=&SRS=EPSG:4326&BBOX={2:f},{3:f},{4:f},{5:f}&WIDTH={6:d}&HEIGHT={7:d}&FORMAT=image/png'.format(
+            self.endpoint, year, bbox[0], bbox[1], bbox[2], bbox[3], width, height
+        )
+
+    def cache_path(self, year, bbox, width, height):
+        """
+        :return: path of the cached image of a request
+        """
+
+        key = '{0}|{1:d}|{2:f},{3:f},{4:f},{5:f}|{6:d}x{7:d}'.format(
+            self.endpoint, year, bbox[0], bbox[1], bbox[2], bbox[3], width, height
+        )
+        return join(self.cache_dir, '{0:d}_{1}.png'.format(year, hashlib.sha1(key.encode()).hexdigest()))
+
+    def _download(self, year, bbox, width, height):
+        """
+        Gets the image of one request into the cache, retrying failed requests
+        with an increasing delay
+
+        :return: path of the cached image
+        """
+
+        path = self.cache_path(year, bbox, width, height)
+        if exists(path):
+            return path
+
+        url = self.request_url(year, bbox, width, height)
+        for attempt in range(self.retries + 1):
+            try:
+                with urlopen(url, timeout=self.timeout) as response:
+                    data = response.read()
+                # The service reports errors as XML documents
+                if not data.startswith(PNG_SIGNATURE):
+                    raise ValueError('Cropscape request did not return an image: {0}'.format(data[:200]))
+                break
+            except (URLError, OSError, ValueError) as error:
+                if isinstance(error, HTTPError) and error.code < 500 or attempt == self.retries:
+                    raise
+                sleep(0.5 * 2**attempt)
+
+        # Write the image atomically so an interrupted download is not cached,
+        # to a temporary file of its own in case another process gets it too
+        tmp_path = '{0}.{1:d}.{2:d}.tmp'.format(path, getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as image_file:
+            image_file.write(data)
+        replace(tmp_path, path)
+        return path
+
+    def _tiles(self, year, bbox, width, height):
+        """
+        :return: list of (row, col, tile request) tuples covering the image
+        """
+
+        west, south, east, north = bbox
+        return [
+            (row, col, (year, (tile_west, tile_south, tile_east, tile_north), cols, rows))
+            for row, rows, tile_north, tile_south in _split(north, south, height, self.tile_size)
+            for col, cols, tile_west, tile_east in _split(west, east, width, self.tile_size)
+        ]
+
+    def fetch_many(self, requests):
+        """
+        Fetches a set of images, the tiles of all of them are downloaded concurrently
+
+        :param requests: list of (year, (west, south, east, north), width, height) tuples
+        :return: list of images (height x width x channels arrays)
+        """
+
+        tiles = [self._tiles(*request) for request in requests]
+
+        # Every distinct tile is downloaded once, even if several images share it
+        tile_requests = list(dict.fromkeys(tile[2] for image_tiles in tiles for tile in image_tiles))
+        with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            paths = dict(zip(tile_requests, executor.map(lambda request: self._download(*request), tile_requests)))
+
+        # Mosaic the tiles of each image
+        images = []
+        for (year, bbox, width, height), image_tiles in zip(requests, tiles):
+            image = None
+            for row, col, tile_request in image_tiles:
+                tile = imread(paths[tile_request])
+                if image is None:
+                    image = zeros((height, width) + tile.shape[2:], dtype=tile.dtype)
+                image[row:row + tile.shape[0], col:col + tile.shape[1]] = tile
+            images.append(image)
+        return images
+
+    def fetch(self, year, bbox, width, height):
+        """
+        Fetches one image
+
+        :param year: year of the data layer
+        :param bbox: (west, south, east, north) bounding box in degrees
+        :param width: image width in pixels
+        :param height: image height in pixels
+        :return: image (height x width x channels array)
+        """
+
+        return self.fetch_many([(year, bbox, width, height)])[0]
+
+
+def utm_bbox(zone, nw_corner, se_corner, n_hemisphere=True):
+    """
+    Latitude and longitude bounding box of a UTM box
+
+    :param zone: UTM coordinate zone
+    :param nw_corner: northwest corner in UTM coordinates (easting, northing) (meters)
+    :param se_corner: southeast corner in UTM coordinates (easting, northing) (meters)
+    :return: (west, south, east, north) in degrees
+    """
+
+    nw_lat, nw_lon = utm_to_latlon(zone, nw_corner[0], nw_corner[1], n_hemisphere=n_hemisphere)
+    se_lat, se_lon = utm_to_latlon(zone, se_corner[0], se_corner[1], n_hemisphere=n_hemisphere)
+    return float(nw_lon), float(se_lat), float(se_lon), float(nw_lat)
+
+
+def get_crop_data_years(shape, zone, nw_corner, se_corner, years, n_hemisphere=True, fetcher=None):
+    """
+    Downloads cropscape data for several years concurrently
+
+    :param shape: pixel shape of the images (width, height)
+    :param zone: UTM coordinate zone
+    :param nw_corner: northwest corner in UTM coordinates (easting, northing) (meters)
+    :param se_corner: southeast corner in UTM coordinates (easting, northing) (meters)
+    :param years: list of years to extract data for
+    :param fetcher: optional CropscapeFetcher (default: one with the default endpoint and cache)
+    :return: dictionary of year -> image of crop data
+    """
+
+    if fetcher is None:
+        fetcher = CropscapeFetcher()
+    bbox = utm_bbox(zone, nw_corner, se_corner, n_hemisphere=n_hemisphere)
+    images = fetcher.fetch_many([(year, bbox, shape[0], shape[1]) for year in years])
+    return dict(zip(years, images))
+
+
+def get_crop_data(filename, shape, zone, nw_corner, se_corner, year, n_hemisphere=True, fetcher=None):
     """
     Downloads cropscape data to an image file
 
@@ -19,19 +218,13 @@ def get_crop_data(filename, shape, zone, nw_corner, se_corner, year, n_hemispher
     :param nw_corner: northwest corner in UTM coordinates (easting, northing) (meters)
     :param se_corner: southeast corner in UTM coordinates (easting, northing) (meters)
     :param year: year to extract data for
+    :param fetcher: optional CropscapeFetcher (default: one with the default endpoint and cache)
     :return: image of crop data
     """
 
-    nw_lat, nw_lon = utm_to_latlon(zone, nw_corner[0], nw_corner[1], n_hemisphere=n_hemisphere)
-    se_lat, se_lon = utm_to_latlon(zone, se_corner[0], se_corner[1], n_hemisphere=n_hemisphere)
-
     if '.png' not in filename:
         filename += '.png'
 
-    request = 'http://129.174.131.7/cgi/wms_cdlall.cgi?SERVICE=WMS&VERSION=1.1.1&REQUEST=GetMap&LAYERS=cdl_{0:d}&STYLES=&SRS=EPSG:4326&BBOX={1:f},{2:f},{3:f},{4:f}&WIDTH={5:d}&HEIGHT={6:d}&FORMAT=image/png'.format(
-        year, nw_lon, se_lat, se_lon, nw_lat, shape[0], shape[1]
-    )
-
-    urlretrieve(request, filename)
-    crop_data = imread(filename)
-    return crop_data
\ No newline at end of file
+    crop_data = get_crop_data_years(shape, zone, nw_corner, se_corner, [year], n_hemisphere, fetcher)[year]
+    imsave(filename, crop_data, check_contrast=False)
+    return crop_data
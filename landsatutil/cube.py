@@ -0,0 +1,286 @@
+"""
+Analysis ready data cube of the radiance (or reflectance) of a set of
+scenes over one region, stored on disk as memory mapped (time, band, y, x) arrays
+
+The arrays are plain contiguous .npy files rather than a chunked format, so
+any selection of a time range, evenly spaced bands and a window is a view of
+the memory map (a chunked layout would have to copy the chunks into a new
+array). Every (time, band) plane is contiguous and stored row by row, so a
+window only pages in the rows it spans.
+"""
+
+# Imports
+import json
+from datetime import datetime
+from os import makedirs, replace
+from os.path import join, exists
+from numpy import array, asarray, floor, float32, bool_, datetime64, searchsorted, isin
+from numpy.lib.format import open_memmap
+
+from .scene import LandsatScene
+from .temporal import NODATA
+
+# Constants
+CUBE_METADATA = 'cube.json'
+CUBE_DATA = 'radiance.npy'
+CUBE_VALID = 'valid.npy'
+DEFAULT_CHUNK_ROWS = 512
+
+
+def _scene_offset(scene, nw_coords):
+    """
+    Pixel position of the cube origin in a scene
+
+    :param scene: LandsatScene
+    :param nw_coords: UTM coordinates (meters) of the north west corner of the cube
+    :return: (row, col) of the cube origin in the scene, negative if the scene starts inside the cube
+    """
+
+    col = floor(nw_coords[0]/scene.pixel_size - scene.coords[0, 0])
+    row = floor(scene.coords[0, 1] - nw_coords[1]/scene.pixel_size)
+    return int(row), int(col)
+
+
+def build_cube(directory, archive_paths, nw_coords, se_coords, bands=tuple(range(1, 8)),
+               chunk_rows=DEFAULT_CHUNK_ROWS, dtype=float32, product='radiance'):
+    """
+    Ingests a set of scenes (in the same UTM zone) into a data cube. Every
+    scene is aligned to the pixel grid starting at the north west corner, its
+    bands are read a block of rows at a time (so only one block is in memory)
+    and converted to radiance or reflectance in place in the cube. Pixels
+    outside a scene or with the nodata value in any band are marked invalid
+    (and zero).
+
+    :param directory: directory to write the cube to
+    :param archive_paths: list of archive paths
+    :param nw_coords: UTM coordinates (meters) of the north west corner of the cube
+    :param se_coords: UTM coordinates (meters) of the south east corner of the cube
+    :param bands: bands to ingest
+    :param chunk_rows: number of rows read at once
+    :param dtype: data type of the cube
+    :param product: radiometric product, 'radiance' or 'reflectance' (see radiometry.calibrate)
+    :return: DataCube opened read only
+    """
+
+    if not archive_paths:
+        raise ValueError('No scenes to build a cube from')
+    nw_coords = asarray(nw_coords, dtype=float)
+    se_coords = asarray(se_coords, dtype=float)
+    bands = [int(band) for band in bands]
+    makedirs(directory, exist_ok=True)
+
+    # Scenes in order of acquisition
+    scenes = [LandsatScene(archive_path) for archive_path in archive_paths]
+    acquired = [datetime(s.year, s.month, s.day, s.hour, s.minute, s.second) for s in scenes]
+    order = sorted(range(len(scenes)), key=lambda n: (acquired[n], scenes[n].scene_id))
+    scenes = [scenes[n] for n in order]
+    acquired = [acquired[n] for n in order]
+    archive_paths = [archive_paths[n] for n in order]
+
+    # Cube grid
+    pixel_size = scenes[0].pixel_size
+    rows = int(round((nw_coords[1] - se_coords[1])/pixel_size))
+    cols = int(round((se_coords[0] - nw_coords[0])/pixel_size))
+
+    data = open_memmap(join(directory, CUBE_DATA + '.tmp'), mode='w+', dtype=dtype,
+                       shape=(len(scenes), len(bands), rows, cols))
+    valid = open_memmap(join(directory, CUBE_VALID + '.tmp'), mode='w+', dtype=bool_,
+                        shape=(len(scenes), rows, cols))
+
+    for t, scene in enumerate(scenes):
+        # Part of the cube covered by the scene
+        row_offset, col_offset = _scene_offset(scene, nw_coords)
+        row_start, col_start = max(-row_offset, 0), max(-col_offset, 0)
+        row_stop = min(rows, scene.image_size[1] - row_offset)
+        col_stop = min(cols, scene.image_size[0] - col_offset)
+        valid[t] = False
+        data[t] = 0
+        if row_stop <= row_start or col_stop <= col_start:
+            continue
+
+        images = [scene.archive.open_tiff(scene.archive.find_member('_B{0:d}.TIF'.format(band))) for band in bands]
+        for chunk_start in range(row_start, row_stop, chunk_rows):
+            chunk_stop = min(chunk_start + chunk_rows, row_stop)
+            chunk_valid = valid[t, chunk_start:chunk_stop, col_start:col_stop]
+            chunk_valid[...] = True
+            for b, (band, image) in enumerate(zip(bands, images)):
+                dn = image.read_window(chunk_start + row_offset, chunk_stop + row_offset,
+                                       col_start + col_offset, col_stop + col_offset)
+                chunk_valid &= dn != NODATA
+                scene.calibrate(dn, band, product, out=data[t, b, chunk_start:chunk_stop, col_start:col_stop])
+            for b in range(len(bands)):
+                data[t, b, chunk_start:chunk_stop, col_start:col_stop][~chunk_valid] = 0
+
+    data.flush()
+    valid.flush()
+    del data, valid
+
+    # The metadata is written last, a cube without it is incomplete
+    replace(join(directory, CUBE_DATA + '.tmp'), join(directory, CUBE_DATA))
+    replace(join(directory, CUBE_VALID + '.tmp'), join(directory, CUBE_VALID))
+    metadata = {
+        'nw_coords': nw_coords.tolist(),
+        'pixel_size': pixel_size,
+        'bands': bands,
+        'product': product,
+        'scene_ids': [scene.scene_id for scene in scenes],
+        'acquired': [date.isoformat() for date in acquired],
+        'archive_paths': list(archive_paths),
+    }
+    with open(join(directory, CUBE_METADATA + '.tmp'), 'w') as metadata_file:
+        json.dump(metadata, metadata_file, indent=1)
+    replace(join(directory, CUBE_METADATA + '.tmp'), join(directory, CUBE_METADATA))
+
+    return DataCube(directory)
+
+
+def open_cube(directory, archive_paths, nw_coords, se_coords, bands=tuple(range(1, 8)), product='radiance',
+              **kwargs):
+    """
+    Opens the data cube in a directory, building it first if it does not
+    exist or does not hold the given scenes, region, bands and product
+
+    :param directory: cube directory
+    :param archive_paths: list of archive paths
+    :param nw_coords: UTM coordinates (meters) of the north west corner of the cube
+    :param se_coords: UTM coordinates (meters) of the south east corner of the cube
+    :param bands: bands to ingest
+    :param product: radiometric product, 'radiance' or 'reflectance'
+    :return: DataCube object
+    """
+
+    if exists(join(directory, CUBE_METADATA)):
+        cube = DataCube(directory)
+        if sorted(cube.archive_paths) == sorted(archive_paths) and cube.bands == [int(b) for b in bands] and \
+                cube.product == product and \
+                cube.nw_coords.tolist() == asarray(nw_coords, dtype=float).tolist() and \
+                cube.window(nw_coords, se_coords) == (slice(0, cube.shape[2]), slice(0, cube.shape[3])):
+            return cube
+        del cube
+    return build_cube(directory, archive_paths, nw_coords, se_coords, bands=bands, product=product, **kwargs)
+
+
+class DataCube(object):
+
+    def __init__(self, directory, mode='r'):
+        """
+        Open a data cube written by build_cube
+
+        :param directory: cube directory
+        :param mode: memmap mode ('r' for read only, 'r+' to modify)
+        :return: DataCube object
+        """
+
+        self.directory = directory
+        with open(join(directory, CUBE_METADATA)) as metadata_file:
+            metadata = json.load(metadata_file)
+        self.nw_coords = array(metadata['nw_coords'])
+        self.pixel_size = metadata['pixel_size']
+        self.bands = metadata['bands']
+        self.product = metadata.get('product', 'radiance')
+        self.scene_ids = metadata['scene_ids']
+        self.archive_paths = metadata['archive_paths']
+        self.times = array(metadata['acquired'], dtype='datetime64[s]')
+
+        self.data = open_memmap(join(directory, CUBE_DATA), mode=mode)
+        self.valid = open_memmap(join(directory, CUBE_VALID), mode=mode)
+        self.shape = self.data.shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def time_slice(self, start=None, end=None):
+        """
+        :param start: earliest acquisition (datetime or ISO string)
+        :param end: latest acquisition (datetime or ISO string), inclusive
+        :return: slice of the time axis
+        """
+
+        first = 0 if start is None else searchsorted(self.times, datetime64(start, 's'), side='left')
+        last = len(self) if end is None else searchsorted(self.times, datetime64(end, 's'), side='right')
+        return slice(int(first), int(last))
+
+    def band_index(self, bands=None):
+        """
+        Index of the band axis, a slice when the bands are evenly spaced in the
+        cube (so selections stay views) and a list otherwise
+
+        :param bands: list of bands (default: all)
+        :return: slice or list of band positions
+        """
+
+        if bands is None:
+            return slice(0, len(self.bands))
+        positions = [self.bands.index(int(band)) for band in bands]
+        if len(positions) == 1:
+            return slice(positions[0], positions[0] + 1)
+        step = positions[1] - positions[0]
+        if step > 0 and all(b - a == step for a, b in zip(positions[:-1], positions[1:])):
+            return slice(positions[0], positions[-1] + 1, step)
+        return positions
+
+    def window(self, nw_coords=None, se_coords=None):
+        """
+        Pixel window of a UTM box, clipped to the cube
+
+        :param nw_coords: UTM coordinates (meters) of the north west corner (default: cube corner)
+        :param se_coords: UTM coordinates (meters) of the south east corner (default: cube corner)
+        :return: (row slice, col slice)
+        """
+
+        rows, cols = self.shape[2:]
+        row_start, col_start = 0, 0
+        row_stop, col_stop = rows, cols
+        if nw_coords is not None:
+            col_start = int(floor((nw_coords[0] - self.nw_coords[0])/self.pixel_size))
+            row_start = int(floor((self.nw_coords[1] - nw_coords[1])/self.pixel_size))
+        if se_coords is not None:
+            col_stop = int(floor((se_coords[0] - self.nw_coords[0])/self.pixel_size))
+            row_stop = int(floor((self.nw_coords[1] - se_coords[1])/self.pixel_size))
+        return (slice(min(max(row_start, 0), rows), min(max(row_stop, 0), rows)),
+                slice(min(max(col_start, 0), cols), min(max(col_stop, 0), cols)))
+
+    def select(self, start=None, end=None, bands=None, nw_coords=None, se_coords=None):
+        """
+        Selects part of the cube. The result is a view of the memory map (no
+        data is read or copied) unless the bands are not evenly spaced.
+
+        :param start: earliest acquisition (datetime or ISO string)
+        :param end: latest acquisition (datetime or ISO string), inclusive
+        :param bands: list of bands (default: all)
+        :param nw_coords: UTM coordinates (meters) of the north west corner
+        :param se_coords: UTM coordinates (meters) of the south east corner
+        :return: (values (time, band, y, x), validity (time, y, x)) tuple
+        """
+
+        times = self.time_slice(start, end)
+        rows, cols = self.window(nw_coords, se_coords)
+        band_index = self.band_index(bands)
+        if isinstance(band_index, slice):
+            data = self.data[times, band_index, rows, cols]
+        else:
+            data = self.data[times][:, band_index, rows, cols]
+        return data, self.valid[times, rows, cols]
+
+    def frames(self, band, nw_coords=None, se_coords=None, years=None, start=None, end=None):
+        """
+        Iterates over the scenes of one band, in the form the reducers take
+
+        :param band: band of interest
+        :param nw_coords: UTM coordinates (meters) of the north west corner
+        :param se_coords: UTM coordinates (meters) of the south east corner
+        :param years: optional list of acquisition years
+        :param start: earliest acquisition (datetime or ISO string)
+        :param end: latest acquisition (datetime or ISO string), inclusive
+        :return: generator of (values, validity) views
+        """
+
+        data, valid = self.select(start, end, [band], nw_coords, se_coords)
+        times = self.times[self.time_slice(start, end)]
+        if years is not None:
+            keep = isin(times.astype('datetime64[Y]').astype(int) + 1970, [int(year) for year in years])
+        else:
+            keep = [True]*len(times)
+        for t in range(len(times)):
+            if keep[t]:
+                yield data[t, 0], valid[t]
@@ -1,12 +1,25 @@
 """
 Simple calculations for converting latitude and longitude to meters
+
+All the functions accept scalars or numpy arrays of any (broadcastable) shape
 """
 
 # Imports
-from math import pi, cos, sin, pow, tan
+from numpy import pi, cos, sin, sqrt, asarray, where, floor, empty, add, multiply, prod
+from numpy import broadcast_shapes, broadcast_to
 
 R_EARTH = (6.371*10e6)/2.0
 
+# WGS84 ellipsoid and UTM projection constants
+A_WGS84 = 6378137
+E_WGS84 = 0.081819191
+E1SQ_WGS84 = 0.006739497
+K0_UTM = 0.9996
+FALSE_EASTING = 500000.0
+FALSE_NORTHING_SOUTH = 10000000.0
+# Pixels converted at once by utm_to_latlon, small enough for the intermediate values to stay in cache
+BLOCK_PIXELS = 8192
+
 
 def dist_lat(lat_diff):
     """
@@ -16,7 +29,7 @@ def dist_lat(lat_diff):
     :return: distance in meters
     """
 
-    return lat_diff*(pi/180.0)*R_EARTH
+    return asarray(lat_diff)*(pi/180.0)*R_EARTH
 
 
 def dist_lon(lon_diff, lat):
@@ -29,66 +42,203 @@ def dist_lon(lon_diff, lat):
     :return: distance along the longitude distance in meters
     """
 
-    radius = cos(lat*(pi/180.0))*R_EARTH
-    return lon_diff*(pi/180.0)*radius
+    radius = cos(asarray(lat)*(pi/180.0))*R_EARTH
+    return asarray(lon_diff)*(pi/180.0)*radius
+
+
+def _grid_axes(easting, northing):
+    """
+    Finds the axes of a grid of coordinates, whose northings are constant
+    along the rows and eastings constant along the columns
+
+    :param easting: array of eastings
+    :param northing: array of northings
+    :return: (easting row vector, northing column vector), or (None, None) if the
+             coordinates are not such a grid
+    """
+
+    if easting.ndim != 2 or easting.shape != northing.shape or easting.shape[1] < 2:
+        return None, None
+    if (northing[:, 1:] == northing[:, :1]).all() and (easting[1:] == easting[:1]).all():
+        return easting[:1], northing[:, :1]
+    return None, None
 
 
 def utm_to_latlon(zone, easting, northing, n_hemisphere=True):
     """
-    Converts UTM coordinates (meters) to latitude and longitude
+    Converts UTM coordinates (meters) to latitude and longitude. The terms
+    that only depend on the northing are computed once per row when the
+    coordinates are a grid, given either as a row and a column vector or as
+    full arrays with constant rows and columns (e.g. from meshgrid).
 
     :param zone: UTM zone
     :param easting: UTM easting parameter
     :param northing: UTM northing parameter
-    :param n_hemisphere:
+    :param n_hemisphere: true for coordinates in the northern hemisphere
     :return: decimal (latitude, longitude)
     """
-    if not n_hemisphere:
-        northing = 10000000 - northing
 
-    a = 6378137
-    e = 0.081819191
-    e1sq = 0.006739497
-    k0 = 0.9996
+    zone = asarray(zone)
+    easting = asarray(easting, dtype=float)
+    northing = asarray(northing, dtype=float)
+    n_hemisphere = asarray(n_hemisphere, dtype=bool)
+    shape = broadcast_shapes(zone.shape, easting.shape, northing.shape, n_hemisphere.shape)
+    if zone.size == 1 and n_hemisphere.size == 1:
+        easting_axis, northing_axis = _grid_axes(easting, northing)
+        if easting_axis is not None:
+            easting, northing = easting_axis, northing_axis
+    northing = where(n_hemisphere, northing, FALSE_NORTHING_SOUTH - northing)
+
+    a = A_WGS84
+    e = E_WGS84
+    e1sq = E1SQ_WGS84
+    k0 = K0_UTM
 
     arc = northing / k0
-    mu = arc / (a * (1 - pow(e, 2) / 4.0 - 3 * pow(e, 4) / 64.0 - 5 * pow(e, 6) / 256.0))
-
-    ei = (1 - pow((1 - e * e), (1 / 2.0))) / (1 + pow((1 - e * e), (1 / 2.0)))
-
-    ca = 3 * ei / 2 - 27 * pow(ei, 3) / 32.0
-
-    cb = 21 * pow(ei, 2) / 16 - 55 * pow(ei, 4) / 32
-    cc = 151 * pow(ei, 3) / 96
-    cd = 1097 * pow(ei, 4) / 512
-    phi1 = mu + ca * sin(2 * mu) + cb * sin(4 * mu) + cc * sin(6 * mu) + cd * sin(8 * mu)
-
-    n0 = a / pow((1 - pow((e * sin(phi1)), 2)), (1 / 2.0))
-
-    r0 = a * (1 - e * e) / pow((1 - pow((e * sin(phi1)), 2)), (3 / 2.0))
-    fact1 = n0 * tan(phi1) / r0
-
-    _a1 = 500000 - easting
-    dd0 = _a1 / (n0 * k0)
-    fact2 = dd0 * dd0 / 2
-
-    t0 = pow(tan(phi1), 2)
-    Q0 = e1sq * pow(cos(phi1), 2)
-    fact3 = (5 + 3 * t0 + 10 * Q0 - 4 * Q0 * Q0 - 9 * e1sq) * pow(dd0, 4) / 24
-
-    fact4 = (61 + 90 * t0 + 298 * Q0 + 45 * t0 * t0 - 252 * e1sq - 3 * Q0 * Q0) * pow(dd0, 6) / 720
-
-    lof1 = _a1 / (n0 * k0)
-    lof2 = (1 + 2 * t0 + Q0) * pow(dd0, 3) / 6.0
-    lof3 = (5 - 2 * Q0 + 28 * t0 - 3 * pow(Q0, 2) + 8 * e1sq + 24 * pow(t0, 2)) * pow(dd0, 5) / 120
-    _a2 = (lof1 - lof2 + lof3) / cos(phi1)
-    _a3 = _a2 * 180 / pi
-
-    latitude = 180 * (phi1 - fact1 * (fact2 + fact3 + fact4)) / pi
-
-    if not n_hemisphere:
-        latitude = -latitude
+    mu = arc / (a * (1 - e**2 / 4.0 - 3 * e**4 / 64.0 - 5 * e**6 / 256.0))
+
+    ei = (1 - (1 - e * e)**(1 / 2.0)) / (1 + (1 - e * e)**(1 / 2.0))
+
+    ca = 3 * ei / 2 - 27 * ei**3 / 32.0
+
+    cb = 21 * ei**2 / 16 - 55 * ei**4 / 32
+    cc = 151 * ei**3 / 96
+    cd = 1097 * ei**4 / 512
+    # sin(4mu), sin(6mu) and sin(8mu) from the multiple angle identities
+    sin_2mu = sin(2 * mu)
+    cos_2mu = cos(2 * mu)
+    sin_4mu = 2 * sin_2mu * cos_2mu
+    cos_4mu = 1 - 2 * sin_2mu * sin_2mu
+    sin_6mu = sin_2mu * cos_4mu + cos_2mu * sin_4mu
+    sin_8mu = 2 * sin_4mu * cos_4mu
+    phi1 = mu + ca * sin_2mu + cb * sin_4mu + cc * sin_6mu + cd * sin_8mu
+
+    # Trigonometric terms are computed once and reused
+    sin_phi1 = sin(phi1)
+    cos_phi1 = cos(phi1)
+    tan_phi1 = sin_phi1 / cos_phi1
+    es2 = 1 - (e * sin_phi1)**2
+
+    n0 = a / sqrt(es2)
+
+    r0 = a * (1 - e * e) / (es2 * sqrt(es2))
+    fact1 = n0 * tan_phi1 / r0
+
+    t0 = tan_phi1 * tan_phi1
+    Q0 = e1sq * cos_phi1 * cos_phi1
+
+    # Series coefficients, these only depend on the northing so for a grid
+    # given as a row and a column vector they are only computed once per row
+    sign = where(n_hemisphere, 180 / pi, -180 / pi)
+    lat_k = sign * fact1
+    lat_c3 = (5 + 3 * t0 + 10 * Q0 - 4 * Q0 * Q0 - 9 * e1sq) / 24
+    lat_c4 = (61 + 90 * t0 + 298 * Q0 + 45 * t0 * t0 - 252 * e1sq - 3 * Q0 * Q0) / 720
+    lon_k = (180 / pi) / cos_phi1
+    lon_c2 = -(1 + 2 * t0 + Q0) / 6.0
+    lon_c3 = (5 - 2 * Q0 + 28 * t0 - 3 * Q0 * Q0 + 8 * e1sq + 24 * t0 * t0) / 120
+
+    # With dd0 = (FALSE_EASTING - easting)/(n0 k0) the series of the latitude
+    #   phi1 - fact1 (dd0^2/2 + lat_c3 dd0^4 + lat_c4 dd0^6)
+    # and of the longitude offset
+    #   (dd0 + lon_c2 dd0^3 + lon_c3 dd0^5) / cos(phi1)
+    # are polynomials in the squared easting offset w = (FALSE_EASTING - easting)^2
+    # whose coefficients only depend on the northing, so only the polynomials
+    # are evaluated per pixel (Horner's rule)
+    offset = FALSE_EASTING - easting
+    scale = 1 / (n0 * k0)
+    scale_2 = scale * scale
+    lat_1 = -0.5 * lat_k * scale_2
+    lat_2 = -lat_k * lat_c3 * scale_2 * scale_2
+    lat_3 = -lat_k * lat_c4 * scale_2 * scale_2 * scale_2
+    lon_1 = -lon_k * scale
+    lon_2 = lon_1 * lon_c2 * scale_2
+    lon_3 = lon_1 * lon_c3 * scale_2 * scale_2
+    terms = [broadcast_to(term, shape) for term in (
+        offset, offset * offset, sign * phi1, lat_1, lat_2, lat_3, where(zone > 0, 6 * zone - 183.0, 3.0),
+        lon_1, lon_2, lon_3
+    )]
+
+    # The polynomials are evaluated in place in the outputs, a block of rows at
+    # a time so the intermediate values stay in the processor cache
+    latitude = empty(shape)
+    longitude = empty(shape)
+    if shape:
+        step = max(BLOCK_PIXELS // max(int(prod(shape[1:])), 1), 1)
+        blocks = [slice(start, start + step) for start in range(0, shape[0], step)]
+    else:
+        blocks = [Ellipsis]
+    for block in blocks:
+        offset, w, lat_0, lat_1, lat_2, lat_3, lon_0, lon_1, lon_2, lon_3 = [term[block] for term in terms]
+        lat, lon = latitude[block], longitude[block]
+
+        # latitude = lat_0 + w (lat_1 + w (lat_2 + w lat_3))
+        multiply(lat_3, w, out=lat)
+        add(lat, lat_2, out=lat)
+        multiply(lat, w, out=lat)
+        add(lat, lat_1, out=lat)
+        multiply(lat, w, out=lat)
+        add(lat, lat_0, out=lat)
+
+        # longitude = central meridian + offset (lon_1 + w (lon_2 + w lon_3))
+        multiply(lon_3, w, out=lon)
+        add(lon, lon_2, out=lon)
+        multiply(lon, w, out=lon)
+        add(lon, lon_1, out=lon)
+        multiply(lon, offset, out=lon)
+        add(lon, lon_0, out=lon)
+
+    return latitude[()], longitude[()]
+
+
+def latlon_to_utm(latitude, longitude, zone=None):
+    """
+    Converts latitude and longitude to UTM coordinates (meters), the inverse
+    of utm_to_latlon
 
-    longitude = ((zone > 0) and (6 * zone - 183.0) or 3.0) - _a3
+    :param latitude: decimal latitude
+    :param longitude: decimal longitude
+    :param zone: UTM zone to project into (default: the zone containing each point)
+    :return: (zone, easting, northing, n_hemisphere)
+    """
 
-    return latitude, longitude
\ No newline at end of file
+    latitude = asarray(latitude, dtype=float)
+    longitude = asarray(longitude, dtype=float)
+    if zone is None:
+        zone = floor((longitude + 180.0) / 6.0) % 60 + 1
+    zone = asarray(zone).astype(int)
+
+    e2 = E_WGS84 * E_WGS84
+    e4 = e2 * e2
+    e6 = e4 * e2
+    ep2 = E1SQ_WGS84
+    k0 = K0_UTM
+
+    phi = latitude * (pi / 180.0)
+    sin_phi = sin(phi)
+    cos_phi = cos(phi)
+    tan_phi = sin_phi / cos_phi
+
+    n = A_WGS84 / sqrt(1 - e2 * sin_phi * sin_phi)
+    t = tan_phi * tan_phi
+    c = ep2 * cos_phi * cos_phi
+    a = cos_phi * (longitude - (6 * zone - 183.0)) * (pi / 180.0)
+    a2 = a * a
+    a4 = a2 * a2
+
+    # Meridional arc length
+    m = A_WGS84 * ((1 - e2 / 4 - 3 * e4 / 64 - 5 * e6 / 256) * phi
+                   - (3 * e2 / 8 + 3 * e4 / 32 + 45 * e6 / 1024) * sin(2 * phi)
+                   + (15 * e4 / 256 + 45 * e6 / 1024) * sin(4 * phi)
+                   - (35 * e6 / 3072) * sin(6 * phi))
+
+    easting = FALSE_EASTING + k0 * n * a * (
+        1 + (1 - t + c) * a2 / 6 + (5 - 18 * t + t * t + 72 * c - 58 * ep2) * a4 / 120
+    )
+    northing = k0 * (m + n * tan_phi * a2 * (
+        0.5 + (5 - t + 9 * c + 4 * c * c) * a2 / 24 + (61 - 58 * t + t * t + 600 * c - 330 * ep2) * a4 / 720
+    ))
+
+    n_hemisphere = latitude >= 0
+    northing = where(n_hemisphere, northing, northing + FALSE_NORTHING_SOUTH)
+
+    return zone[()], easting[()], northing[()], n_hemisphere[()]
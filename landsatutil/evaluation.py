@@ -0,0 +1,162 @@
+"""
+Monte Carlo cross validation of classifiers, with the splits generated up
+front and the trials run over a process pool
+"""
+
+# Imports
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from numpy import asarray, unique, searchsorted, bincount, zeros, sort, mean, var, int64
+from numpy.random import SeedSequence, default_rng
+
+# Data shared by the trials of a worker process, set once by the pool initializer
+_worker_data = {}
+
+
+def random_splits(num_samples, train_fraction=0.8, num_trials=100, seed=0):
+    """
+    Draws random train / test splits
+
+    :param num_samples: number of samples in the data set
+    :param train_fraction: fraction of the samples used for training
+    :param num_trials: number of splits
+    :param seed: seed of the whole set of splits, each trial gets its own seed spawned from it
+    :return: list of (trial seed, sorted training indices, sorted test indices) tuples
+    """
+
+    num_train = int(num_samples * train_fraction)
+    splits = []
+    for trial_seed in SeedSequence(seed).spawn(num_trials):
+        order = default_rng(trial_seed).permutation(num_samples)
+        seed_value = int(trial_seed.generate_state(1)[0])
+        splits.append((seed_value, sort(order[:num_train]), sort(order[num_train:])))
+    return splits
+
+
+def confusion_matrix(truth, predicted, classes):
+    """
+    Counts the predictions of each class for each true class
+
+    :param truth: array of true outcomes
+    :param predicted: array of predicted outcomes
+    :param classes: sorted array of all the classes
+    :return: (classes x classes) array, rows are true and columns predicted classes
+    """
+
+    num_classes = len(classes)
+    truth_index = searchsorted(classes, truth)
+    predicted_index = searchsorted(classes, predicted)
+    counts = bincount(truth_index*num_classes + predicted_index, minlength=num_classes*num_classes)
+    return counts.reshape(num_classes, num_classes)
+
+
+def _init_worker(data, outcomes, classes):
+    _worker_data['data'] = data
+    _worker_data['outcomes'] = outcomes
+    _worker_data['classes'] = classes
+
+
+def _run_trial(task):
+    """
+    Fits and tests a model on one split (run in worker processes)
+
+    :param task: (model class, model parameters, trial seed, training indices, test indices) tuple
+    :return: (accuracy, confusion matrix, fit time, predict time) tuple
+    """
+
+    model_class, model_params, seed, training_indices, test_indices = task
+    data = _worker_data['data']
+    outcomes = _worker_data['outcomes']
+
+    model = model_class(**model_params)
+    if 'random_state' in model.get_params() and 'random_state' not in model_params:
+        model.set_params(random_state=seed)
+
+    start = perf_counter()
+    model.fit(data[training_indices], outcomes[training_indices])
+    fit_time = perf_counter() - start
+    start = perf_counter()
+    predicted = model.predict(data[test_indices])
+    predict_time = perf_counter() - start
+
+    truth = outcomes[test_indices]
+    accuracy = (predicted == truth).sum() / test_indices.size
+    return accuracy, confusion_matrix(truth, predicted, _worker_data['classes']), fit_time, predict_time
+
+
+def evaluate(model_class, data, outcomes, model_params=None, num_trials=100, train_fraction=0.8, seed=0,
+             workers=1, splits=None):
+    """
+    Estimates how well a classifier predicts the outcomes by fitting it to
+    many random training sets and testing it on the rest of the data. The
+    result only depends on the seed, not on the number of workers.
+
+    :param model_class: classifier class, or function returning a classifier (e.g.
+                        classification.crop_estimator), with the scikit-learn fit / predict
+                        interface, it must be picklable when workers > 1
+    :param data: (samples x variables) array of explanatory variables
+    :param outcomes: array of outcomes
+    :param model_params: dictionary of parameters the model is created with
+    :param num_trials: number of trials
+    :param train_fraction: fraction of the samples used for training
+    :param seed: seed of the random splits
+    :param workers: number of worker processes
+    :param splits: optional list of splits from random_splits (num_trials, train_fraction
+                   and seed are then not used)
+    :return: dictionary with the per trial 'accuracy', 'fit_time' and 'predict_time'
+             arrays, the 'mean' and 'var' of the accuracy, the 'classes' and the
+             'confusion' matrix summed over the trials
+    """
+
+    data = asarray(data)
+    outcomes = asarray(outcomes)
+    classes = unique(outcomes)
+    model_params = {} if model_params is None else dict(model_params)
+    if splits is None:
+        splits = random_splits(outcomes.size, train_fraction, num_trials, seed)
+    tasks = [(model_class, model_params, trial_seed, training, test) for trial_seed, training, test in splits]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(data, outcomes, classes)) as executor:
+            trials = list(executor.map(_run_trial, tasks, chunksize=max(len(tasks)//(4*workers), 1)))
+    else:
+        _init_worker(data, outcomes, classes)
+        trials = [_run_trial(task) for task in tasks]
+        _worker_data.clear()
+
+    accuracy = asarray([trial[0] for trial in trials])
+    confusion = zeros((classes.size, classes.size), dtype=int64)
+    for trial in trials:
+        confusion += trial[1]
+
+    return {
+        'accuracy': accuracy,
+        'mean': mean(accuracy),
+        'var': var(accuracy),
+        'classes': classes,
+        'confusion': confusion,
+        'fit_time': asarray([trial[2] for trial in trials]),
+        'predict_time': asarray([trial[3] for trial in trials]),
+        'seeds': [trial_seed for trial_seed, _, _ in splits],
+    }
+
+
+def sweep(model_class, data, outcomes, param_list, **kwargs):
+    """
+    Evaluates a classifier for each of a list of parameter settings on the
+    same splits
+
+    :param model_class: classifier class or function (see evaluate)
+    :param data: (samples x variables) array of explanatory variables
+    :param outcomes: array of outcomes
+    :param param_list: list of model parameter dictionaries (e.g. [{'C': 1}, {'C': 10}])
+    :param kwargs: other arguments of evaluate
+    :return: list of (parameters, evaluate result) tuples
+    """
+
+    outcomes = asarray(outcomes)
+    if kwargs.get('splits') is None:
+        kwargs['splits'] = random_splits(outcomes.size, kwargs.pop('train_fraction', 0.8),
+                                         kwargs.pop('num_trials', 100), kwargs.pop('seed', 0))
+    return [(params, evaluate(model_class, data, outcomes, model_params=params, **kwargs)) for params in param_list]
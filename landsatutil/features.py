@@ -0,0 +1,220 @@
+"""
+Columnar on-disk store of per field, per scene features. Rows are appended
+in batches, every batch is a directory of one .npy file per column that is
+committed atomically, so an interrupted run keeps every finished batch and
+can be resumed.
+"""
+
+# Imports
+import json
+from os import listdir, makedirs, replace
+from os.path import join, exists
+from shutil import rmtree
+from numpy import asarray, concatenate, argsort, empty, dtype as np_dtype, save, load, isin
+
+# Constants
+SCHEMA_FILE = 'schema.json'
+PARTS_DIR = 'parts'
+COMPACTED_MARKER = 'compacted'
+KEY_COLUMNS = ('label', 'scene_id')
+
+
+class FeatureStore(object):
+
+    def __init__(self, directory, key=KEY_COLUMNS):
+        """
+        Open (or create) a feature store
+
+        :param directory: store directory
+        :param key: names of the columns identifying a row (a field and a scene)
+        :return: FeatureStore object
+        """
+
+        self.directory = directory
+        self.parts_dir = join(directory, PARTS_DIR)
+        makedirs(self.parts_dir, exist_ok=True)
+
+        schema_path = join(directory, SCHEMA_FILE)
+        if exists(schema_path):
+            with open(schema_path) as schema_file:
+                schema = json.load(schema_file)
+            self.columns = [(name, np_dtype(type_str)) for name, type_str in schema['columns']]
+            self.key = tuple(schema['key'])
+        else:
+            self.columns = None
+            self.key = tuple(key)
+
+        # Keys of the rows already stored
+        self._done = set()
+        if self.columns is not None:
+            keys = self.read(self.key)
+            self._done.update(zip(*[keys[name].tolist() for name in self.key]))
+
+    def _parts(self):
+        """
+        :return: sorted list of the committed part directories, starting at the
+                 latest compacted part (which holds the rows of all earlier parts)
+        """
+
+        parts = sorted(name for name in listdir(self.parts_dir) if not name.endswith('.tmp'))
+        for n in range(len(parts) - 1, 0, -1):
+            if exists(join(self.parts_dir, parts[n], COMPACTED_MARKER)):
+                return parts[n:]
+        return parts
+
+    def _write_schema(self, columns):
+        self.columns = [(name, np_dtype(column_type)) for name, column_type in columns]
+        schema = {'columns': [(name, column_type.str) for name, column_type in self.columns], 'key': self.key}
+        with open(join(self.directory, SCHEMA_FILE + '.tmp'), 'w') as schema_file:
+            json.dump(schema, schema_file, indent=1)
+        replace(join(self.directory, SCHEMA_FILE + '.tmp'), join(self.directory, SCHEMA_FILE))
+
+    def __len__(self):
+        return len(self._done)
+
+    @property
+    def column_names(self):
+        return [name for name, _ in self.columns] if self.columns is not None else []
+
+    def is_done(self, *key):
+        """
+        :return: true if a row with the given key (e.g. label, scene_id) is stored
+        """
+
+        return tuple(key) in self._done
+
+    def missing(self, labels, scene_id):
+        """
+        Labels that have no row for a scene yet
+
+        :param labels: array of labels
+        :param scene_id: scene id
+        :return: array of the labels still to be computed, in the given order
+        """
+
+        labels = asarray(labels)
+        done = [label for label in labels.tolist() if (label, scene_id) in self._done]
+        return labels[~isin(labels, done)]
+
+    def append(self, columns):
+        """
+        Appends a batch of rows. The first batch fixes the columns and their
+        types, later batches are converted to them. Rows whose key is already
+        stored are dropped.
+
+        :param columns: dictionary of column name -> 1D array, all of one length
+        :return: number of rows written
+        """
+
+        if self.columns is None:
+            missing_keys = [name for name in self.key if name not in columns]
+            if missing_keys:
+                raise ValueError('Feature batch has no key column {0}'.format(missing_keys[0]))
+            self._write_schema([(name, asarray(value).dtype) for name, value in columns.items()])
+
+        batch = {}
+        for name, column_type in self.columns:
+            if name not in columns:
+                raise ValueError('Feature batch has no column {0}'.format(name))
+            batch[name] = asarray(columns[name]).astype(column_type, copy=False)
+        lengths = set(value.shape[0] for value in batch.values())
+        if len(lengths) != 1:
+            raise ValueError('Feature batch columns have different lengths')
+
+        # Leave out the rows that are already stored
+        keys = list(zip(*[batch[name].tolist() for name in self.key]))
+        new = asarray([key not in self._done for key in keys], dtype=bool)
+        if not new.all():
+            batch = dict((name, value[new]) for name, value in batch.items())
+            keys = [key for key, is_new in zip(keys, new) if is_new]
+        if not keys:
+            return 0
+
+        # Write the columns to a temporary directory and commit it with a rename
+        parts = self._parts()
+        part_name = 'part_{0:06d}'.format(int(parts[-1].split('_')[1]) + 1 if parts else 0)
+        tmp_dir = join(self.parts_dir, part_name + '.tmp')
+        if exists(tmp_dir):
+            rmtree(tmp_dir)
+        makedirs(tmp_dir)
+        for name, value in batch.items():
+            save(join(tmp_dir, name + '.npy'), value)
+        replace(tmp_dir, join(self.parts_dir, part_name))
+
+        self._done.update(keys)
+        return len(keys)
+
+    def read(self, columns=None):
+        """
+        Reads columns of every stored row. The columns are memory mapped, a
+        store with a single part (see compact) is read without copying.
+
+        :param columns: list of column names (default: all)
+        :return: dictionary of column name -> 1D array
+        """
+
+        if self.columns is None:
+            return {}
+        column_types = dict(self.columns)
+        columns = self.column_names if columns is None else list(columns)
+
+        parts = self._parts()
+        result = {}
+        for name in columns:
+            chunks = [load(join(self.parts_dir, part, name + '.npy'), mmap_mode='r') for part in parts]
+            if len(chunks) == 1:
+                result[name] = chunks[0]
+            elif chunks:
+                result[name] = concatenate(chunks)
+            else:
+                result[name] = empty(0, dtype=column_types[name])
+        return result
+
+    def compact(self):
+        """
+        Merges all the parts into one, so later reads are memory mapped views
+        """
+
+        parts = self._parts()
+        if len(parts) <= 1:
+            return
+
+        # The merged part is marked as compacted and committed before the old
+        # parts are removed, parts before it are ignored if a crash leaves them
+        columns = self.read()
+        part_name = 'part_{0:06d}'.format(int(parts[-1].split('_')[1]) + 1)
+        tmp_dir = join(self.parts_dir, part_name + '.tmp')
+        if exists(tmp_dir):
+            rmtree(tmp_dir)
+        makedirs(tmp_dir)
+        for name, value in columns.items():
+            save(join(tmp_dir, name + '.npy'), value)
+        open(join(tmp_dir, COMPACTED_MARKER), 'w').close()
+        del columns
+        replace(tmp_dir, join(self.parts_dir, part_name))
+        for part in parts:
+            rmtree(join(self.parts_dir, part))
+
+    def to_frame(self, columns=None):
+        """
+        :param columns: list of column names (default: all)
+        :return: pandas DataFrame of the stored rows
+        """
+
+        from pandas import DataFrame
+        data = self.read(columns)
+        return DataFrame(dict((name, asarray(value)) for name, value in data.items()), columns=list(data.keys()))
+
+    def to_csv(self, path, columns=None, sort_by=None):
+        """
+        Writes the stored rows to a csv file
+
+        :param path: output file path
+        :param columns: list of column names (default: all)
+        :param sort_by: optional column to (stably) sort the rows by
+        """
+
+        frame = self.to_frame(columns)
+        if sort_by is not None:
+            frame = frame.iloc[argsort(asarray(self.read([sort_by])[sort_by]), kind='stable')]
+        frame.to_csv(path, index=False)
@@ -0,0 +1,397 @@
+"""
+Registry of the fields of a field mask: one record per field (label, area,
+centroid and bounding box in pixel and UTM coordinates) in a numpy
+structured array, the exact footprints of the fields as row runs, and a grid
+index for point, box and nearest field queries
+"""
+
+# Imports
+from os import replace
+from numpy import asarray, array, arange, argsort, bincount, concatenate, cumsum, flatnonzero, floor, full
+from numpy import load, median, minimum, maximum, nonzero, repeat, savez, searchsorted, unique, zeros, lexsort
+from numpy import where, int32, int64, float64, ceil, inf, ones, bool_
+from pandas import DataFrame
+
+# Constants
+REGISTRY_VERSION = 2
+FIELD_DTYPE = [
+    ('label', int64),
+    ('area', int64),
+    # Pixel coordinates, the south east corner is one past the last row and column (as bbox of regionprops)
+    ('center_row', float64),
+    ('center_col', float64),
+    ('nw_row', int32),
+    ('nw_col', int32),
+    ('se_row', int32),
+    ('se_col', int32),
+    # UTM coordinates (meters), of the pixel centers for the centroid and the pixel edges for the box
+    ('center_x', float64),
+    ('center_y', float64),
+    ('nw_x', float64),
+    ('nw_y', float64),
+    ('se_x', float64),
+    ('se_y', float64),
+]
+MIN_CELL_SIZE = 16
+DEFAULT_CHUNK_ROWS = 1024
+
+
+def field_records(field_mask, nw_corner, pixel_size=30.0):
+    """
+    Measures every field of a label image in one pass over the pixels (no loop
+    over the fields)
+
+    :param field_mask: 2D integer label image, zero is background
+    :param nw_corner: UTM coordinates (meters) of the north west corner of the image
+    :param pixel_size: pixel edge length (meters)
+    :return: structured array of FIELD_DTYPE sorted by label
+    """
+
+    # Labelled pixels in raster order, grouped by label (stable, so rows stay sorted)
+    flat_index = flatnonzero(field_mask)
+    pixel_labels = asarray(field_mask).ravel()[flat_index].astype(int64)
+    order = argsort(pixel_labels, kind='stable')
+    pixel_labels = pixel_labels[order]
+    rows, cols = divmod(flat_index[order], field_mask.shape[1])
+    labels, starts, area = unique(pixel_labels, return_index=True, return_counts=True)
+
+    fields = zeros(labels.size, dtype=FIELD_DTYPE)
+    fields['label'] = labels
+    fields['area'] = area
+    if labels.size == 0:
+        return fields
+    fields['center_row'] = bincount(pixel_labels, weights=rows)[labels]/area
+    fields['center_col'] = bincount(pixel_labels, weights=cols)[labels]/area
+    fields['nw_row'] = rows[starts]
+    fields['se_row'] = rows[starts + area - 1] + 1
+    fields['nw_col'] = minimum.reduceat(cols, starts)
+    fields['se_col'] = maximum.reduceat(cols, starts) + 1
+
+    # UTM coordinates
+    fields['center_x'] = nw_corner[0] + (fields['center_col'] + 0.5)*pixel_size
+    fields['center_y'] = nw_corner[1] - (fields['center_row'] + 0.5)*pixel_size
+    fields['nw_x'] = nw_corner[0] + fields['nw_col']*pixel_size
+    fields['nw_y'] = nw_corner[1] - fields['nw_row']*pixel_size
+    fields['se_x'] = nw_corner[0] + fields['se_col']*pixel_size
+    fields['se_y'] = nw_corner[1] - fields['se_row']*pixel_size
+    return fields
+
+
+def field_runs(field_mask, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Run length encodes the fields of a label image along the rows, a chunk of
+    rows at a time (so the image may be memory mapped)
+
+    :param field_mask: 2D integer label image, zero is background
+    :param chunk_rows: number of rows read at once
+    :return: (start, stop, label) int64 arrays, the flat pixel index of the first pixel
+             and one past the last pixel of every run of a field, in raster order
+    """
+
+    cols = field_mask.shape[1]
+    starts, stops, labels = [], [], []
+    for first in range(0, field_mask.shape[0], chunk_rows):
+        block = asarray(field_mask[first:first + chunk_rows], dtype=int64)
+
+        # Runs start at the start of a row and where the label changes, and
+        # stop where the next run of the row starts
+        change = ones(block.shape, dtype=bool_)
+        change[:, 1:] = block[:, 1:] != block[:, :-1]
+        run_rows, run_cols = nonzero(change)
+        run_stops = full(run_cols.size, cols, dtype=int64)
+        same_row = flatnonzero(run_rows[1:] == run_rows[:-1])
+        run_stops[same_row] = run_cols[same_row + 1]
+
+        # Background runs are left out
+        run_labels = block[run_rows, run_cols]
+        field = run_labels != 0
+        row_offset = (run_rows[field] + first).astype(int64)*cols
+        starts.append(row_offset + run_cols[field])
+        stops.append(row_offset + run_stops[field])
+        labels.append(run_labels[field])
+
+    if not labels:
+        return zeros(0, dtype=int64), zeros(0, dtype=int64), zeros(0, dtype=int64)
+    return concatenate(starts), concatenate(stops), concatenate(labels)
+
+
+class FieldRegistry(object):
+
+    def __init__(self, fields, nw_corner, pixel_size=30.0, shape=None, field_mask=None, cell_size=None,
+                 runs=None):
+        """
+        Create a registry of fields
+
+        :param fields: structured array of FIELD_DTYPE (e.g. from field_records)
+        :param nw_corner: UTM coordinates (meters) of the north west corner of the field mask
+        :param pixel_size: pixel edge length (meters)
+        :param shape: (rows, cols) of the field mask
+        :param field_mask: optional label image (e.g. memory mapped), point queries look
+                           the labels up in it
+        :param cell_size: edge length of the index grid cells in pixels (default: twice
+                          the median field box size)
+        :param runs: optional footprints of the fields from field_runs, point queries
+                     search them when there is no field mask. With neither, point
+                     queries only test the field boxes.
+        :return: FieldRegistry object
+        """
+
+        self.fields = fields[argsort(fields['label'], kind='stable')]
+        self.nw_corner = array(nw_corner, dtype=float64)
+        self.pixel_size = float(pixel_size)
+        if shape is None:
+            shape = (int(self.fields['se_row'].max(initial=0)), int(self.fields['se_col'].max(initial=0)))
+        self.shape = tuple(int(x) for x in shape)
+        self.field_mask = field_mask
+        self.runs = runs
+        if cell_size is None and len(self.fields):
+            extent = maximum(self.fields['se_row'] - self.fields['nw_row'],
+                             self.fields['se_col'] - self.fields['nw_col'])
+            cell_size = 2*int(ceil(median(extent)))
+        self.cell_size = max(int(cell_size or 0), MIN_CELL_SIZE)
+        self._build_index()
+        self._tree = None
+
+    @property
+    def labels(self):
+        return self.fields['label']
+
+    def __len__(self):
+        return len(self.fields)
+
+    def _build_index(self):
+        """
+        Builds the grid index, a compressed list of the fields whose boxes
+        overlap each cell
+        """
+
+        fields = self.fields
+        self.grid_shape = (max(-(-self.shape[0] // self.cell_size), 1),
+                           max(-(-self.shape[1] // self.cell_size), 1))
+
+        # Cells spanned by the box of every field
+        first_row = fields['nw_row'] // self.cell_size
+        first_col = fields['nw_col'] // self.cell_size
+        num_rows = (fields['se_row'] - 1) // self.cell_size - first_row + 1
+        num_cols = (fields['se_col'] - 1) // self.cell_size - first_col + 1
+        counts = (num_rows*num_cols).astype(int64)
+
+        # One entry per (field, cell), numbered within each field
+        entry_field = repeat(arange(len(fields)), counts)
+        within = arange(counts.sum()) - repeat(cumsum(counts) - counts, counts)
+        cell_row = first_row[entry_field] + within // num_cols[entry_field]
+        cell_col = first_col[entry_field] + within % num_cols[entry_field]
+        cells = cell_row.astype(int64)*self.grid_shape[1] + cell_col
+
+        order = argsort(cells, kind='stable')
+        self._cell_fields = entry_field[order]
+        cell_counts = bincount(cells, minlength=self.grid_shape[0]*self.grid_shape[1])
+        self._cell_start = concatenate([[0], cumsum(cell_counts)])
+
+    def _candidates(self, cells):
+        """
+        :param cells: array of flat cell indices
+        :return: (position in cells, field index) arrays of the fields indexed in each cell
+        """
+
+        starts = self._cell_start[cells]
+        counts = self._cell_start[cells + 1] - starts
+        query = repeat(arange(cells.size), counts)
+        offsets = arange(counts.sum()) - repeat(cumsum(counts) - counts, counts)
+        return query, self._cell_fields[repeat(starts, counts) + offsets]
+
+    def to_pixel(self, x, y):
+        """
+        :param x: UTM easting(s) (meters)
+        :param y: UTM northing(s) (meters)
+        :return: (row, col) integer arrays of the pixels holding the points
+        """
+
+        x, y = asarray(x, dtype=float64), asarray(y, dtype=float64)
+        return (floor((self.nw_corner[1] - y)/self.pixel_size).astype(int64),
+                floor((x - self.nw_corner[0])/self.pixel_size).astype(int64))
+
+    def index(self, labels):
+        """
+        :param labels: field label(s)
+        :return: positions of the fields in the registry, -1 for unknown labels
+        """
+
+        labels = asarray(labels, dtype=int64)
+        if len(self.fields) == 0:
+            return full(labels.shape, -1, dtype=int64)
+        position = minimum(searchsorted(self.fields['label'], labels), len(self.fields) - 1)
+        return where(self.fields['label'][position] == labels, position, -1)
+
+    def get(self, labels):
+        """
+        :param labels: field labels
+        :return: records of the fields (structured array), KeyError for unknown labels
+        """
+
+        position = self.index(labels)
+        if (position < 0).any():
+            raise KeyError('Unknown field labels {0}'.format(asarray(labels)[position < 0][:10]))
+        return self.fields[position]
+
+    def field_at(self, x, y):
+        """
+        Point in field query for any number of points
+
+        :param x: UTM easting(s) (meters)
+        :param y: UTM northing(s) (meters)
+        :return: labels of the fields holding the points, 0 where there is none. Without a
+                 field mask or the field runs a point within several field boxes takes
+                 the field with the closest centroid.
+        """
+
+        rows, cols = self.to_pixel(x, y)
+        shape = rows.shape
+        rows, cols = rows.ravel(), cols.ravel()
+        result = zeros(rows.size, dtype=int64)
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+
+        if self.field_mask is not None:
+            result[inside] = self.field_mask[rows[inside], cols[inside]]
+            return result.reshape(shape)
+
+        if self.runs is not None:
+            # The last run starting at or before each point holds it if it
+            # has not stopped yet (runs of different fields never overlap)
+            run_start, run_stop, run_label = self.runs
+            points = flatnonzero(inside)
+            flat_index = rows[points]*self.shape[1] + cols[points]
+            run = searchsorted(run_start, flat_index, side='right') - 1
+            hit = run >= 0
+            hit[hit] = flat_index[hit] < run_stop[run[hit]]
+            result[points[hit]] = run_label[run[hit]]
+            return result.reshape(shape)
+
+        # Fields indexed in the cell of every point whose box holds the point
+        points = flatnonzero(inside)
+        cells = (rows[points] // self.cell_size)*self.grid_shape[1] + cols[points] // self.cell_size
+        query, candidate = self._candidates(cells)
+        point_rows, point_cols = rows[points][query], cols[points][query]
+        fields = self.fields[candidate]
+        hit = ((point_rows >= fields['nw_row']) & (point_rows < fields['se_row']) &
+               (point_cols >= fields['nw_col']) & (point_cols < fields['se_col']))
+        query, fields = query[hit], fields[hit]
+
+        # Closest centroid first for every point
+        distance = (point_rows[hit] - fields['center_row'])**2 + (point_cols[hit] - fields['center_col'])**2
+        order = lexsort((distance, query))
+        query, fields = query[order], fields[order]
+        first = concatenate([[True], query[1:] != query[:-1]]) if query.size else zeros(0, dtype=bool)
+        result[points[query[first]]] = fields['label'][first]
+        return result.reshape(shape)
+
+    def intersecting(self, nw_coords, se_coords):
+        """
+        Fields whose boxes intersect a box
+
+        :param nw_coords: UTM coordinates (meters) of the north west corner of the box
+        :param se_coords: UTM coordinates (meters) of the south east corner of the box
+        :return: records of the fields (structured array) sorted by label
+        """
+
+        nw_row, nw_col = self.to_pixel(nw_coords[0], nw_coords[1])
+        se_row, se_col = self.to_pixel(se_coords[0], se_coords[1])
+        # Cells spanned by the box, clipped to the grid
+        first_row, last_row = max(nw_row // self.cell_size, 0), min(se_row // self.cell_size, self.grid_shape[0] - 1)
+        first_col, last_col = max(nw_col // self.cell_size, 0), min(se_col // self.cell_size, self.grid_shape[1] - 1)
+        if first_row > last_row or first_col > last_col:
+            return self.fields[0:0]
+        cell_rows, cell_cols = nonzero(full((last_row - first_row + 1, last_col - first_col + 1), True))
+        cells = (cell_rows + first_row)*self.grid_shape[1] + cell_cols + first_col
+
+        _, candidate = self._candidates(cells)
+        fields = self.fields[unique(candidate)]
+        hit = ((fields['nw_x'] < se_coords[0]) & (fields['se_x'] > nw_coords[0]) &
+               (fields['se_y'] < nw_coords[1]) & (fields['nw_y'] > se_coords[1]))
+        return fields[hit]
+
+    def nearest(self, x, y, k=1):
+        """
+        Fields with the closest centroids to any number of points
+
+        :param x: UTM easting(s) (meters)
+        :param y: UTM northing(s) (meters)
+        :param k: number of fields to find per point
+        :return: (labels, distances (meters)) arrays, with a last axis of length k if k > 1,
+                 label 0 and an infinite distance where there are fewer than k fields
+        """
+
+        x, y = asarray(x, dtype=float64), asarray(y, dtype=float64)
+        if len(self.fields) == 0:
+            shape = x.shape + ((k,) if k > 1 else ())
+            return zeros(shape, dtype=int64), full(shape, inf)
+
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+            self._tree = cKDTree(array([self.fields['center_x'], self.fields['center_y']]).T)
+        distance, position = self._tree.query(array([x.ravel(), y.ravel()]).T, k=k)
+        labels = self.fields['label'][minimum(position, len(self.fields) - 1)]
+        labels[position >= len(self.fields)] = 0
+        return labels.reshape(x.shape + labels.shape[1:]), distance.reshape(x.shape + distance.shape[1:])
+
+    def to_csv(self, path):
+        """
+        Writes the field records to a csv file
+
+        :param path: output file path
+        """
+
+        DataFrame(self.fields).to_csv(path, index=False)
+
+    def save(self, path):
+        """
+        Writes the registry to a binary (numpy .npz) file
+
+        :param path: output file path
+        """
+
+        runs = {}
+        if self.runs is not None:
+            runs = dict(zip(('run_start', 'run_stop', 'run_label'), self.runs))
+        with open(path + '.tmp', 'wb') as registry_file:
+            savez(registry_file, version=REGISTRY_VERSION, fields=self.fields, nw_corner=self.nw_corner,
+                  pixel_size=self.pixel_size, shape=array(self.shape), cell_size=self.cell_size, **runs)
+        replace(path + '.tmp', path)
+
+
+def field_registry(field_mask, nw_corner, pixel_size=30.0, keep_mask=False):
+    """
+    Builds the registry of the fields of a label image
+
+    :param field_mask: 2D integer label image, zero is background
+    :param nw_corner: UTM coordinates (meters) of the north west corner of the image
+    :param pixel_size: pixel edge length (meters)
+    :param keep_mask: if true point queries look the labels up in the field mask
+                      instead of the field runs
+    :return: FieldRegistry
+    """
+
+    return FieldRegistry(field_records(field_mask, nw_corner, pixel_size), nw_corner, pixel_size,
+                         shape=field_mask.shape, field_mask=field_mask if keep_mask else None,
+                         runs=field_runs(field_mask))
+
+
+def load_registry(path, field_mask=None):
+    """
+    Reads a registry written by FieldRegistry.save
+
+    :param path: registry file path
+    :param field_mask: optional label image for point queries (e.g. load(..., mmap_mode='r'))
+    :return: FieldRegistry
+    """
+
+    with load(path) as saved:
+        # Version 1 registries have no field runs, their point queries test the boxes
+        if int(saved['version']) not in (1, REGISTRY_VERSION):
+            raise ValueError('Unsupported field registry version {0}'.format(saved['version']))
+        runs = None
+        if 'run_start' in saved.files:
+            runs = (saved['run_start'], saved['run_stop'], saved['run_label'])
+        return FieldRegistry(saved['fields'], saved['nw_corner'], float(saved['pixel_size']),
+                             shape=tuple(saved['shape']), field_mask=field_mask, cell_size=int(saved['cell_size']),
+                             runs=runs)
@@ -0,0 +1,276 @@
+"""
+Tiled binary morphology and connected component labeling for field masks
+that are too large to process in one piece
+"""
+
+# Imports
+from concurrent.futures import ProcessPoolExecutor
+from numpy import ones, zeros, empty, arange, unique, concatenate, minimum, argsort, int32, int64, bool_
+from scipy.ndimage import binary_erosion, binary_dilation, label as ndi_label
+
+from . import profiling
+from .segmentation import tile_grid
+from .temporal import _ordered_map
+
+# Constants
+DEFAULT_TILE_SIZE = 1024
+
+
+def _erode(image, height, width):
+    """
+    Erosion by a height x width rectangle as a row then a column erosion.
+    Pixels outside the image count as foreground (as in skimage).
+    """
+
+    image = binary_erosion(image, structure=ones((height, 1), dtype=bool_), border_value=1)
+    return binary_erosion(image, structure=ones((1, width), dtype=bool_), border_value=1)
+
+
+def _dilate(image, height, width):
+    """
+    Dilation by a height x width rectangle as a row then a column dilation.
+    Pixels outside the image count as background.
+    """
+
+    image = binary_dilation(image, structure=ones((height, 1), dtype=bool_), border_value=0)
+    return binary_dilation(image, structure=ones((1, width), dtype=bool_), border_value=0)
+
+
+def apply_operations(image, operations):
+    """
+    Applies a sequence of rectangular binary morphology operations in memory,
+    decomposing each rectangle into a row and a column element
+
+    :param image: 2D boolean image
+    :param operations: list of (operation, height, width) tuples with operation
+                       one of 'erosion', 'dilation', 'opening' or 'closing'
+    :return: 2D boolean image
+    """
+
+    for operation, height, width in operations:
+        if operation == 'erosion':
+            image = _erode(image, height, width)
+        elif operation == 'dilation':
+            image = _dilate(image, height, width)
+        elif operation == 'opening':
+            image = _dilate(_erode(image, height, width), height, width)
+        elif operation == 'closing':
+            image = _erode(_dilate(image, height, width), height, width)
+        else:
+            raise ValueError('Unknown morphology operation {0}'.format(operation))
+    return image
+
+
+def operations_halo(operations):
+    """
+    Number of pixels a sequence of operations can reach across, which is the
+    halo a tile needs for its interior to match the whole image result
+
+    :param operations: list of (operation, height, width) tuples
+    :return: halo in pixels
+    """
+
+    halo = 0
+    for operation, height, width in operations:
+        passes = 2 if operation in ('opening', 'closing') else 1
+        halo += passes*max(height//2, width//2)
+    return halo
+
+
+def _process_window(task):
+    """
+    Applies operations to a window and crops out the core (run in worker processes)
+
+    :param task: (window, operations, (row, col) of the core in the window, core shape) tuple
+    :return: core of the result
+    """
+
+    window, operations, (row, col), (rows, cols) = task
+    return apply_operations(window, operations)[row:row + rows, col:col + cols]
+
+
+@profiling.profiled('morphology.tiled_morphology')
+def tiled_morphology(image, operations, tile_size=DEFAULT_TILE_SIZE, workers=1, out=None):
+    """
+    Applies a sequence of rectangular binary morphology operations tile by
+    tile. Every tile is processed with a halo wide enough for the whole
+    sequence, so the result is identical to apply_operations on the whole
+    image while only a few tiles are ever in memory.
+
+    :param image: 2D boolean image (may be a memmap)
+    :param operations: list of (operation, height, width) tuples
+    :param tile_size: tile edge length in pixels
+    :param workers: number of worker processes
+    :param out: optional output array (e.g. a memmap), created if not given
+    :return: 2D boolean image
+    """
+
+    rows, cols = image.shape
+    halo = operations_halo(operations)
+    if out is None:
+        out = empty(image.shape, dtype=bool_)
+
+    tiles = tile_grid(image.shape, tile_size)
+
+    def tasks():
+        for row_start, row_stop, col_start, col_stop in tiles:
+            r0, r1 = max(row_start - halo, 0), min(row_stop + halo, rows)
+            c0, c1 = max(col_start - halo, 0), min(col_stop + halo, cols)
+            yield (image[r0:r1, c0:c1], operations, (row_start - r0, col_start - c0),
+                   (row_stop - row_start, col_stop - col_start))
+
+    if workers > 1:
+        # Only a few windows per worker are submitted ahead so the copies of the
+        # image waiting in the pool stay bounded
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = _ordered_map(executor, _process_window, tasks(), 2*workers)
+            for (row_start, row_stop, col_start, col_stop), core in zip(tiles, results):
+                out[row_start:row_stop, col_start:col_stop] = core
+    else:
+        for (row_start, row_stop, col_start, col_stop), task in zip(tiles, tasks()):
+            out[row_start:row_stop, col_start:col_stop] = _process_window(task)
+
+    profiling.current().add(pixels=image.size, tiles=len(tiles))
+    return out
+
+
+def _label_tile(task):
+    """
+    Labels the connected components of one tile (run in worker processes)
+
+    :param task: (tile, connectivity) tuple
+    :return: (labels, number of labels, flat tile index of the first pixel of each label)
+    """
+
+    tile, connectivity = task
+    structure = ones((3, 3), dtype=bool_) if connectivity == 2 else None
+    labels, num_labels = ndi_label(tile, structure=structure)
+    flat_labels = labels.ravel()
+    present, first = unique(flat_labels, return_index=True)
+    return labels, num_labels, first[present > 0]
+
+
+def _union_find(num_labels, pairs):
+    """
+    Merges labels that are connected across tile seams
+
+    :param num_labels: number of provisional labels (label 0 is background)
+    :param pairs: (n, 2) array of provisional labels that touch
+    :return: array mapping every provisional label to the root of its component
+    """
+
+    parent = arange(num_labels + 1)
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for a, b in pairs.tolist():
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    # Point every label straight at its root
+    for x in range(num_labels + 1):
+        parent[x] = find(x)
+    return parent
+
+
+def _seam_pairs(labels, seam, axis, connectivity):
+    """
+    Finds the pairs of labels that touch across a seam between tiles
+
+    :param labels: provisional label image
+    :param seam: index of the first row (axis 0) or column (axis 1) after the seam
+    :param axis: 0 for a seam between tile rows, 1 for a seam between tile columns
+    :param connectivity: 1 (4 neighbours) or 2 (8 neighbours)
+    :return: (n, 2) array of touching labels
+    """
+
+    if axis == 0:
+        before, after = labels[seam - 1, :], labels[seam, :]
+    else:
+        before, after = labels[:, seam - 1], labels[:, seam]
+    before, after = before.astype(int64), after.astype(int64)
+
+    pairs = [(before, after)]
+    if connectivity == 2:
+        pairs.append((before[:-1], after[1:]))
+        pairs.append((before[1:], after[:-1]))
+
+    found = []
+    for a, b in pairs:
+        touching = (a > 0) & (b > 0)
+        found.append(concatenate([a[touching][:, None], b[touching][:, None]], axis=1))
+    return unique(concatenate(found), axis=0)
+
+
+@profiling.profiled('morphology.tiled_label')
+def tiled_label(image, connectivity=1, tile_size=DEFAULT_TILE_SIZE, workers=1, out=None):
+    """
+    Labels the connected components of a binary image tile by tile. Each
+    tile is labeled on its own, the labels that touch across tile seams are
+    merged with a union-find pass and the result is renumbered so the labels
+    match skimage.measure.label on the whole image (background 0, labels
+    numbered from 1 in raster scan order of their first pixel).
+
+    :param image: 2D boolean image (may be a memmap)
+    :param connectivity: 1 (4 neighbours) or 2 (8 neighbours)
+    :param tile_size: tile edge length in pixels
+    :param workers: number of worker processes
+    :param out: optional int32 output array (e.g. a memmap), created if not given
+    :return: (label image, number of labels)
+    """
+
+    cols = image.shape[1]
+    if out is None:
+        out = zeros(image.shape, dtype=int32)
+
+    tiles = tile_grid(image.shape, tile_size)
+    tasks = ((image[r0:r1, c0:c1], connectivity) for r0, r1, c0, c1 in tiles)
+
+    # Label every tile with provisional labels that are unique across tiles,
+    # with a few tiles per worker submitted ahead
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    if executor is not None:
+        results = _ordered_map(executor, _label_tile, tasks, 2*workers)
+    else:
+        results = map(_label_tile, tasks)
+    num_labels = 0
+    first_pixel = [zeros(1, dtype=int64)]
+    for (r0, r1, c0, c1), (labels, tile_labels, first) in zip(tiles, results):
+        labels[labels > 0] += num_labels
+        out[r0:r1, c0:c1] = labels
+        # Flat index of the first pixel of each label in the whole image
+        first_pixel.append((r0 + first//(c1 - c0))*cols + c0 + first % (c1 - c0))
+        num_labels += tile_labels
+    if executor is not None:
+        executor.shutdown()
+    first_pixel = concatenate(first_pixel)
+
+    # Merge the labels across the seams
+    row_seams = sorted(set(r0 for r0, _, _, _ in tiles) - {0})
+    col_seams = sorted(set(c0 for _, _, c0, _ in tiles) - {0})
+    pairs = [_seam_pairs(out, seam, 0, connectivity) for seam in row_seams] + \
+            [_seam_pairs(out, seam, 1, connectivity) for seam in col_seams]
+    pairs = unique(concatenate(pairs), axis=0) if pairs else zeros((0, 2), dtype=int64)
+    root = _union_find(num_labels, pairs)
+
+    # Number the components by the raster order of their first pixel
+    component_first = first_pixel.copy()
+    minimum.at(component_first, root, first_pixel)
+    roots = unique(root[1:])
+    order = argsort(component_first[roots], kind='stable')
+    final = zeros(num_labels + 1, dtype=int32)
+    final[roots[order]] = arange(1, roots.size + 1)
+    lookup = final[root]
+
+    for r0, r1, c0, c1 in tiles:
+        out[r0:r1, c0:c1] = lookup[out[r0:r1, c0:c1]]
+
+    profiling.current().add(pixels=image.size, tiles=len(tiles), labels=int(roots.size))
+    return out, roots.size
@@ -0,0 +1,224 @@
+"""
+Mosaics of the scenes covering a region that spans several WRS path/rows,
+composited onto one pixel grid a tile at a time. Only the window of each
+scene overlapping a tile is read, and every pixel takes its value from one
+source scene chosen by a selection rule (e.g. the latest clear acquisition).
+"""
+
+# Imports
+from datetime import datetime
+from numpy import asarray, zeros, full, inf, int16, float32, ones, bool_, broadcast_to
+
+from . import profiling
+from .reducers import tile_bounds
+from .scene import open_scene, clip_window
+from .temporal import NODATA
+
+# Constants
+DEFAULT_TILE_SIZE = 1024
+SELECTIONS = ('latest', 'earliest', 'sun_elevation')
+
+
+def grid_shape(nw_coords, se_coords, pixel_size):
+    """
+    :param nw_coords: UTM coordinates (meters) of the north west corner of the grid
+    :param se_coords: UTM coordinates (meters) of the south east corner of the grid
+    :param pixel_size: pixel edge length (meters)
+    :return: (rows, cols) of the grid
+    """
+
+    return (int(round((nw_coords[1] - se_coords[1])/pixel_size)),
+            int(round((se_coords[0] - nw_coords[0])/pixel_size)))
+
+
+def bright_pixel_test(band=1, max_reflectance=0.25):
+    """
+    Simple clear pixel test for the clear argument of mosaic(), pixels brighter
+    than a threshold in a band (clouds and haze are bright in blue) are not clear
+
+    :param band: band to test, it must be one of the mosaic bands
+    :param max_reflectance: highest top of atmosphere reflectance of a clear pixel
+    :return: function(scene, dn) -> boolean array, true where the pixels are clear
+    """
+
+    def clear(scene, dn):
+        return scene.calibrate(dn[band], band, 'reflectance') <= max_reflectance
+    return clear
+
+
+def _scene_priority(scene, selection):
+    """
+    :return: priority of a scene for a selection rule applied per scene
+    """
+
+    acquired = datetime(scene.year, scene.month, scene.day, scene.hour, scene.minute, scene.second)
+    if selection == 'latest':
+        return acquired.timestamp()
+    elif selection == 'earliest':
+        return -acquired.timestamp()
+    elif selection == 'sun_elevation':
+        return float(scene.metadata.get('IMAGE_ATTRIBUTES/SUN_ELEVATION', -90))
+    raise ValueError('Unknown selection {0}'.format(selection))
+
+
+def mosaic_scenes(catalog, nw_coords, se_coords, start=None, end=None, **conditions):
+    """
+    Finds the scenes to mosaic over a region in a catalog
+
+    :param catalog: SceneCatalog
+    :param nw_coords: UTM coordinates (meters) of the north west corner of the region
+    :param se_coords: UTM coordinates (meters) of the south east corner of the region
+    :param start: earliest acquisition (datetime or ISO string)
+    :param end: latest acquisition (datetime or ISO string)
+    :param conditions: other conditions of SceneCatalog.query (e.g. months, utm_zone)
+    :return: list of archive paths sorted by acquisition time
+    """
+
+    utm_zone = conditions.pop('utm_zone', None)
+    records = catalog.query(nw_coords=nw_coords, se_coords=se_coords, start=start, end=end, **conditions)
+    return [record['archive_path'] for record in records if utm_zone is None or record['utm_zone'] == utm_zone]
+
+
+def iter_mosaic(archive_paths, bands, nw_coords, se_coords, selection='latest', clear=None, product='reflectance',
+                tile_size=DEFAULT_TILE_SIZE, dtype=float32):
+    """
+    Composites scenes onto the pixel grid starting at the north west corner,
+    one tile at a time, so only a tile of every band is in memory.
+
+    With a selection by scene ('latest', 'earliest' or 'sun_elevation') every
+    pixel takes the valid (and clear) value of the highest priority scene, the
+    scenes are read in priority order and the rest are skipped once a tile is
+    filled. A selection function scores every pixel instead, and the valid
+    pixel with the highest score wins.
+
+    :param archive_paths: archive paths of the scenes (same UTM zone and pixel size)
+    :param bands: bands to mosaic
+    :param nw_coords: UTM coordinates (meters) of the north west corner of the mosaic
+    :param se_coords: UTM coordinates (meters) of the south east corner of the mosaic
+    :param selection: one of SELECTIONS, or function(scene, dn) -> score array of a window,
+                      where dn is a dictionary of band -> digital numbers of the window
+    :param clear: optional function(scene, dn) -> boolean array, true for pixels that
+                  may be used (e.g. bright_pixel_test())
+    :param product: radiometric product (see radiometry.calibrate)
+    :param tile_size: tile edge length in pixels
+    :param dtype: data type of the mosaic
+    :return: generator of ((row_start, row_stop, col_start, col_stop), (bands x rows x cols)
+             array, (rows x cols) index into archive_paths of the source of every pixel,
+             -1 where no scene has valid data) tuples
+    """
+
+    nw_coords = asarray(nw_coords, dtype=float)
+    se_coords = asarray(se_coords, dtype=float)
+    bands = [int(band) for band in bands]
+    scenes = [open_scene(archive_path) for archive_path in archive_paths]
+    if not scenes:
+        raise ValueError('No scenes to mosaic')
+    pixel_size = scenes[0].pixel_size
+    utm_zone = scenes[0].metadata.get('PROJECTION_PARAMETERS/UTM_ZONE')
+    for scene in scenes:
+        if scene.pixel_size != pixel_size:
+            raise ValueError('Scene {0} has a {1} m pixel size, expected {2} m'.format(
+                scene.scene_id, scene.pixel_size, pixel_size))
+        if scene.metadata.get('PROJECTION_PARAMETERS/UTM_ZONE') != utm_zone:
+            raise ValueError('Scene {0} is in UTM zone {1}, expected zone {2}'.format(
+                scene.scene_id, scene.metadata.get('PROJECTION_PARAMETERS/UTM_ZONE'), utm_zone))
+
+    # Scenes in the order they are composited, and where the mosaic origin is in each
+    per_pixel = callable(selection)
+    order = list(range(len(scenes)))
+    if not per_pixel:
+        priorities = [_scene_priority(scene, selection) for scene in scenes]
+        order.sort(key=lambda n: -priorities[n])
+    origins = [scene.coords_to_pixel(nw_coords) for scene in scenes]
+    members = [None]*len(scenes)
+
+    for bounds in tile_bounds(grid_shape(nw_coords, se_coords, pixel_size), tile_size):
+        row_start, row_stop, col_start, col_stop = bounds
+        shape = (row_stop - row_start, col_stop - col_start)
+        tile = zeros((len(bands),) + shape, dtype=dtype)
+        source = full(shape, -1, dtype=int16)
+        best = full(shape, -inf)
+
+        with profiling.span('mosaic.tile', scenes=len(scenes)) as stage:
+            stage.add(pixels=tile.size)
+            for n in order:
+                scene = scenes[n]
+                col, row = origins[n]
+                inside, placement = clip_window(row + row_start, row + row_stop, col + col_start, col + col_stop,
+                                                (scene.image_size[1], scene.image_size[0]))
+                if inside[0] == inside[1] or inside[2] == inside[3]:
+                    continue
+
+                # Extract the bands of a compressed archive in one pass the first
+                # time the scene is needed, so the windows are read from disk
+                if members[n] is None:
+                    members[n] = dict((band, scene.archive.find_member('_B{0:d}.TIF'.format(band)))
+                                      for band in bands)
+                    scene.archive.extract_members(list(members[n].values()))
+
+                # Read only the window of the scene in the tile. The images are not
+                # kept between tiles, an archive streamed without a cache directory
+                # holds the whole member in memory
+                dn = dict((band, scene.archive.open_tiff(members[n][band]).read_window(*inside))
+                          for band in bands)
+                stage.add(scenes_read=1)
+
+                # Valid pixels have data in every band
+                valid = ones(dn[bands[0]].shape, dtype=bool_)
+                for band in bands:
+                    valid &= dn[band] != NODATA
+                if clear is not None:
+                    valid &= clear(scene, dn)
+
+                if per_pixel:
+                    score = broadcast_to(asarray(selection(scene, dn), dtype=float), valid.shape)
+                    chosen = valid & (score > best[placement])
+                    best[placement][chosen] = score[chosen]
+                else:
+                    chosen = valid & (source[placement] < 0)
+
+                source[placement][chosen] = n
+                for b, band in enumerate(bands):
+                    tile[b][placement][chosen] = scene.calibrate(dn[band][chosen], band, product, dtype)
+
+                # Lower priority scenes can not replace any pixel of a full tile
+                if not per_pixel and (source >= 0).all():
+                    break
+
+        yield bounds, tile, source
+
+
+def mosaic(archive_paths, bands, nw_coords, se_coords, selection='latest', clear=None, product='reflectance',
+           tile_size=DEFAULT_TILE_SIZE, dtype=float32, out=None, source_out=None):
+    """
+    Composites scenes onto one grid (see iter_mosaic). To mosaic regions too
+    large for memory, pass memory mapped output arrays (numpy.lib.format.open_memmap).
+
+    :param archive_paths: archive paths of the scenes (e.g. from mosaic_scenes())
+    :param bands: bands to mosaic
+    :param nw_coords: UTM coordinates (meters) of the north west corner of the mosaic
+    :param se_coords: UTM coordinates (meters) of the south east corner of the mosaic
+    :param selection: see iter_mosaic
+    :param clear: see iter_mosaic
+    :param product: radiometric product (see radiometry.calibrate)
+    :param tile_size: tile edge length in pixels
+    :param dtype: data type of the mosaic
+    :param out: optional (bands x rows x cols) array to write the mosaic to
+    :param source_out: optional (rows x cols) integer array to write the source indices to
+    :return: (bands x rows x cols) array, (rows x cols) index into archive_paths of the
+             source of every pixel (-1 where no scene has valid data)
+    """
+
+    if not archive_paths:
+        raise ValueError('No scenes to mosaic')
+    shape = grid_shape(nw_coords, se_coords, open_scene(archive_paths[0]).pixel_size)
+    if out is None:
+        out = zeros((len(bands),) + shape, dtype=dtype)
+    if source_out is None:
+        source_out = full(shape, -1, dtype=int16)
+
+    for (row_start, row_stop, col_start, col_stop), tile, source in iter_mosaic(
+            archive_paths, bands, nw_coords, se_coords, selection, clear, product, tile_size, dtype):
+        out[:, row_start:row_stop, col_start:col_stop] = tile
+        source_out[row_start:row_stop, col_start:col_stop] = source
+    return out, source_out
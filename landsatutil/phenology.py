@@ -0,0 +1,324 @@
+"""
+Multi-temporal field features: a dense (field x date x band) tensor built from
+the per scene field statistics, vegetation index series, interpolation onto a
+common day of year grid and phenology metrics, each computed for all the
+fields at once
+"""
+
+# Imports
+from numpy import asarray, arange, unique, full, zeros, where, isfinite, nan, errstate, take_along_axis, bincount
+from numpy import maximum, minimum, any as np_any, diff, stack
+from numpy import int64, float64
+
+# Constants
+BANDS = tuple(range(1, 8))
+DEFAULT_GRID = arange(91, 305, 8)
+
+# EVI coefficients (gain, red and blue aerosol coefficients, canopy background)
+EVI_COEFFICIENTS = (2.5, 6.0, 7.5, 1.0)
+
+PHENOLOGY_DTYPE = [
+    ('label', int64),
+    ('year', int64),
+    ('observations', int64),
+    ('base', float64),
+    ('peak', float64),
+    ('peak_doy', float64),
+    ('amplitude', float64),
+    ('greenup_doy', float64),
+    ('senescence_doy', float64),
+    ('season_length', float64),
+    ('integral', float64),
+    ('season_integral', float64),
+    ('greenup_rate', float64),
+    ('senescence_rate', float64),
+]
+
+
+def acquisition_dates(columns):
+    """
+    :param columns: dictionary (or DataFrame) with 'year', 'month' and 'day' columns
+    :return: datetime64[D] array of the dates of the rows
+    """
+
+    years = asarray(columns['year'], dtype=int64)
+    months = asarray(columns['month'], dtype=int64)
+    days = asarray(columns['day'], dtype=int64)
+    return ((years - 1970).astype('datetime64[Y]') + (months - 1).astype('timedelta64[M]')).astype('datetime64[D]') \
+        + (days - 1).astype('timedelta64[D]')
+
+
+def day_of_year(dates):
+    """
+    :param dates: datetime64 array
+    :return: int array of the days of the year (1 to 366)
+    """
+
+    dates = asarray(dates).astype('datetime64[D]')
+    return (dates - dates.astype('datetime64[Y]').astype('datetime64[D]')).astype(int64) + 1
+
+
+def time_series_tensor(columns, bands=BANDS, statistic='ref'):
+    """
+    Arranges the per (field, scene) rows of the field statistics (e.g. from
+    a FeatureStore) as a dense tensor. Rows of the same field and date (e.g.
+    overlapping scenes) are averaged, missing ones are nan.
+
+    :param columns: dictionary (or DataFrame) with 'label', 'year', 'month', 'day'
+                    and 'b<band>_<statistic>' columns
+    :param bands: bands to take
+    :param statistic: column suffix of the statistic ('ref' for the mean, 'var')
+    :return: (sorted field labels, sorted datetime64[D] dates, (fields x dates x bands) float array)
+    """
+
+    field_labels, field_index = unique(asarray(columns['label'], dtype=int64), return_inverse=True)
+    dates, date_index = unique(acquisition_dates(columns), return_inverse=True)
+    values = stack([asarray(columns['b{0:d}_{1}'.format(band, statistic)], dtype=float64) for band in bands],
+                   axis=1)
+
+    # Sum and count the rows of each cell, leaving out missing values
+    flat = field_index*dates.size + date_index
+    present = isfinite(values)
+    totals = zeros((field_labels.size*dates.size, len(bands)))
+    counts = zeros((field_labels.size*dates.size, len(bands)))
+    for b in range(len(bands)):
+        totals[:, b] = bincount(flat[present[:, b]], weights=values[present[:, b], b], minlength=totals.shape[0])
+        counts[:, b] = bincount(flat[present[:, b]], minlength=counts.shape[0])
+    with errstate(invalid='ignore', divide='ignore'):
+        tensor = totals/counts
+    return field_labels, dates, tensor.reshape(field_labels.size, dates.size, len(bands))
+
+
+def normalized_difference(first, second):
+    """
+    :return: (first - second)/(first + second), nan where the sum is zero
+    """
+
+    with errstate(invalid='ignore', divide='ignore'):
+        result = (first - second)/(first + second)
+    result[~isfinite(result)] = nan
+    return result
+
+
+def ndvi(tensor, bands=BANDS, red=3, nir=4):
+    """
+    Normalized difference vegetation index of a reflectance tensor
+
+    :param tensor: (... x bands) array of top of atmosphere reflectance
+    :param bands: bands of the last axis of the tensor
+    :param red: red band
+    :param nir: near infrared band
+    :return: array of the tensor shape without the band axis
+    """
+
+    bands = list(bands)
+    return normalized_difference(tensor[..., bands.index(nir)], tensor[..., bands.index(red)])
+
+
+def evi(tensor, bands=BANDS, blue=1, red=3, nir=4, coefficients=EVI_COEFFICIENTS):
+    """
+    Enhanced vegetation index of a reflectance tensor
+
+    :param tensor: (... x bands) array of top of atmosphere reflectance
+    :param bands: bands of the last axis of the tensor
+    :param blue: blue band
+    :param red: red band
+    :param nir: near infrared band
+    :param coefficients: (gain, red coefficient, blue coefficient, canopy background)
+    :return: array of the tensor shape without the band axis
+    """
+
+    bands = list(bands)
+    gain, c_red, c_blue, background = coefficients
+    b, r, n = tensor[..., bands.index(blue)], tensor[..., bands.index(red)], tensor[..., bands.index(nir)]
+    with errstate(invalid='ignore', divide='ignore'):
+        result = gain*(n - r)/(n + c_red*r - c_blue*b + background)
+    result[~isfinite(result)] = nan
+    return result
+
+
+def interpolate_series(values, doy, grid=DEFAULT_GRID, extrapolate=False):
+    """
+    Linearly interpolates the series of every field onto a common day of year
+    grid, skipping each field's missing (nan) observations. The bracketing
+    observations of every grid day are found for all the fields at once with
+    running maximum / minimum indices instead of a loop over fields.
+
+    :param values: (fields x dates) array, nan where a field has no observation
+    :param doy: sorted day of year of each date (one season)
+    :param grid: days of the year to interpolate to
+    :param extrapolate: if true grid days before the first or after the last
+                        observation of a field take its nearest value, otherwise nan
+    :return: (fields x grid) array
+    """
+
+    values = asarray(values, dtype=float64)
+    doy = asarray(doy, dtype=float64)
+    grid = asarray(grid, dtype=float64)
+    num_fields, num_dates = values.shape
+    if num_dates == 0:
+        return full((num_fields, grid.size), nan)
+
+    # Index of the last valid observation at or before, and the first at or
+    # after, every date (-1 and num_dates when there is none)
+    valid = isfinite(values)
+    positions = arange(num_dates)
+    previous = maximum.accumulate(where(valid, positions, -1), axis=1)
+    following = minimum.accumulate(where(valid, positions, num_dates)[:, ::-1], axis=1)[:, ::-1]
+
+    # Observations bracketing every grid day
+    after = doy.searchsorted(grid, side='left')
+    before = doy.searchsorted(grid, side='right') - 1
+    low = full((num_fields, grid.size), -1, dtype=int64)
+    high = full((num_fields, grid.size), num_dates, dtype=int64)
+    low[:, before >= 0] = previous[:, before[before >= 0]]
+    high[:, after < num_dates] = following[:, after[after < num_dates]]
+
+    has_low = low >= 0
+    has_high = high < num_dates
+    low_value = take_along_axis(values, maximum(low, 0), axis=1)
+    high_value = take_along_axis(values, minimum(high, num_dates - 1), axis=1)
+    low_doy = doy[maximum(low, 0)]
+    high_doy = doy[minimum(high, num_dates - 1)]
+
+    with errstate(invalid='ignore', divide='ignore'):
+        weight = (grid[None, :] - low_doy)/(high_doy - low_doy)
+    weight[~isfinite(weight)] = 0.0
+    result = low_value + weight*(high_value - low_value)
+    result[~(has_low & has_high)] = nan
+
+    if extrapolate:
+        result = where(has_low & ~has_high, low_value, result)
+        result = where(~has_low & has_high, high_value, result)
+    return result
+
+
+def seasonal_series(values, dates, grid=DEFAULT_GRID, years=None, extrapolate=False):
+    """
+    Interpolates the series of every field onto the day of year grid for each year
+
+    :param values: (fields x dates) array
+    :param dates: sorted datetime64 dates of the columns of values
+    :param grid: days of the year to interpolate to
+    :param years: years to make (default: the years of the dates)
+    :param extrapolate: see interpolate_series
+    :return: (years, (fields x years x grid) array)
+    """
+
+    dates = asarray(dates).astype('datetime64[D]')
+    date_years = dates.astype('datetime64[Y]').astype(int64) + 1970
+    years = unique(date_years) if years is None else asarray(years, dtype=int64)
+    doy = day_of_year(dates)
+
+    series = full((values.shape[0], years.size, len(grid)), nan)
+    for n, year in enumerate(years):
+        in_year = date_years == year
+        series[:, n, :] = interpolate_series(values[:, in_year], doy[in_year], grid, extrapolate)
+    return years, series
+
+
+def phenology_metrics(series, grid=DEFAULT_GRID, threshold=0.5):
+    """
+    Phenology metrics of interpolated vegetation index series, for all the
+    series at once. Green-up and senescence are the first and last grid days
+    at which the index is above base + threshold*amplitude.
+
+    :param series: (... x grid) array of a vegetation index on the grid (nan where unknown)
+    :param grid: days of the year of the last axis
+    :param threshold: fraction of the amplitude above the base marking the season
+    :return: dictionary of metric name -> array of the leading shape of series
+             ('observations', 'base', 'peak', 'peak_doy', 'amplitude', 'greenup_doy',
+             'senescence_doy', 'season_length', 'integral', 'season_integral',
+             'greenup_rate', 'senescence_rate')
+    """
+
+    series = asarray(series, dtype=float64)
+    grid = asarray(grid, dtype=float64)
+    shape = series.shape[:-1]
+    known = isfinite(series)
+    any_known = np_any(known, axis=-1)
+    filled = where(known, series, -1e300)
+
+    metrics = {'observations': known.sum(axis=-1)}
+    with errstate(invalid='ignore'):
+        metrics['peak'] = where(any_known, filled.max(axis=-1), nan)
+        metrics['base'] = where(any_known, where(known, series, 1e300).min(axis=-1), nan)
+    peak_index = filled.argmax(axis=-1)
+    metrics['peak_doy'] = where(any_known, grid[peak_index], nan)
+    metrics['amplitude'] = metrics['peak'] - metrics['base']
+
+    # Season: the grid days above the threshold level
+    level = metrics['base'] + threshold*metrics['amplitude']
+    with errstate(invalid='ignore'):
+        above = known & (series >= level[..., None])
+    positions = arange(grid.size)
+    first = where(above, positions, grid.size).min(axis=-1)
+    last = where(above, positions, -1).max(axis=-1)
+    in_season = any_known & (last >= 0)
+    metrics['greenup_doy'] = where(in_season, grid[minimum(first, grid.size - 1)], nan)
+    metrics['senescence_doy'] = where(in_season, grid[maximum(last, 0)], nan)
+    metrics['season_length'] = metrics['senescence_doy'] - metrics['greenup_doy']
+
+    # Trapezoid integrals over the known intervals, the season integral is
+    # the part above the base
+    step = diff(grid)
+    both = known[..., 1:] & known[..., :-1]
+    zero = where(known, series, 0.0)
+    pairs = (zero[..., 1:] + zero[..., :-1])*0.5*step
+    metrics['integral'] = where(any_known, where(both, pairs, 0.0).sum(axis=-1), nan)
+    above_base = where(known, maximum(series - metrics['base'][..., None], 0.0), 0.0)
+    pairs = (above_base[..., 1:] + above_base[..., :-1])*0.5*step
+    metrics['season_integral'] = where(any_known, where(both, pairs, 0.0).sum(axis=-1), nan)
+
+    # Steepest rise and fall per day
+    with errstate(invalid='ignore'):
+        slope = where(both, diff(series, axis=-1)/step, nan)
+    steep = np_any(both, axis=-1)
+    metrics['greenup_rate'] = where(steep, where(both, slope, -1e300).max(axis=-1), nan)
+    metrics['senescence_rate'] = where(steep, -where(both, slope, 1e300).min(axis=-1), nan)
+
+    for name in metrics:
+        metrics[name] = metrics[name].reshape(shape)
+    return metrics
+
+
+def phenology_table(columns, index='ndvi', grid=DEFAULT_GRID, threshold=0.5, bands=BANDS, include_series=False):
+    """
+    Phenology features of every field and year from the per scene field
+    statistics, one row per (label, year) so they can be joined with the
+    truth (e.g. truth.join_truth)
+
+    :param columns: dictionary (or DataFrame) of field statistics of top of atmosphere
+                    reflectance, as written by collate_crop_data.py
+    :param index: 'ndvi' or 'evi'
+    :param grid: days of the year of the common grid
+    :param threshold: see phenology_metrics
+    :param bands: bands of the statistics columns
+    :param include_series: if true the interpolated index on the grid is added as
+                           '<index>_doy<day>' columns
+    :return: dictionary of column name -> array, with 'label', 'year' and the
+             metrics prefixed with the index name (e.g. 'ndvi_peak')
+    """
+
+    labels, dates, tensor = time_series_tensor(columns, bands=bands)
+    if index == 'ndvi':
+        values = ndvi(tensor, bands=bands)
+    elif index == 'evi':
+        values = evi(tensor, bands=bands)
+    else:
+        raise ValueError('Unknown vegetation index {0}'.format(index))
+
+    years, series = seasonal_series(values, dates, grid)
+    metrics = phenology_metrics(series, grid, threshold)
+
+    table = {
+        'label': (labels[:, None] + zeros((1, years.size), dtype=int64)).ravel(),
+        'year': (years[None, :] + zeros((labels.size, 1), dtype=int64)).ravel(),
+    }
+    for name, value in metrics.items():
+        table['{0}_{1}'.format(index, name)] = value.ravel()
+    if include_series:
+        flat_series = series.reshape(labels.size*years.size, len(grid))
+        for n, day in enumerate(grid):
+            table['{0}_doy{1:d}'.format(index, int(day))] = flat_series[:, n]
+    return table
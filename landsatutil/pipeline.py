@@ -0,0 +1,284 @@
+"""
+Incremental runner for a graph of processing stages. Every stage output
+(artifact) is stored in a directory keyed by a hash of the stage parameters,
+the keys of its input artifacts and the signatures of the files it reads, so
+only stages whose inputs changed are recomputed. Independent stages run
+concurrently.
+"""
+
+# Imports
+import hashlib
+import json
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from os import listdir, makedirs, rename, rmdir, stat, getpid, walk
+from os.path import abspath, dirname, isdir, isfile, join
+from time import perf_counter
+
+# Constants
+MANIFEST_FILE = 'manifest.json'
+
+
+def file_signature(path):
+    """
+    Signature of an input file, its path, size and modification time (large
+    archives are not read to hash their contents)
+
+    :param path: path to the file (or directory)
+    :return: [absolute path, size, mtime] list
+    """
+
+    file_stat = stat(path)
+    return [abspath(path), file_stat.st_size, file_stat.st_mtime]
+
+
+class Stage(object):
+
+    def __init__(self, name, function, inputs=(), params=None, files=(), version=1):
+        """
+        Create a processing stage
+
+        :param name: unique name of the stage (may contain '/', e.g. 'features/<scene id>')
+        :param function: function(output directory, dictionary of input name -> artifact
+                         directory, parameters) writing the artifact files to the output
+                         directory, it may return a JSON serializable summary
+        :param inputs: names of the stages whose artifacts the stage reads
+        :param params: JSON serializable dictionary of parameters
+        :param files: paths of the external files the stage reads (e.g. archives)
+        :param version: version of the stage code, increase it to invalidate old artifacts
+        :return: Stage object
+        """
+
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.params = {} if params is None else params
+        self.files = list(files)
+        self.version = version
+
+
+class Pipeline(object):
+
+    def __init__(self, store_dir):
+        """
+        Create an empty pipeline storing its artifacts in a directory
+
+        :param store_dir: artifact store directory
+        :return: Pipeline object
+        """
+
+        self.store_dir = store_dir
+        self.stages = {}
+        self._keys = {}
+        makedirs(store_dir, exist_ok=True)
+
+    def add(self, stage):
+        """
+        Adds a stage, its inputs must have been added already
+
+        :param stage: Stage
+        :return: the stage
+        """
+
+        if stage.name in self.stages:
+            raise ValueError('Stage {0} is already in the pipeline'.format(stage.name))
+        for name in stage.inputs:
+            if name not in self.stages:
+                raise KeyError('Input {0} of stage {1} is not in the pipeline'.format(name, stage.name))
+        self.stages[stage.name] = stage
+        return stage
+
+    def key(self, name):
+        """
+        Content key of a stage's artifact
+
+        :param name: stage name
+        :return: hexadecimal hash string
+        """
+
+        if name not in self._keys:
+            stage = self.stages[name]
+            description = {
+                'stage': name,
+                'version': stage.version,
+                'params': stage.params,
+                'inputs': dict((input_name, self.key(input_name)) for input_name in stage.inputs),
+                'files': [file_signature(path) for path in stage.files],
+            }
+            encoded = json.dumps(description, sort_keys=True, default=str).encode()
+            self._keys[name] = hashlib.sha1(encoded).hexdigest()
+        return self._keys[name]
+
+    def artifact_path(self, name):
+        """
+        :param name: stage name
+        :return: directory of the stage's current artifact
+        """
+
+        return join(self.store_dir, name, self.key(name))
+
+    def is_current(self, name):
+        """
+        :return: true if the artifact of the stage's current inputs exists
+        """
+
+        return isfile(join(self.artifact_path(name), MANIFEST_FILE))
+
+    def manifest(self, name):
+        """
+        :return: manifest of a stage's current artifact (key, parameters, inputs,
+                 run time and the summary returned by the stage)
+        """
+
+        with open(join(self.artifact_path(name), MANIFEST_FILE)) as manifest_file:
+            return json.load(manifest_file)
+
+    def dependencies(self, targets=None):
+        """
+        Stages needed for a set of targets, in an order where every stage comes
+        after its inputs
+
+        :param targets: stage names (default: all stages)
+        :return: list of stage names
+        """
+
+        order = []
+        seen = set()
+
+        def visit(name):
+            if name in seen:
+                return
+            seen.add(name)
+            for input_name in self.stages[name].inputs:
+                visit(input_name)
+            order.append(name)
+
+        for name in (self.stages if targets is None else targets):
+            visit(name)
+        return order
+
+    def plan(self, targets=None, force=()):
+        """
+        :param targets: stage names (default: all stages)
+        :param force: names of stages to recompute even if their artifact exists
+        :return: list of (stage name, true if it has to be run) tuples in dependency order
+        """
+
+        return [(name, name in force or not self.is_current(name)) for name in self.dependencies(targets)]
+
+    def _run_stage(self, name):
+        """
+        Runs one stage into a temporary directory and moves it into place once
+        it is complete, so an interrupted stage leaves no artifact behind
+
+        :return: seconds the stage took
+        """
+
+        stage = self.stages[name]
+        path = self.artifact_path(name)
+        tmp_path = '{0}.{1:d}.{2:d}.tmp'.format(path, getpid(), threading.get_ident())
+        if isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        makedirs(tmp_path)
+
+        try:
+            inputs = dict((input_name, self.artifact_path(input_name)) for input_name in stage.inputs)
+            start = perf_counter()
+            summary = stage.function(tmp_path, inputs, stage.params)
+            seconds = perf_counter() - start
+            with open(join(tmp_path, MANIFEST_FILE), 'w') as manifest_file:
+                json.dump({
+                    'stage': name,
+                    'key': self.key(name),
+                    'version': stage.version,
+                    'params': stage.params,
+                    'inputs': dict((input_name, self.key(input_name)) for input_name in stage.inputs),
+                    'files': [file_signature(file_path) for file_path in stage.files],
+                    'seconds': seconds,
+                    'summary': summary,
+                }, manifest_file, indent=1, default=str)
+
+            # Replace an artifact left by a forced run
+            if isdir(path):
+                shutil.rmtree(path)
+            rename(tmp_path, path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        return seconds
+
+    def run(self, targets=None, workers=1, force=(), log=print):
+        """
+        Brings the artifacts of a set of targets up to date, running the stages
+        whose inputs changed. Stages are started as soon as their inputs are
+        ready, up to workers at a time.
+
+        :param targets: stage names (default: all stages)
+        :param workers: number of stages run at once
+        :param force: names of stages to recompute even if their artifact exists
+        :param log: function called with progress messages (None for silence)
+        :return: dictionary of stage name -> artifact directory
+        """
+
+        log = log or (lambda message: None)
+        pending = [name for name, needed in self.plan(targets, force) if needed]
+        done = set(self.dependencies(targets)) - set(pending)
+        for name in sorted(done):
+            log('[cached]  {0}'.format(name))
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            while pending or running:
+                # Start every stage whose inputs are ready
+                for name in [name for name in pending if all(i in done for i in self.stages[name].inputs)]:
+                    pending.remove(name)
+                    log('[start]   {0}'.format(name))
+                    running[executor.submit(self._run_stage, name)] = name
+                if not running:
+                    raise RuntimeError('Stages {0} can not be scheduled'.format(pending))
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        seconds = future.result()
+                    except BaseException:
+                        # Let the running stages finish but start no more
+                        pending = []
+                        wait(running)
+                        raise
+                    done.add(name)
+                    log('[done]    {0} ({1:.1f} s)'.format(name, seconds))
+
+        return dict((name, self.artifact_path(name)) for name in self.dependencies(targets))
+
+    def prune(self):
+        """
+        Removes the artifacts in the store that are not the current artifact of
+        any stage, including those of stages no longer in the pipeline (e.g. the
+        features of a scene that is no longer selected), and the stage
+        directories left empty
+
+        :return: number of artifact directories removed
+        """
+
+        store_dir = abspath(self.store_dir)
+        current = set(abspath(self.artifact_path(name)) for name in self.stages)
+        removed = 0
+        for directory, subdirectories, files in walk(store_dir):
+            if MANIFEST_FILE not in files or directory == store_dir:
+                continue
+            # Artifacts are not searched for more artifacts
+            subdirectories[:] = []
+            if directory in current:
+                continue
+            shutil.rmtree(directory)
+            removed += 1
+
+            # Remove the stage directories the artifact was the last entry of
+            parent = dirname(directory)
+            while parent != store_dir and parent.startswith(store_dir) and not listdir(parent):
+                rmdir(parent)
+                parent = dirname(parent)
+        return removed
@@ -0,0 +1,341 @@
+"""
+Opt-in timing spans of the pipeline stages, with counters (bytes read,
+pixels processed, cache hits) and the peak memory of the process, exported as
+JSON or as a Chrome trace (chrome://tracing, Perfetto).
+
+Profiling is off by default and a disabled span costs one flag check. It is
+switched on with enable(), or for a whole script run by setting the
+LANDSATUTIL_PROFILE environment variable to an output path prefix, in which
+case <prefix>.json and <prefix>.trace.json are written when the script exits.
+Only spans of the process that enabled profiling are recorded, work done in
+worker processes is covered by the span around it.
+"""
+
+# Imports
+import atexit
+import json
+import sys
+import threading
+from functools import wraps
+from multiprocessing import parent_process
+from os import environ, getpid
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Constants
+ENVIRONMENT_VARIABLE = 'LANDSATUTIL_PROFILE'
+# Counter pairs reported as a hit rate in the summary
+HIT_COUNTERS = [('cache_hits', 'cache_misses', 'cache_hit_rate')]
+
+# Profiler state
+_enabled = False
+_owner_pid = None
+_origin = 0.0
+_records = []
+_records_lock = threading.Lock()
+_local = threading.local()
+
+
+def peak_rss():
+    """
+    :return: peak resident set size of the process in bytes, or None where it
+             is not available
+    """
+
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return usage if sys.platform == 'darwin' else usage*1024
+
+
+class Span(object):
+
+    def __init__(self, name, attributes):
+        """
+        A timed region of code, created by span()
+
+        :param name: name of the stage (e.g. 'scene.band_subimage')
+        :param attributes: dictionary of descriptive values (e.g. the scene id)
+        :return: Span object
+        """
+
+        self.name = name
+        self.attributes = attributes
+        self.counters = {}
+        self.start = None
+        self.depth = 0
+
+    def add(self, **counters):
+        """
+        Adds to the counters of the span (e.g. bytes_read=..., pixels=...)
+        """
+
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, **attributes):
+        """
+        Sets descriptive attributes of the span
+        """
+
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.depth = len(stack)
+        stack.append(self)
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = perf_counter() - self.start
+        _local.stack.pop()
+        record = {
+            'name': self.name,
+            'start': self.start - _origin,
+            'duration': duration,
+            'depth': self.depth,
+            'pid': getpid(),
+            'thread': threading.get_ident(),
+            'peak_rss': peak_rss(),
+            'counters': self.counters,
+            'attributes': self.attributes,
+        }
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        with _records_lock:
+            _records.append(record)
+        return False
+
+
+class _NullSpan(object):
+    """
+    Span returned while profiling is disabled, it records nothing
+    """
+
+    def add(self, **counters):
+        pass
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, **attributes):
+    """
+    Times a region of code:
+
+        with profiling.span('zonal.zonal_stats') as stage:
+            ...
+            stage.add(pixels=labels.size)
+
+    :param name: name of the stage
+    :param attributes: descriptive values stored with the span
+    :return: context manager (a shared no-op object when profiling is disabled)
+    """
+
+    if not _enabled or getpid() != _owner_pid:
+        return _NULL_SPAN
+    return Span(name, attributes)
+
+
+def current():
+    """
+    Innermost open span of the calling thread, so a function timed with
+    profiled() can add counters to its own span
+
+    :return: Span (a shared no-op object when profiling is disabled or no span is open)
+    """
+
+    if not _enabled:
+        return _NULL_SPAN
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else _NULL_SPAN
+
+
+def profiled(name):
+    """
+    Decorator timing every call of a function as a span
+
+    :param name: name of the stage
+    :return: decorator
+    """
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def enable():
+    """
+    Starts recording spans (of this process)
+    """
+
+    global _enabled, _owner_pid, _origin
+    if not _enabled:
+        _owner_pid = getpid()
+        if not _records:
+            _origin = perf_counter()
+        _enabled = True
+
+
+def disable():
+    """
+    Stops recording spans, the recorded spans are kept
+    """
+
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """
+    Removes the recorded spans
+    """
+
+    global _origin
+    with _records_lock:
+        del _records[:]
+    _origin = perf_counter()
+
+
+def records():
+    """
+    :return: list of the recorded spans (dictionaries) in the order they ended
+    """
+
+    with _records_lock:
+        return list(_records)
+
+
+def summary():
+    """
+    Totals of the recorded spans by stage name
+
+    :return: dictionary of name -> dictionary with the 'count', 'total', 'mean'
+             and 'max' time (seconds), the summed counters, cache hit rates, and
+             the 'peak_rss' reached by the end of the stage
+    """
+
+    stages = {}
+    for record in records():
+        stage = stages.setdefault(record['name'], {
+            'count': 0, 'total': 0.0, 'max': 0.0, 'peak_rss': None, 'counters': {}
+        })
+        stage['count'] += 1
+        stage['total'] += record['duration']
+        stage['max'] = max(stage['max'], record['duration'])
+        if record['peak_rss'] is not None:
+            stage['peak_rss'] = max(stage['peak_rss'] or 0, record['peak_rss'])
+        for key, value in record['counters'].items():
+            stage['counters'][key] = stage['counters'].get(key, 0) + value
+
+    for stage in stages.values():
+        stage['mean'] = stage['total']/stage['count']
+        counters = stage['counters']
+        for hits, misses, rate in HIT_COUNTERS:
+            lookups = counters.get(hits, 0) + counters.get(misses, 0)
+            if lookups:
+                counters[rate] = counters.get(hits, 0)/lookups
+        seconds = stage['total']
+        if seconds > 0 and 'bytes_read' in counters:
+            counters['bytes_per_second'] = counters['bytes_read']/seconds
+        if seconds > 0 and 'pixels' in counters:
+            counters['pixels_per_second'] = counters['pixels']/seconds
+    return stages
+
+
+def format_summary():
+    """
+    :return: table of the summary as text, slowest stages first
+    """
+
+    lines = ['{0:<32} {1:>7} {2:>11} {3:>11} {4:>10}'.format('stage', 'calls', 'total (s)', 'mean (s)',
+                                                           'peak MB')]
+    stages = summary()
+    for name in sorted(stages, key=lambda name: -stages[name]['total']):
+        stage = stages[name]
+        peak = '' if stage['peak_rss'] is None else '{0:.0f}'.format(stage['peak_rss']/2**20)
+        lines.append('{0:<32} {1:>7d} {2:>11.4f} {3:>11.5f} {4:>10}'.format(
+            name, stage['count'], stage['total'], stage['mean'], peak
+        ))
+    return '\n'.join(lines)
+
+
+def write_json(path):
+    """
+    Writes the recorded spans and their summary to a JSON file
+
+    :param path: output file path
+    """
+
+    with open(path, 'w') as output_file:
+        json.dump({'summary': summary(), 'spans': records()}, output_file, indent=1, default=str)
+
+
+def write_chrome_trace(path):
+    """
+    Writes the recorded spans in the Chrome trace event format, the counters
+    and attributes of a span are shown as its arguments
+
+    :param path: output file path
+    """
+
+    events = []
+    for record in records():
+        args = dict(record['attributes'])
+        args.update(record['counters'])
+        if record['peak_rss'] is not None:
+            args['peak_rss'] = record['peak_rss']
+        events.append({
+            'name': record['name'],
+            'cat': record['name'].split('.')[0],
+            'ph': 'X',
+            'ts': record['start']*1e6,
+            'dur': record['duration']*1e6,
+            'pid': record['pid'],
+            'tid': record['thread'],
+            'args': args,
+        })
+    with open(path, 'w') as output_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, output_file, default=str)
+
+
+def _write_at_exit(prefix):
+    if getpid() != _owner_pid or not _records:
+        return
+    write_json(prefix + '.json')
+    write_chrome_trace(prefix + '.trace.json')
+    print(format_summary(), file=sys.stderr)
+
+
+# Profile the whole run when the environment asks for it (worker processes
+# inherit the environment but do not record)
+if environ.get(ENVIRONMENT_VARIABLE) and parent_process() is None:
+    enable()
+    atexit.register(_write_at_exit, environ[ENVIRONMENT_VARIABLE])
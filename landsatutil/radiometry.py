@@ -0,0 +1,170 @@
+"""
+Radiometric conversion of Landsat digital numbers to radiance, top of
+atmosphere reflectance and brightness temperature, done in place on a single
+array of the requested data type
+"""
+
+# Imports
+from datetime import date
+from numpy import pi, cos, sin, log, divide, multiply, add, empty, errstate, float32
+
+# Constants
+PRODUCTS = ('dn', 'radiance', 'reflectance')
+
+# Exo-atmospheric solar irradiance (W/(m^2 sr um)) of the reflective bands,
+# used when the metadata has no reflectance rescaling coefficients (Chander et al. 2009)
+ESUN = {
+    'LANDSAT_4': {1: 1983.0, 2: 1795.0, 3: 1539.0, 4: 1028.0, 5: 219.8, 7: 83.49},
+    'LANDSAT_5': {1: 1983.0, 2: 1796.0, 3: 1536.0, 4: 1031.0, 5: 220.0, 7: 83.44},
+    'LANDSAT_7': {1: 1997.0, 2: 1812.0, 3: 1533.0, 4: 1039.0, 5: 230.8, 7: 84.90, 8: 1362.0},
+}
+
+# Thermal band calibration constants (K1 in W/(m^2 sr um), K2 in kelvin)
+THERMAL_CONSTANTS = {
+    'LANDSAT_4': {6: (671.62, 1284.30)},
+    'LANDSAT_5': {6: (607.76, 1260.56)},
+    'LANDSAT_7': {6: (666.09, 1282.71)},
+    'LANDSAT_8': {10: (774.8853, 1321.0789), 11: (480.8883, 1201.1442)},
+}
+
+
+def _spacecraft(metadata):
+    return metadata.get('PRODUCT_METADATA/SPACECRAFT_ID', 'LANDSAT_5')
+
+
+def earth_sun_distance(day_of_year):
+    """
+    Approximate earth to sun distance
+
+    :param day_of_year: day of the year (1 to 366)
+    :return: distance in astronomical units
+    """
+
+    return 1 - 0.01672*cos((0.9856*(day_of_year - 4))*(pi/180.0))
+
+
+def is_thermal(metadata, band):
+    """
+    :return: true if the band of the scene is a thermal band
+    """
+
+    return band in THERMAL_CONSTANTS.get(_spacecraft(metadata), {})
+
+
+def radiance_coefficients(metadata, band):
+    """
+    Gain and bias converting digital numbers of a band to radiance
+
+    :param metadata: scene metadata dictionary
+    :param band: band number
+    :return: (gain, bias) with radiance = gain*dn + bias
+    """
+
+    return (float(metadata['RADIOMETRIC_RESCALING/RADIANCE_MULT_BAND_{0:d}'.format(band)]),
+            float(metadata['RADIOMETRIC_RESCALING/RADIANCE_ADD_BAND_{0:d}'.format(band)]))
+
+
+def reflectance_coefficients(metadata, band):
+    """
+    Gain and bias converting digital numbers of a reflective band to top of
+    atmosphere reflectance corrected for the sun elevation. The rescaling
+    coefficients in the metadata are used when present, otherwise they are
+    derived from the radiance coefficients, the solar irradiance of the band
+    and the earth to sun distance.
+
+    :param metadata: scene metadata dictionary
+    :param band: band number
+    :return: (gain, bias) with reflectance = gain*dn + bias
+    """
+
+    if is_thermal(metadata, band):
+        raise ValueError('Band {0:d} is a thermal band and has no reflectance'.format(band))
+
+    sun_elevation = float(metadata['IMAGE_ATTRIBUTES/SUN_ELEVATION'])*(pi/180.0)
+    mult_key = 'RADIOMETRIC_RESCALING/REFLECTANCE_MULT_BAND_{0:d}'.format(band)
+    add_key = 'RADIOMETRIC_RESCALING/REFLECTANCE_ADD_BAND_{0:d}'.format(band)
+    if mult_key in metadata:
+        gain, bias = float(metadata[mult_key]), float(metadata[add_key])
+    else:
+        if 'IMAGE_ATTRIBUTES/EARTH_SUN_DISTANCE' in metadata:
+            distance = float(metadata['IMAGE_ATTRIBUTES/EARTH_SUN_DISTANCE'])
+        else:
+            acquired = date(*[int(x) for x in metadata['PRODUCT_METADATA/DATE_ACQUIRED'].split('-')])
+            distance = earth_sun_distance(acquired.timetuple().tm_yday)
+        scale = pi*distance**2/ESUN[_spacecraft(metadata)][band]
+        gain, bias = radiance_coefficients(metadata, band)
+        gain, bias = gain*scale, bias*scale
+
+    return gain/sin(sun_elevation), bias/sin(sun_elevation)
+
+
+def thermal_constants(metadata, band):
+    """
+    :return: (K1, K2) calibration constants of a thermal band, from the metadata
+             when present
+    """
+
+    for group in ('TIRS_THERMAL_CONSTANTS', 'THERMAL_CONSTANTS'):
+        k1_key = '{0}/K1_CONSTANT_BAND_{1:d}'.format(group, band)
+        if k1_key in metadata:
+            return float(metadata[k1_key]), float(metadata['{0}/K2_CONSTANT_BAND_{1:d}'.format(group, band)])
+    return THERMAL_CONSTANTS[_spacecraft(metadata)][band]
+
+
+def linear_convert(dn, gain, bias, dtype=float32, out=None):
+    """
+    Computes gain*dn + bias allocating at most one array of the output type
+
+    :param dn: array of digital numbers
+    :param gain: gain
+    :param bias: bias
+    :param dtype: output data type (used when out is not given)
+    :param out: optional output array, may be dn itself if it has a floating point type
+    :return: converted array
+    """
+
+    if out is None:
+        out = empty(dn.shape, dtype=dtype)
+    if out is not dn:
+        out[...] = dn
+    multiply(out, out.dtype.type(gain), out=out)
+    add(out, out.dtype.type(bias), out=out)
+    return out
+
+
+def calibrate(dn, metadata, band, product='radiance', dtype=float32, out=None):
+    """
+    Converts the digital numbers of a band to a radiometric product. The
+    'reflectance' product is top of atmosphere reflectance for the reflective
+    bands and brightness temperature (kelvin) for the thermal bands.
+
+    :param dn: array of digital numbers
+    :param metadata: scene metadata dictionary
+    :param band: band number
+    :param product: one of 'dn', 'radiance' or 'reflectance'
+    :param dtype: output data type (used when out is not given)
+    :param out: optional output array, may be dn itself if it has a floating point type
+    :return: converted array
+    """
+
+    if product == 'dn':
+        if out is None:
+            out = empty(dn.shape, dtype=dtype)
+        if out is not dn:
+            out[...] = dn
+        return out
+    elif product == 'radiance' or (product == 'reflectance' and is_thermal(metadata, band)):
+        out = linear_convert(dn, *radiance_coefficients(metadata, band), dtype=dtype, out=out)
+        if product == 'reflectance':
+            # Brightness temperature K2/ln(K1/L + 1), zero where there is no radiance
+            k1, k2 = thermal_constants(metadata, band)
+            with errstate(divide='ignore', invalid='ignore'):
+                divide(out.dtype.type(k1), out, out=out)
+                add(out, 1, out=out)
+                log(out, out=out)
+                divide(out.dtype.type(k2), out, out=out)
+        return out
+    elif product == 'reflectance':
+        return linear_convert(dn, *reflectance_coefficients(metadata, band), dtype=dtype, out=out)
+    else:
+        raise ValueError('Unknown radiometric product {0}'.format(product))
@@ -0,0 +1,235 @@
+"""
+Streaming per-pixel reducers for stacks of co-registered images
+"""
+
+# Imports
+from numpy import zeros, empty, full, inf, nan, clip, floor, argmax, int_, uint32
+from numpy import add, subtract, multiply, divide, minimum, maximum, where, sqrt
+
+from . import profiling
+
+
+class Reducer(object):
+    """
+    Base class for reducers that consume a stack of images one frame at a
+    time, updating per-pixel accumulators in place. If frames of different
+    shape are given the accumulators are cropped to the common (top left)
+    extent, in the same way collect_bands truncates its images.
+    """
+
+    def __init__(self):
+        self.shape = None
+
+    def _allocate(self, shape):
+        """
+        Creates the accumulators for frames of the given shape
+
+        :param shape: frame shape
+        """
+
+        raise NotImplementedError
+
+    def _crop(self, shape):
+        """
+        Crops the accumulators (as views) to the given shape
+
+        :param shape: new frame shape
+        """
+
+        for name, value in vars(self).items():
+            if name != 'shape' and hasattr(value, 'ndim') and value.shape[-2:] == self.shape:
+                setattr(self, name, value[..., 0:shape[0], 0:shape[1]])
+
+    def _fit(self, image, valid):
+        """
+        Makes the accumulators and the frame the same shape
+
+        :param image: frame
+        :param valid: frame validity mask
+        :return: (image, valid) cropped to the accumulator shape
+        """
+
+        if self.shape is None:
+            self.shape = image.shape
+            self._allocate(image.shape)
+        elif image.shape != self.shape:
+            shape = (min(image.shape[0], self.shape[0]), min(image.shape[1], self.shape[1]))
+            if shape != self.shape:
+                self._crop(shape)
+                self.shape = shape
+        return image[0:self.shape[0], 0:self.shape[1]], valid[0:self.shape[0], 0:self.shape[1]]
+
+    def update(self, image, valid):
+        """
+        Adds a frame to the reduction
+
+        :param image: 2D numpy array
+        :param valid: 2D boolean numpy array, false for pixels to leave out (nodata)
+        """
+
+        raise NotImplementedError
+
+    def result(self):
+        """
+        :return: dictionary of statistic name -> 2D numpy array
+        """
+
+        raise NotImplementedError
+
+
+class CountReducer(Reducer):
+    """
+    Number of valid frames at each pixel
+    """
+
+    def _allocate(self, shape):
+        self.count = zeros(shape, dtype=uint32)
+
+    def update(self, image, valid):
+        image, valid = self._fit(image, valid)
+        add(self.count, valid, out=self.count, casting='unsafe')
+
+    def result(self):
+        return {'count': self.count}
+
+
+class MeanVarianceReducer(Reducer):
+    """
+    Per-pixel mean and variance of the valid frames using Welford's online
+    update. Pixels with no valid frames have a mean and variance of fill_value.
+    """
+
+    def __init__(self, fill_value=0.0):
+        Reducer.__init__(self)
+        self.fill_value = fill_value
+
+    def _allocate(self, shape):
+        self.count = zeros(shape, dtype=uint32)
+        self.mean = zeros(shape)
+        self.m2 = zeros(shape)
+        self._delta = empty(shape)
+        self._scratch = empty(shape)
+
+    def update(self, image, valid):
+        image, valid = self._fit(image, valid)
+        add(self.count, 1, out=self.count, where=valid)
+        subtract(image, self.mean, out=self._delta)
+        divide(self._delta, self.count, out=self._scratch, where=valid)
+        add(self.mean, self._scratch, out=self.mean, where=valid)
+        subtract(image, self.mean, out=self._scratch)
+        multiply(self._delta, self._scratch, out=self._scratch)
+        add(self.m2, self._scratch, out=self.m2, where=valid)
+
+    def result(self):
+        has_data = self.count > 0
+        variance = full(self.shape, self.fill_value)
+        divide(self.m2, self.count, out=variance, where=has_data)
+        return {
+            'count': self.count,
+            'mean': where(has_data, self.mean, self.fill_value),
+            'var': variance,
+            'std': where(has_data, sqrt(variance), self.fill_value),
+        }
+
+
+class MinMaxReducer(Reducer):
+    """
+    Per-pixel minimum and maximum of the valid frames (nan where there are none)
+    """
+
+    def _allocate(self, shape):
+        self.min = full(shape, inf)
+        self.max = full(shape, -inf)
+
+    def update(self, image, valid):
+        image, valid = self._fit(image, valid)
+        minimum(self.min, image, out=self.min, where=valid)
+        maximum(self.max, image, out=self.max, where=valid)
+
+    def result(self):
+        return {
+            'min': where(self.min == inf, nan, self.min),
+            'max': where(self.max == -inf, nan, self.max),
+        }
+
+
+class PercentileReducer(Reducer):
+    """
+    Approximate per-pixel percentiles from a fixed-bin histogram sketch kept
+    for every pixel. Values are clipped to value_range, and the error of each
+    percentile is at most half a bin width. Memory use is bins counters per
+    pixel, so large stacks should be reduced tile by tile.
+    """
+
+    def __init__(self, percentiles=(50,), value_range=(0.0, 256.0), bins=256):
+        Reducer.__init__(self)
+        self.percentiles = percentiles
+        self.value_range = value_range
+        self.bins = bins
+        self.bin_width = (value_range[1] - value_range[0])/bins
+
+    def _allocate(self, shape):
+        self.histogram = zeros((self.bins,) + shape, dtype=uint32)
+        self.count = zeros(shape, dtype=uint32)
+
+    def update(self, image, valid):
+        image, valid = self._fit(image, valid)
+        add(self.count, 1, out=self.count, where=valid)
+
+        # Each pixel lands in exactly one bin so a plain fancy index add is safe
+        bin_index = clip(int_(floor((image - self.value_range[0])/self.bin_width)), 0, self.bins - 1)
+        rows, cols = valid.nonzero()
+        self.histogram[bin_index[rows, cols], rows, cols] += 1
+
+    def result(self):
+        results = {}
+        cumulative = self.histogram.cumsum(axis=0)
+        has_data = self.count > 0
+        for percentile in self.percentiles:
+            # First bin where the cumulative count reaches the percentile rank
+            target = self.count*(percentile/100.0)
+            bin_index = argmax(cumulative >= target[None, :, :], axis=0)
+            value = self.value_range[0] + (bin_index + 0.5)*self.bin_width
+            name = 'median' if percentile == 50 else 'p{0:g}'.format(percentile)
+            results[name] = where(has_data, value, nan)
+        return results
+
+
+@profiling.profiled('reducers.reduce_stack')
+def reduce_stack(frames, reducers):
+    """
+    Feeds a stream of frames through a set of reducers
+
+    :param frames: iterable of (image, valid) pairs, e.g. from temporal.iter_subimages
+    :param reducers: list of Reducer objects
+    :return: dictionary of statistic name -> 2D numpy array from all the reducers
+    """
+
+    num_frames = num_pixels = 0
+    for image, valid in frames:
+        for reducer in reducers:
+            reducer.update(image, valid)
+        num_frames += 1
+        num_pixels += image.size
+    profiling.current().add(frames=num_frames, pixels=num_pixels)
+
+    results = {}
+    for reducer in reducers:
+        results.update(reducer.result())
+    return results
+
+
+def tile_bounds(shape, tile_size):
+    """
+    Splits an image extent into tiles
+
+    :param shape: (rows, cols) of the image
+    :param tile_size: tile edge length in pixels
+    :return: list of (row_start, row_stop, col_start, col_stop) tuples
+    """
+
+    return [
+        (r, min(r + tile_size, shape[0]), c, min(c + tile_size, shape[1]))
+        for r in range(0, shape[0], tile_size)
+        for c in range(0, shape[1], tile_size)
+    ]
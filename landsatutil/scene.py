@@ -3,43 +3,119 @@ Landsat scene extraction data abstraction utilities.
 """
 
 # Imports
-import tarfile
-from numpy import array, abs, float_
+from numpy import array, floor, zeros, full, float32, uint8
+from numpy import dtype as np_dtype
 from numpy import int32 as int_
-from skimage.io import imread
-from os.path import isdir, basename, join
-from os import listdir
+from os.path import abspath
+
+from . import profiling
+from .archive import open_archive, DEFAULT_CACHE_DIR
+from .radiometry import calibrate, radiance_coefficients
 
 # Constants
 TMP_DIR = 'tmp'
 
+# Scenes that have already been opened, keyed by absolute archive path
+_open_scenes = {}
+
+
+def open_scene(archive_path, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Gets the LandsatScene for an archive, only creating it (and parsing the
+    metadata) the first time the archive is opened
+
+    :param archive_path: path to the archive
+    :param cache_dir: directory to extract members of compressed archives to (see archive.LandsatArchive)
+    :return: LandsatScene object
+    """
+
+    key = abspath(archive_path)
+    if key not in _open_scenes:
+        _open_scenes[key] = LandsatScene(archive_path, cache_dir=cache_dir)
+    return _open_scenes[key]
+
+
+def clip_window(row_start, row_stop, col_start, col_stop, shape):
+    """
+    Splits a pixel window into the part that lies inside an image
+
+    :param row_start: first row of the window (may be negative)
+    :param row_stop: row after the last row of the window (may be past the image)
+    :param col_start: first column of the window
+    :param col_stop: column after the last column of the window
+    :param shape: (rows, cols) of the image
+    :return: ((row_start, row_stop, col_start, col_stop) of the part in the image,
+             (row slice, col slice) of where it goes in the window), the part is
+             empty when the window does not overlap the image
+    """
+
+    # Clamp the bounds to the image, an empty part starts and stops at the same place
+    first_row = min(max(row_start, 0), shape[0])
+    last_row = max(min(row_stop, shape[0]), first_row)
+    first_col = min(max(col_start, 0), shape[1])
+    last_col = max(min(col_stop, shape[1]), first_col)
+
+    placement = (slice(max(first_row - row_start, 0), max(last_row - row_start, 0)),
+                 slice(max(first_col - col_start, 0), max(last_col - col_start, 0)))
+    return (first_row, last_row, first_col, last_col), placement
+
+
+def parse_metadata(md_lines):
+    """
+    Extract contents of a metadata (MTL) file into a dictionary keyed by
+    'GROUP/PARAMETER'
+
+    :param md_lines: iterable of the lines of the metadata file
+    :return: dictionary of metadata values (as strings)
+    """
+
+    # Create Empty Dictionary
+    metadata = {}
+    # Set group to None
+    group = 'NONE'
+
+    # Extract data from each line
+    for line in md_lines:
+        line_items = line.split('=')
+        if len(line_items) != 2:
+            continue
+        param = line_items[0].strip(' \"\n')
+        value = line_items[1].strip(' \"\n')
+
+        if param == 'GROUP':
+            group = value
+        elif param == 'END_GROUP':
+            pass
+        else:
+            metadata['{0}/{1}'.format(group, param)] = value
+
+    return metadata
+
 
 class LandsatScene(object):
 
-    def __init__(self, archive_path):
+    def __init__(self, archive_path, cache_dir=DEFAULT_CACHE_DIR):
         """
-        Create a LandsatScene object from a Landsat data product archive
+        Create a LandsatScene object from a Landsat data product archive. The
+        archive is not extracted, the metadata and bands are read from it as
+        they are needed (an earlier extraction in TMP_DIR is used if present).
 
         :param archive_path: path to the archive
+        :param cache_dir: directory to extract members of compressed archives to (see archive.LandsatArchive)
         :return: LandsatScene object
         """
 
-        # Check if the archive has already been extracted
-        self.archive_name = join(TMP_DIR, basename(archive_path).split('.')[0])
-        if not isdir(self.archive_name):
-            archive = tarfile.open(archive_path)
-            archive.extractall(self.archive_name)
-            archive.close()
-
-        # Open the archive
-        file_list = listdir(self.archive_name)
-        try:
-            self.metadata_file = [name for name in file_list if 'MTL.txt' in name][0]
-        except IndexError:
-            print('Could not find metadata file in archive')
+        with profiling.span('scene.open', archive=archive_path):
+            # Open the archive
+            self.archive = open_archive(archive_path, extracted_dir=TMP_DIR, cache_dir=cache_dir)
+            self.archive_name = self.archive.name
+            try:
+                self.metadata_file = self.archive.find_member('MTL.txt')
+            except KeyError:
+                print('Could not find metadata file in archive')
 
-        # Read the metadata file
-        self._read_metadata()
+            # Read the metadata file
+            self._read_metadata()
 
         # Get the scene id
         self.scene_id = self.metadata['METADATA_FILE_INFO/LANDSAT_SCENE_ID']
@@ -76,19 +152,14 @@ class LandsatScene(object):
         n = 1
         self.band_correction = [lambda x: 0]
         while True:
-            # Get the key names
-            data_mult_key = 'RADIOMETRIC_RESCALING/RADIANCE_MULT_BAND_{0:d}'.format(n)
-            data_add_key = 'RADIOMETRIC_RESCALING/RADIANCE_ADD_BAND_{0:d}'.format(n)
-
             # Make sure that the key name exists
-            if data_mult_key not in self.metadata.keys():
+            if 'RADIOMETRIC_RESCALING/RADIANCE_MULT_BAND_{0:d}'.format(n) not in self.metadata:
                 break
-                print(data_mult_key)
 
-            # create coefficients for linear equation m*x + b
-            m = float(self.metadata[data_mult_key])
-            b = float(self.metadata[data_add_key])
-            self.band_correction.append(lambda x: m*x + b)
+            # create coefficients for linear equation m*x + b, bound now so
+            # every band keeps its own coefficients
+            m, b = radiance_coefficients(self.metadata, n)
+            self.band_correction.append(lambda x, m=m, b=b: m*x + b)
 
             n += 1
 
@@ -111,67 +182,96 @@ class LandsatScene(object):
         Extract contents of metadata file into a dictionary
         """
 
-        # Create Empty Dictionary
-        self.metadata = {}
-        # Set group to None
-        group = 'NONE'
-
-        # Open the data file
-        md_file = open(join(self.archive_name, self.metadata_file), 'r')
-
-        # Extract data from each line
-        for line in md_file:
-            line_items = line.split('=')
-            if len(line_items) != 2:
-                continue
-            param = line_items[0].strip(' \"\n')
-            value = line_items[1].strip(' \"\n')
-
-            if param == 'GROUP':
-                group = value
-            elif param == 'END_GROUP':
-                pass
-            else:
-                self.metadata['{0}/{1}'.format(group, param)] = value
+        # Read the data file
+        md_lines = self.archive.read_member(self.metadata_file).decode('ascii', 'replace').splitlines()
+        self.metadata = parse_metadata(md_lines)
 
     def coords_to_pixel(self, coords):
         """
         Function for interpolating the pixel location of the given UTM coordinates
 
         :param coords: array with [x, y] coordinates (meters)
-        :return: pixel coordinates as an array [r, c]
+        :return: pixel coordinates as an array [c, r], negative or past the image
+                 size for coordinates outside the scene
         """
 
-        # Divide Through by Pixel Size and subtract offset
-        # negative values in the y must be flipped as image and utm y coordinates
-        # are in opposite directions
-        pixel_coords = abs(coords/self.pixel_size - self.coords[0, :])
+        # Divide Through by Pixel Size and subtract offset, the y offset is
+        # negated as image and utm y coordinates are in opposite directions
+        pixel_coords = (array(coords, dtype=float)/self.pixel_size - self.coords[0, :])*array([1, -1])
+
+        return int_(floor(pixel_coords))
 
-        return int_(pixel_coords)
+    def calibrate(self, dn, band, product='radiance', dtype=float32, out=None):
+        """
+        Converts digital numbers of a band of this scene (see radiometry.calibrate)
 
-    def get_band_subimage(self, band, nw_coords, se_coords, convert=True):
+        :param dn: array of digital numbers
+        :param band: Band of interest
+        :param product: one of 'dn', 'radiance' or 'reflectance'
+        :param dtype: output data type (used when out is not given)
+        :param out: optional output array, may be dn itself to convert in place
+        :return: converted array
+        """
+
+        with profiling.span('scene.calibrate', product=product) as stage:
+            stage.add(pixels=dn.size)
+            return calibrate(dn, self.metadata, band, product=product, dtype=dtype, out=out)
+
+    def get_band_subimage(self, band, nw_coords, se_coords, convert=True, cache=None, dtype=float32):
         """
         Gets a sub-image from the specified band from the north west coordinates
-        to the south east coordinates.
+        to the south east coordinates. Parts of the window outside the scene are
+        filled with the nodata value (zero digital numbers), as at the scene edges.
 
         :param band: Band of interest (1: blue, 2: green, etc)
         :param nw_coords: North west coordinates in UTM (meters)
         :param se_coords: South east coordinates in UTM (meters)
-        :param convert: If true, converts the image to radiance
+        :param convert: If true, converts the image to radiance, may also be one of
+                        the radiometry products ('dn', 'radiance' or 'reflectance')
+        :param cache: optional BandCache, if given the whole band is decoded once
+                      and kept so later subimages of the same band are sliced from it
+        :param dtype: data type of the returned image
         :return: Scene subimage at at the desired coordinates as numpy float array
         """
-        # Read the file
-        image_file = '{0}/{1}/{1}_B{2:d}.TIF'.format(TMP_DIR, self.scene_id, band)
-        band_image = float_(imread(image_file))
+        # Band image member and radiometric product
+        image_member = self.archive.find_member('_B{0:d}.TIF'.format(band))
+        if convert is True or convert is False:
+            product = 'radiance' if convert else 'dn'
+        else:
+            product = convert
 
         # Get pixel coordinates
         nw_pixel = self.coords_to_pixel(nw_coords)
         se_pixel = self.coords_to_pixel(se_coords)
+        shape = (max(se_pixel[1] - nw_pixel[1], 0), max(se_pixel[0] - nw_pixel[0], 0))
+        inside, placement = clip_window(nw_pixel[1], se_pixel[1], nw_pixel[0], se_pixel[0],
+                                        (self.image_size[1], self.image_size[0]))
 
-        # Truncate
-        subimage = band_image[nw_pixel[1]:se_pixel[1], nw_pixel[0]:se_pixel[0]]
-        # Convert to radiance if needed
-        if convert:
-            return self.band_correction[band](subimage)
-        else:
-            return subimage
+        with profiling.span('scene.band_subimage', scene=self.scene_id, band=band) as stage:
+            stage.add(pixels=shape[0]*shape[1])
+
+            # Slice the window out of the cached band
+            if cache is not None:
+                def load_band():
+                    return self.calibrate(self.archive.open_tiff(image_member).read(), band, product, dtype)
+
+                misses = cache.misses
+                band_image = cache.get_or_load((self.scene_id, band, product, np_dtype(dtype).str), load_band)
+                stage.add(cache_hits=int(cache.misses == misses), cache_misses=int(cache.misses != misses))
+                part = band_image[inside[0]:inside[1], inside[2]:inside[3]]
+                if part.shape == shape:
+                    return part.copy()
+                nodata = self.calibrate(zeros(1, dtype=uint8), band, product, band_image.dtype)[0]
+                subimage = full(shape, nodata, dtype=band_image.dtype)
+                subimage[placement] = part
+                return subimage
+
+            # Truncate, decoding only the part of the image inside the window, and
+            # convert it into a single array of the output type
+            band_image = self.archive.open_tiff(image_member)
+            part = band_image.read_window(*inside)
+            if part.shape == shape:
+                return self.calibrate(part, band, product, dtype)
+            subimage = zeros(shape, dtype=part.dtype)
+            subimage[placement] = part
+            return self.calibrate(subimage, band, product, dtype)
@@ -1,8 +1,91 @@
 """
 Utilities for segmenting features from landsat data
 """
-from numpy import cos, sin, pi, int_
-from skimage.draw import line
+from concurrent.futures import ProcessPoolExecutor
+from numpy import cos, sin, pi, int_, abs, sign, asarray, arange, concatenate, atleast_1d, zeros
+from skimage.transform import hough_line, hough_line_peaks
+
+from . import profiling
+
+# Record type of the lines found by separate_fields
+LINE_DTYPE = [
+    ('stride', int_),
+    ('row', int_),
+    ('col', int_),
+    ('rows', int_),
+    ('cols', int_),
+    ('dist', float),
+    ('theta', float),
+]
+
+
+def _line_pixels(starts, stops, length, thickness):
+    """
+    Rasterizes a batch of lines that all run the full length of one axis
+
+    :param starts: minor axis coordinate of each line at major coordinate 0
+    :param stops: minor axis coordinate of each line at major coordinate length
+    :param length: extent of the major axis
+    :param thickness: line thickness in pixels (along the minor axis)
+    :return: (major, minor) coordinate arrays of every pixel of every line
+    """
+
+    # Minor axis steps rounded half up from the start, as Bresenham's algorithm does
+    steps = arange(length + 1)
+    major = steps[None, :].repeat(starts.size, axis=0)
+    extent = stops - starts
+    minor = starts[:, None] + sign(extent)[:, None] * \
+        ((2*abs(extent)[:, None]*steps[None, :] + length) // (2*length))
+
+    # Widen the lines across the minor axis
+    widths = arange(thickness) - thickness//2
+    major = major[:, :, None].repeat(thickness, axis=2).ravel()
+    minor = (minor[:, :, None] + widths).ravel()
+
+    return major, minor
+
+
+def draw_hough_lines(image, dist, theta, color=0, thickness=1, offset=(0, 0), shape=None):
+    """
+    Draws a batch of lines described by the hough transform to an image
+
+    :param image: Image to draw on
+    :param dist: array of hough transform distances
+    :param theta: array of hough transform angles
+    :param color: intensity to draw the lines
+    :param thickness: line thickness in pixels
+    :param offset: (row, col) position in the image of the origin of the hough
+                   transform, so lines found in a tile can be drawn in global coordinates
+    :param shape: (rows, cols) extent of the hough transform input, the lines are
+                  clipped to it (default: the image from offset to its end)
+    """
+
+    dist = atleast_1d(asarray(dist, dtype=float))
+    theta = atleast_1d(asarray(theta, dtype=float))
+    if shape is None:
+        shape = (image.shape[0] - offset[0], image.shape[1] - offset[1])
+    rows, cols = shape
+
+    # Find the x (col) intercepts of the near vertical lines
+    vertical = abs(theta) < pi/4
+    x0 = int_(dist[vertical]/cos(theta[vertical]))
+    x1 = int_(x0 - rows * sin(theta[vertical]))
+    r_vertical, c_vertical = _line_pixels(x0, x1, rows, thickness)
+
+    # Find the y (row) intercepts of the rest
+    y0 = int_(dist[~vertical]/sin(theta[~vertical]))
+    y1 = int_(y0 + cols * cos(theta[~vertical]))
+    c_horizontal, r_horizontal = _line_pixels(y0, y1, cols, thickness)
+
+    r = concatenate([r_vertical, r_horizontal])
+    c = concatenate([c_vertical, c_horizontal])
+
+    # Keep the points inside the hough transform extent and the image and draw them
+    inside = (r >= 0) & (c >= 0) & (r < rows) & (c < cols)
+    r = r[inside] + offset[0]
+    c = c[inside] + offset[1]
+    inside = (r >= 0) & (c >= 0) & (r < image.shape[0]) & (c < image.shape[1])
+    image[r[inside], c[inside]] = color
 
 
 def draw_hough_line(image, dist, theta, color=0):
@@ -15,24 +98,104 @@ def draw_hough_line(image, dist, theta, color=0):
     :param color: intensity to draw line
     """
 
-    rows, cols = image.shape
+    draw_hough_lines(image, [dist], [theta], color=color)
 
-    if abs(theta) < pi/4:
-        # Find the x (col) intercepts
-        x0 = int_(dist/cos(theta))
-        x1 = int_(x0 - rows * sin(theta))
-        intercepts = (0, x0, rows, x1)
 
+def _find_tile_lines(task):
+    """
+    Finds the near horizontal and vertical lines in one tile (run in worker processes)
+
+    :param task: (window, min_distance, threshold, angle_tolerance) tuple
+    :return: (dist, theta) arrays of the lines in window coordinates
+    """
+
+    window, min_distance, threshold, angle_tolerance = task
+    h, theta, d = hough_line(window)
+    h, theta, d = hough_line_peaks(h, theta, d, min_distance=min_distance, threshold=threshold)
+    keep = (abs(theta) < angle_tolerance) | (abs(theta) > ((pi/2) - angle_tolerance))
+    return d[keep], theta[keep]
+
+
+def tile_grid(shape, stride):
+    """
+    Splits an image into roughly stride sized tiles, the last tile in each
+    direction takes up the remainder
+
+    :param shape: (rows, cols) of the image
+    :param stride: tile size in pixels
+    :return: list of (row_start, row_stop, col_start, col_stop) tuples
+    """
+
+    num_row_strides = max(shape[0]//stride, 1)
+    num_col_strides = max(shape[1]//stride, 1)
+    r_stride = shape[0]//num_row_strides
+    c_stride = shape[1]//num_col_strides
+
+    return [
+        (r*r_stride, shape[0] if r == num_row_strides - 1 else (r+1)*r_stride,
+         c*c_stride, shape[1] if c == num_col_strides - 1 else (c+1)*c_stride)
+        for r in range(num_row_strides)
+        for c in range(num_col_strides)
+    ]
+
+
+@profiling.profiled('segmentation.separate_fields')
+def separate_fields(between_fields, field_mask=None, strides=(100, 200, 400), halo=0, workers=1,
+                    min_distance=20, threshold=0, angle_tolerance=0.1, color=0):
+    """
+    Finds the roads between fields as near horizontal and vertical hough
+    lines, tile by tile at several tile sizes, and burns them into the field
+    mask. Each tile is extended by a halo on every side when looking for
+    lines so lines crossing the tile edges are still found, but lines are
+    only drawn inside the tile. Tiles without any candidate pixels are skipped.
+
+    :param between_fields: boolean image of the candidate (non field) pixels
+    :param field_mask: optional image to draw the lines on
+    :param strides: tile sizes in pixels
+    :param halo: number of pixels each tile is extended by for the hough transform
+    :param workers: number of worker processes
+    :param min_distance: minimum distance between hough peaks
+    :param threshold: minimum hough peak intensity
+    :param angle_tolerance: maximum angle of a line from horizontal or vertical (radians)
+    :param color: intensity to draw the lines
+    :return: structured array of the lines with the tile stride, the (row, col)
+             origin and (rows, cols) shape of the window the line was found in,
+             and the hough distance (in window coordinates) and angle
+    """
+
+    rows, cols = between_fields.shape
+
+    # Tiles with their halo windows
+    tiles = []
+    for stride in strides:
+        for row_start, row_stop, col_start, col_stop in tile_grid(between_fields.shape, stride):
+            window = (max(row_start - halo, 0), min(row_stop + halo, rows),
+                      max(col_start - halo, 0), min(col_stop + halo, cols))
+            if between_fields[window[0]:window[1], window[2]:window[3]].any():
+                tiles.append((stride, (row_start, row_stop, col_start, col_stop), window))
+
+    tasks = [(between_fields[w[0]:w[1], w[2]:w[3]], min_distance, threshold, angle_tolerance)
+             for _, _, w in tiles]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            tile_lines = list(executor.map(_find_tile_lines, tasks, chunksize=max(len(tasks)//(4*workers), 1)))
     else:
-        # Find the y (row) intercepts
-        y0 = int_(dist/sin(theta))
-        y1 = int_(y0 + cols * cos(theta))
-        intercepts = (y0, 0, y1, cols)
-
-    r, c = line(*intercepts)
-
-    # Check to make sure each point stays in the image bounds and draw it
-    for n in range(r.size):
-        if r[n] >= 0 and c[n] >= 0:
-            if r[n] < rows and c[n] < cols:
-                image[r[n], c[n]] = color
\ No newline at end of file
+        tile_lines = [_find_tile_lines(task) for task in tasks]
+
+    # Collect the lines and draw them
+    lines = zeros(sum(d.size for d, _ in tile_lines), dtype=LINE_DTYPE)
+    n = 0
+    for (stride, core, window), (d, theta) in zip(tiles, tile_lines):
+        lines[n:n + d.size] = [
+            (stride, window[0], window[2], window[1] - window[0], window[3] - window[2], d_n, theta_n)
+            for d_n, theta_n in zip(d, theta)
+        ]
+        n += d.size
+
+        if field_mask is not None and d.size > 0:
+            draw_hough_lines(field_mask[core[0]:core[1], core[2]:core[3]], d, theta, color=color,
+                             offset=(window[0] - core[0], window[2] - core[2]),
+                             shape=(window[1] - window[0], window[3] - window[2]))
+
+    profiling.current().add(pixels=between_fields.size, tiles=len(tiles), lines=lines.size)
+    return lines
@@ -0,0 +1,329 @@
+"""
+The crop prediction workflow (field mask -> field features -> truth labels
+-> model -> predictions) as stages of an incremental pipeline. Features are
+collated per scene and the crop data is fetched per year, so a new scene or
+season only adds stages and the artifacts of the others are reused.
+"""
+
+# Imports
+import json
+from functools import partial
+from os.path import abspath, dirname, join
+from numpy import array, full, nan, load, save, savez, logical_and, logical_not, bincount, int32
+from pandas import DataFrame, read_csv
+
+from .catalog import SceneCatalog
+from .classification import CropModel, crop_estimator, load_model, predict_fields, burn_predictions
+from .cropscape_tools import CropscapeFetcher, DEFAULT_ENDPOINT, DEFAULT_CACHE_DIR, get_crop_data_years
+from .evaluation import evaluate
+from .features import FeatureStore
+from .fields import field_registry, load_registry
+from .morphology import tiled_morphology, tiled_label
+from .phenology import DEFAULT_GRID, phenology_table
+from .pipeline import Pipeline, Stage
+from .reducers import MeanVarianceReducer, reduce_stack
+from .scene import LandsatScene
+from .segmentation import separate_fields
+from .temporal import NODATA, iter_subimages, compress_temporal_image
+from .truth import align_to_mask, encode_colors, majority_labels, join_truth
+from .zonal import zonal_stats
+
+# Constants
+BAND_COLUMNS = ['b{0:d}_{1}'.format(band, stat) for band in range(1, 8) for stat in ('ref', 'var')]
+DEFAULT_CONFIG = {
+    # UTM coordinates (zone 13) of the very small area
+    'nw_corner': [396210, 4175310],
+    'se_corner': [404460, 4167150],
+    'utm_zone': 13,
+    'pixel_size': 30.0,
+    'mask_archive_dir': 'Bulk Order 397884/L4-5 TM',
+    'mask_years': list(range(2005, 2012)),
+    'archive_dir': 'tmp/',
+    'years': [2008, 2009, 2010, 2011],
+    'min_field_area': 100,
+    'max_field_area': 700,
+    'cdl_endpoint': DEFAULT_ENDPOINT,
+    'cdl_cache': DEFAULT_CACHE_DIR,
+    'min_purity': 0.75,
+    'min_count': 20,
+    'explanatory_variables': ['month'] + BAND_COLUMNS,
+    'outcome_variable': 'CropTruth',
+    'trials': 100,
+    'train_fraction': 0.8,
+    'seed': 0,
+    'phenology_grid': DEFAULT_GRID.tolist(),
+    'phenology_threshold': 0.5,
+}
+TARGETS = ('mask', 'features', 'phenology', 'labels', 'model', 'predictions')
+
+
+def mask_stage(output_dir, inputs, params, workers=1):
+    """
+    Finds the field mask from the temporal average NDVI of the mask scenes
+    (the steps of find_mask.py)
+    """
+
+    nw_corner, se_corner = array(params['nw_corner']), array(params['se_corner'])
+
+    # Temporal average of the red and near infrared bands
+    temporal_bands = {}
+    for band in (3, 4):
+        frames = iter_subimages(params['archives'], band, nw_corner, se_corner, workers=workers)
+        temporal_bands[band] = reduce_stack(frames, [MeanVarianceReducer(fill_value=nan)])['mean']
+    temporal_ndvi = (temporal_bands[4] - temporal_bands[3]) / (temporal_bands[4] + temporal_bands[3])
+    field_mask = compress_temporal_image(temporal_ndvi) >= 10
+
+    # Find the area containing the fields and the roads between them
+    field_area = tiled_morphology(field_mask, [('erosion', 5, 5), ('closing', 50, 50)], workers=workers)
+    between_fields = logical_and(field_area, logical_not(field_mask))
+    road_lines = separate_fields(between_fields, field_mask, strides=[100, 200, 400], halo=20, workers=workers)
+    save(join(output_dir, 'road_lines.npy'), road_lines)
+    field_mask = tiled_morphology(field_mask, [('opening', 1, 5), ('opening', 5, 1)], workers=workers)
+
+    # Label the fields and keep the ones of a plausible size
+    field_mask, _ = tiled_label(field_mask, connectivity=1, workers=workers)
+    area = bincount(field_mask.ravel())
+    keep = (area > params['min_field_area']) & (area < params['max_field_area'])
+    keep[0] = False
+    field_mask[~keep[field_mask]] = 0
+    save(join(output_dir, 'field_mask.npy'), field_mask.astype(int32))
+
+    registry = field_registry(field_mask, nw_corner, params['pixel_size'])
+    registry.save(join(output_dir, 'field_registry.npz'))
+    registry.to_csv(join(output_dir, 'field_props.csv'))
+
+    return {'fields': int(keep.sum()), 'scenes': len(params['archives'])}
+
+
+def scene_features_stage(output_dir, inputs, params):
+    """
+    Statistics of the top of atmosphere reflectance of every field in one
+    scene (one row of collate_crop_data.py per field)
+    """
+
+    field_mask = load(join(inputs['mask'], 'field_mask.npy'))
+    labels = load_registry(join(inputs['mask'], 'field_registry.npz')).labels
+    nw_corner, se_corner = array(params['nw_corner']), array(params['se_corner'])
+
+    # Pixels with no data in any band are left out of every band
+    scene = LandsatScene(params['archive'])
+    scene.archive.extract_members([scene.archive.find_member('_B{0:d}.TIF'.format(band)) for band in range(1, 8)])
+    images = [scene.get_band_subimage(band, nw_corner, se_corner, convert='dn') for band in range(1, 8)]
+    rows = min([field_mask.shape[0]] + [image.shape[0] for image in images])
+    cols = min([field_mask.shape[1]] + [image.shape[1] for image in images])
+    valid = images[0][0:rows, 0:cols] != NODATA
+    for image in images[1:]:
+        valid &= image[0:rows, 0:cols] != NODATA
+
+    columns = {
+        'label': labels,
+        'scene_id': full(labels.size, scene.scene_id, dtype='U32'),
+        'year': full(labels.size, scene.year),
+        'month': full(labels.size, scene.month),
+        'day': full(labels.size, scene.day),
+        'hour': full(labels.size, scene.hour),
+    }
+    for band, image in zip(range(1, 8), images):
+        reflectance = scene.calibrate(image[0:rows, 0:cols], band, 'reflectance')
+        field_stats = zonal_stats(field_mask[0:rows, 0:cols], reflectance, valid=valid, label_list=labels)
+        columns['b{0:d}_ref'.format(band)] = field_stats['mean']
+        columns['b{0:d}_var'.format(band)] = field_stats['var']
+    savez(join(output_dir, 'columns.npz'), **columns)
+    return {'scene_id': scene.scene_id, 'fields': int(labels.size)}
+
+
+def features_stage(output_dir, inputs, params):
+    """
+    Merges the per scene field statistics into one feature store
+    """
+
+    store = FeatureStore(join(output_dir, 'store'))
+    for name in sorted(inputs):
+        if name.startswith('scene_features/'):
+            with load(join(inputs[name], 'columns.npz')) as columns:
+                store.append(dict((column, columns[column]) for column in columns.files))
+    store.compact()
+    store.to_csv(join(output_dir, 'field_data.csv'),
+                 columns=['label', 'year', 'month', 'day', 'hour'] + BAND_COLUMNS, sort_by='label')
+    return {'rows': len(store)}
+
+
+def phenology_stage(output_dir, inputs, params):
+    """
+    Phenology features (NDVI and EVI) of every field and year from the merged
+    field statistics
+    """
+
+    store = FeatureStore(join(inputs['features'], 'store'))
+    columns = store.read(['label', 'year', 'month', 'day'] + ['b{0:d}_ref'.format(band) for band in range(1, 8)])
+    table = {}
+    for index in ('ndvi', 'evi'):
+        table.update(phenology_table(columns, index=index, grid=params['grid'], threshold=params['threshold']))
+    DataFrame(table).to_csv(join(output_dir, 'field_phenology.csv'), index=False)
+    return {'rows': int(table['label'].size)}
+
+
+def cdl_stage(output_dir, inputs, params, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Fetches the Cropland Data Layer of one year on the field mask grid
+    """
+
+    fetcher = CropscapeFetcher(endpoint=params['endpoint'], cache_dir=cache_dir)
+    crop_data = get_crop_data_years(params['shape'], params['utm_zone'], params['nw_corner'], params['se_corner'],
+                                    [params['year']], fetcher=fetcher)[params['year']]
+    save(join(output_dir, 'cdl.npy'), crop_data)
+
+
+def labels_stage(output_dir, inputs, params):
+    """
+    Labels the fields with the majority crop of each year (the steps of label_fields.py)
+    """
+
+    field_mask = load(join(inputs['mask'], 'field_mask.npy'))
+    features = FeatureStore(join(inputs['features'], 'store')).read()
+
+    # The crop of each field is the most common crop color of its pixels (black is no data)
+    truth_tables = {}
+    for name, path in inputs.items():
+        if name.startswith('cdl/'):
+            crop_keys = encode_colors(align_to_mask(load(join(path, 'cdl.npy')), field_mask.shape))
+            truth_tables[int(name.split('/')[1])] = majority_labels(field_mask, crop_keys, ignore=[0])
+
+    labeled = join_truth(features, truth_tables, min_purity=params['min_purity'], min_count=params['min_count'])
+    keep = labeled.pop('has_truth')
+    data_set = DataFrame(dict((name, value[keep]) for name, value in labeled.items()), columns=list(labeled.keys()))
+    data_set.to_csv(join(output_dir, 'field_data_truth.csv'), index=False)
+    return {'rows': int(keep.sum())}
+
+
+def model_stage(output_dir, inputs, params, workers=1):
+    """
+    Evaluates and trains the crop model (the steps of predict_crops.py)
+    """
+
+    data_set = read_csv(join(inputs['labels'], 'field_data_truth.csv'))
+    data_matrix = data_set[params['explanatory_variables']].values
+    outcome_truth = data_set[params['outcome_variable']].values
+
+    summary = {'rows': int(outcome_truth.size)}
+    if params['trials'] > 0:
+        results = evaluate(crop_estimator, data_matrix, outcome_truth, num_trials=params['trials'],
+                           train_fraction=params['train_fraction'], seed=params['seed'], workers=workers)
+        summary.update({
+            'mean': float(results['mean']),
+            'var': float(results['var']),
+            'classes': [str(crop) for crop in results['classes']],
+            'confusion': results['confusion'].tolist(),
+        })
+        with open(join(output_dir, 'evaluation.json'), 'w') as evaluation_file:
+            json.dump(summary, evaluation_file, indent=1)
+
+    model = CropModel(params['explanatory_variables']).fit(data_set, outcome_truth)
+    model.save(join(output_dir, 'crop_model.pkl'))
+    return summary
+
+
+def predictions_stage(output_dir, inputs, params):
+    """
+    Classifies every field and burns the crops into an image aligned with the
+    field mask (the steps of classify_fields.py)
+    """
+
+    model = load_model(join(inputs['model'], 'crop_model.pkl'))
+    store = FeatureStore(join(inputs['features'], 'store'))
+    field_labels, field_class, fraction = predict_fields(model, store)
+
+    with open(join(output_dir, 'field_crops.csv'), 'w') as out_file:
+        print('label,crop,fraction', file=out_file)
+        for field_label, class_index, field_fraction in zip(field_labels, field_class, fraction):
+            crop = model.classes[class_index] if class_index >= 0 else ''
+            print(','.join([str(x) for x in [field_label, crop, field_fraction]]), file=out_file)
+
+    field_mask = load(join(inputs['mask'], 'field_mask.npy'), mmap_mode='r')
+    save(join(output_dir, 'crop_type.npy'), burn_predictions(field_mask, field_labels, field_class + 1))
+    with open(join(output_dir, 'crop_type_legend.csv'), 'w') as legend_file:
+        print('value,crop', file=legend_file)
+        for n, crop in enumerate(model.classes):
+            print('{0},{1}'.format(n + 1, crop), file=legend_file)
+    return {'fields': int(field_labels.size)}
+
+
+def _scenes(catalog, directory, years, nw_corner, se_corner):
+    """
+    :return: list of catalog records of the scenes in a directory acquired in
+             the years and covering the area
+    """
+
+    catalog.update(directory)
+    directory = abspath(directory)
+    return [record for record in catalog.query(nw_coords=nw_corner, se_coords=se_corner, years=years)
+            if dirname(record['archive_path']) == directory]
+
+
+def build_pipeline(config, store_dir, workers=1):
+    """
+    Builds the stage graph of the workflow for a configuration. The scenes
+    are looked up in a catalog kept in the store directory.
+
+    :param config: dictionary of settings (see DEFAULT_CONFIG, missing ones take the defaults)
+    :param store_dir: artifact store directory
+    :param workers: number of worker processes used inside the stages
+    :return: Pipeline with the stages 'mask', 'scene_features/<scene id>',
+             'features', 'phenology', 'cdl/<year>', 'labels', 'model' and 'predictions'
+    """
+
+    settings = dict(DEFAULT_CONFIG)
+    settings.update(config)
+    area = {'nw_corner': [float(x) for x in settings['nw_corner']],
+            'se_corner': [float(x) for x in settings['se_corner']]}
+    # (width, height) of the field mask grid
+    shape = (int((area['se_corner'][0] - area['nw_corner'][0]) // settings['pixel_size']),
+             int((area['nw_corner'][1] - area['se_corner'][1]) // settings['pixel_size']))
+
+    pipeline = Pipeline(store_dir)
+    catalog = SceneCatalog(join(store_dir, 'scenes.sqlite'))
+    try:
+        mask_scenes = _scenes(catalog, settings['mask_archive_dir'], settings['mask_years'],
+                              area['nw_corner'], area['se_corner'])
+        scenes = _scenes(catalog, settings['archive_dir'], settings['years'], area['nw_corner'], area['se_corner'])
+    finally:
+        catalog.close()
+
+    # Field mask
+    mask_archives = [record['archive_path'] for record in mask_scenes]
+    pipeline.add(Stage('mask', partial(mask_stage, workers=workers), params=dict(
+        area, archives=mask_archives, pixel_size=settings['pixel_size'], min_field_area=settings['min_field_area'],
+        max_field_area=settings['max_field_area']
+    ), files=mask_archives, version=2))
+
+    # Field features of every scene, merged into one store
+    scene_stages = []
+    for record in scenes:
+        name = 'scene_features/{0}'.format(record['scene_id'])
+        pipeline.add(Stage(name, scene_features_stage, inputs=['mask'],
+                           params=dict(area, archive=record['archive_path']), files=[record['archive_path']]))
+        scene_stages.append(name)
+    pipeline.add(Stage('features', features_stage, inputs=scene_stages))
+    pipeline.add(Stage('phenology', phenology_stage, inputs=['features'], params={
+        'grid': settings['phenology_grid'], 'threshold': settings['phenology_threshold']
+    }))
+
+    # Crop data of every year with scenes, and the truth labels
+    cdl_stages = []
+    for year in sorted(set(record['year'] for record in scenes)):
+        name = 'cdl/{0:d}'.format(year)
+        pipeline.add(Stage(name, partial(cdl_stage, cache_dir=settings['cdl_cache']), params=dict(
+            area, year=year, shape=shape, utm_zone=settings['utm_zone'], endpoint=settings['cdl_endpoint']
+        )))
+        cdl_stages.append(name)
+    pipeline.add(Stage('labels', labels_stage, inputs=['mask', 'features'] + cdl_stages, params={
+        'min_purity': settings['min_purity'], 'min_count': settings['min_count']
+    }))
+
+    # Model and predictions
+    pipeline.add(Stage('model', partial(model_stage, workers=workers), inputs=['labels'], params=dict(
+        (name, settings[name]) for name in ('explanatory_variables', 'outcome_variable', 'trials',
+                                            'train_fraction', 'seed')
+    )))
+    pipeline.add(Stage('predictions', predictions_stage, inputs=['model', 'features', 'mask']))
+    return pipeline
@@ -0,0 +1,306 @@
+"""
+Generator of synthetic Landsat data product archives (MTL metadata and band
+TIFFs in a tar archive) with a patchwork of crop fields, for testing and
+benchmarking without the real bulk orders
+"""
+
+# Imports
+import tarfile
+import time
+from datetime import date, datetime, timedelta
+from io import BytesIO
+from os import makedirs, replace
+from os.path import join
+from numpy import arange, asarray, clip, exp, uint8, int64, float64
+from numpy.random import default_rng
+
+from .radiometry import earth_sun_distance
+from .tiff import write_tiff
+
+# Constants
+BANDS = tuple(range(1, 8))
+
+# Radiance rescaling (gain, bias) of the Landsat 5 TM bands
+RADIANCE_RESCALING = {
+    1: (0.765827, -2.29),
+    2: (1.448189, -4.29),
+    3: (1.043976, -2.21),
+    4: (0.876024, -2.39),
+    5: (0.120354, -0.49),
+    6: (0.055376, 1.18),
+    7: (0.065551, -0.22),
+}
+
+# Digital numbers of each crop class per band, out of season (bare soil) and
+# at the peak of the season, the thermal band cools as the canopy grows
+CROP_SIGNATURES = [
+    # (bare soil DN, peak DN, peak day of year, season width in days)
+    ([80, 40, 50, 45, 90, 140, 50], [60, 30, 25, 110, 60, 125, 25], 200, 40),
+    ([80, 40, 50, 45, 90, 140, 50], [65, 35, 30, 95, 70, 128, 30], 160, 30),
+    ([80, 40, 50, 45, 90, 140, 50], [62, 32, 28, 120, 55, 124, 22], 230, 35),
+    ([75, 38, 46, 50, 80, 136, 45], [70, 36, 40, 70, 85, 134, 40], 180, 60),
+    ([90, 45, 55, 48, 100, 145, 58], [88, 44, 54, 50, 98, 144, 57], 180, 60),
+]
+
+ROAD_DN = [95, 50, 62, 55, 105, 150, 65]
+
+
+def scene_id(wrs_path, wrs_row, acquired, sensor='LT5', station='PAC', version=1):
+    """
+    :return: Landsat scene id (e.g. LT50330342008130PAC01), the year starts at
+             character 9 as find_archives expects
+    """
+
+    return '{0}{1:03d}{2:03d}{3:04d}{4:03d}{5}{6:02d}'.format(
+        sensor, wrs_path, wrs_row, acquired.year, acquired.timetuple().tm_yday, station, version
+    )
+
+
+def metadata_text(scene, acquired, ul_corner, shape, pixel_size=30.0, spacecraft='LANDSAT_5', wrs_path=33,
+                  wrs_row=34, utm_zone=13, sun_elevation=60.0, sun_azimuth=130.0, rescaling=None):
+    """
+    Writes the MTL metadata file of a scene with the groups and keys that
+    LandsatScene, the catalog and the radiometry read
+
+    :param scene: scene id
+    :param acquired: datetime of the scene center
+    :param ul_corner: UTM coordinates (meters) of the upper left corner (x, y)
+    :param shape: (lines, samples) of the band images
+    :param pixel_size: pixel size (meters)
+    :param spacecraft: spacecraft id
+    :param wrs_path: WRS path
+    :param wrs_row: WRS row
+    :param utm_zone: UTM zone
+    :param sun_elevation: sun elevation (degrees)
+    :param sun_azimuth: sun azimuth (degrees)
+    :param rescaling: dictionary of band -> (radiance gain, radiance bias), default RADIANCE_RESCALING
+    :return: contents of the MTL file as a string
+    """
+
+    rescaling = RADIANCE_RESCALING if rescaling is None else rescaling
+    lines, samples = shape
+    west, north = float(ul_corner[0]), float(ul_corner[1])
+    east, south = west + samples*pixel_size, north - lines*pixel_size
+    corners = [('UL', west, north), ('UR', east, north), ('LL', west, south), ('LR', east, south)]
+
+    text = ['GROUP = L1_METADATA_FILE']
+
+    def group(name, items):
+        text.append('  GROUP = {0}'.format(name))
+        text.extend('    {0} = {1}'.format(key, value) for key, value in items)
+        text.append('  END_GROUP = {0}'.format(name))
+
+    group('METADATA_FILE_INFO', [
+        ('ORIGIN', '"Image courtesy of the U.S. Geological Survey"'),
+        ('LANDSAT_SCENE_ID', '"{0}"'.format(scene)),
+        ('FILE_DATE', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+        ('PROCESSING_SOFTWARE_VERSION', '"synthetic"'),
+    ])
+    product = [
+        ('DATA_TYPE', '"L1T"'),
+        ('SPACECRAFT_ID', '"{0}"'.format(spacecraft)),
+        ('SENSOR_ID', '"TM"'),
+        ('WRS_PATH', wrs_path),
+        ('WRS_ROW', wrs_row),
+        ('DATE_ACQUIRED', acquired.strftime('%Y-%m-%d')),
+        ('SCENE_CENTER_TIME', '"{0}.0000000Z"'.format(acquired.strftime('%H:%M:%S'))),
+    ]
+    for name, x, y in corners:
+        product.append(('CORNER_{0}_PROJECTION_X_PRODUCT'.format(name), '{0:.3f}'.format(x)))
+        product.append(('CORNER_{0}_PROJECTION_Y_PRODUCT'.format(name), '{0:.3f}'.format(y)))
+    product += [('REFLECTIVE_LINES', lines), ('REFLECTIVE_SAMPLES', samples),
+                ('THERMAL_LINES', lines), ('THERMAL_SAMPLES', samples)]
+    product += [('FILE_NAME_BAND_{0:d}'.format(band), '"{0}_B{1:d}.TIF"'.format(scene, band)) for band in rescaling]
+    product.append(('METADATA_FILE_NAME', '"{0}_MTL.txt"'.format(scene)))
+    group('PRODUCT_METADATA', product)
+    group('IMAGE_ATTRIBUTES', [
+        ('CLOUD_COVER', '0.00'),
+        ('SUN_AZIMUTH', '{0:.8f}'.format(sun_azimuth)),
+        ('SUN_ELEVATION', '{0:.8f}'.format(sun_elevation)),
+        ('EARTH_SUN_DISTANCE', '{0:.7f}'.format(earth_sun_distance(acquired.timetuple().tm_yday))),
+    ])
+    rescaling_items = []
+    for band, (gain, bias) in sorted(rescaling.items()):
+        rescaling_items.append(('RADIANCE_MULT_BAND_{0:d}'.format(band), '{0:.5E}'.format(gain)))
+        rescaling_items.append(('RADIANCE_ADD_BAND_{0:d}'.format(band), '{0:.5f}'.format(bias)))
+    group('RADIOMETRIC_RESCALING', rescaling_items)
+    group('PROJECTION_PARAMETERS', [
+        ('MAP_PROJECTION', '"UTM"'),
+        ('DATUM', '"WGS84"'),
+        ('GRID_CELL_SIZE_REFLECTIVE', '{0:.2f}'.format(pixel_size)),
+        ('GRID_CELL_SIZE_THERMAL', '{0:.2f}'.format(pixel_size)),
+        ('ORIENTATION', '"NORTH_UP"'),
+        ('UTM_ZONE', utm_zone),
+    ])
+
+    text += ['END_GROUP = L1_METADATA_FILE', 'END', '']
+    return '\n'.join(text)
+
+
+def field_layout(shape, field_size=(40, 60), road_width=2, num_crops=len(CROP_SIGNATURES), seed=0):
+    """
+    Lays out a grid of rectangular fields of random size separated by roads,
+    with a crop class for each field. The layout only depends on the seed, so
+    every scene of a series shares it.
+
+    :param shape: (rows, cols) of the image
+    :param field_size: (mean height, mean width) of the fields in pixels
+    :param road_width: width of the roads between fields in pixels
+    :param num_crops: number of crop classes
+    :param seed: random seed
+    :return: (labels, crops) tuple of the image of field labels (0 on the roads)
+             and the array of crop class of each label (crops[0] is unused)
+    """
+
+    rng = default_rng(seed)
+
+    def edges(length, size):
+        steps = rng.integers(size//2, 3*size//2 + 1, size=length//max(size//2, 1) + 2)
+        stops = steps.cumsum()
+        return stops[stops < length]
+
+    row_edges = edges(shape[0], field_size[0])
+    col_edges = edges(shape[1], field_size[1])
+
+    # Field row and column of every pixel, roads run along the edges
+    field_row = asarray(row_edges).searchsorted(arange(shape[0]), side='right')
+    field_col = asarray(col_edges).searchsorted(arange(shape[1]), side='right')
+    labels = (field_row[:, None]*(col_edges.size + 1) + field_col[None, :] + 1).astype(int64)
+    for edge in row_edges:
+        labels[max(edge - road_width//2, 0):edge + (road_width + 1)//2, :] = 0
+    for edge in col_edges:
+        labels[:, max(edge - road_width//2, 0):edge + (road_width + 1)//2] = 0
+
+    crops = rng.integers(0, num_crops, size=(row_edges.size + 1)*(col_edges.size + 1) + 1)
+    return labels, crops
+
+
+def band_images(labels, crops, day_of_year, bands=BANDS, noise=3.0, nodata_skew=0.1, seed=0):
+    """
+    Makes the digital numbers of the bands of a scene of a field layout. Each
+    crop follows a seasonal curve between its bare soil and peak signature,
+    and the scene has the skewed zero fill of a path oriented scene on its sides.
+
+    :param labels: image of field labels from field_layout
+    :param crops: crop class of each label from field_layout
+    :param day_of_year: day of the year of the scene
+    :param bands: bands to make
+    :param noise: standard deviation of the pixel noise in DN
+    :param nodata_skew: fraction of the width of the zero fill on each side
+    :param seed: random seed of the noise
+    :return: dictionary of band -> 2D uint8 array
+    """
+
+    rng = default_rng(seed)
+    rows, cols = labels.shape
+
+    # Zero fill outside a parallelogram
+    skew = nodata_skew*cols
+    row_position = arange(rows)[:, None] / max(rows - 1, 1)
+    col_index = arange(cols)[None, :]
+    nodata = (col_index < skew*(1 - row_position)) | (col_index >= cols - skew*row_position)
+
+    # Seasonal weight of each crop
+    peak_days = asarray([signature[2] for signature in CROP_SIGNATURES], dtype=float64)
+    widths = asarray([signature[3] for signature in CROP_SIGNATURES], dtype=float64)
+    weights = exp(-0.5*((day_of_year - peak_days)/widths)**2)
+    field_crops = crops[labels] % len(CROP_SIGNATURES)
+
+    images = {}
+    for band in bands:
+        soil = asarray([signature[0][band - 1] for signature in CROP_SIGNATURES], dtype=float64)
+        peak = asarray([signature[1][band - 1] for signature in CROP_SIGNATURES], dtype=float64)
+        crop_dn = soil + weights*(peak - soil)
+        image = crop_dn[field_crops]
+        image[labels == 0] = ROAD_DN[band - 1]
+        image += rng.normal(0.0, noise, size=image.shape)
+        image = clip(image, 1, 255).astype(uint8)
+        image[nodata] = 0
+        images[band] = image
+    return images
+
+
+def datetime_at(day, hour=17, minute=20, second=31):
+    """
+    :return: datetime of a date at a time of day (the default is a typical
+             scene center time over the central US)
+    """
+
+    return datetime(day.year, day.month, day.day, hour, minute, second)
+
+
+def _add_member(archive, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    archive.addfile(info, BytesIO(data))
+
+
+def make_archive(directory, acquired=date(2008, 5, 9), shape=(1000, 1000), ul_corner=(390000.0, 4200000.0),
+                 pixel_size=30.0, wrs_path=33, wrs_row=34, compression='gz', tiff_compression=False,
+                 layout_seed=0, seed=None, field_size=(40, 60), **metadata):
+    """
+    Writes a synthetic Landsat data product archive
+
+    :param directory: directory to write the archive to
+    :param acquired: date (or datetime) of the scene
+    :param shape: (lines, samples) of the band images
+    :param ul_corner: UTM coordinates (meters) of the upper left corner (x, y)
+    :param pixel_size: pixel size (meters)
+    :param wrs_path: WRS path
+    :param wrs_row: WRS row
+    :param compression: None for a plain .tar archive, or 'gz', 'bz2' or 'xz'
+    :param tiff_compression: deflate compress the band TIFFs
+    :param layout_seed: seed of the field layout (shared by the scenes of a series)
+    :param seed: seed of the pixel noise (default: the day of the year)
+    :param field_size: (mean height, mean width) of the fields in pixels
+    :param metadata: other arguments of metadata_text (e.g. sun_elevation)
+    :return: path of the archive
+    """
+
+    if not hasattr(acquired, 'hour'):
+        acquired = datetime_at(acquired)
+    day_of_year = acquired.timetuple().tm_yday
+    scene = scene_id(wrs_path, wrs_row, acquired)
+    makedirs(directory, exist_ok=True)
+    extension = '.tar' if compression is None else '.tar.' + compression
+    path = join(directory, scene + extension)
+
+    labels, crops = field_layout(shape, field_size=field_size, seed=layout_seed)
+    images = band_images(labels, crops, day_of_year, seed=day_of_year if seed is None else seed)
+    text = metadata_text(scene, acquired, ul_corner, shape, pixel_size=pixel_size, wrs_path=wrs_path,
+                         wrs_row=wrs_row, **metadata)
+
+    # Write the archive atomically, one band in memory at a time
+    mode = 'w' if compression is None else 'w:' + compression
+    with tarfile.open(path + '.tmp', mode, format=tarfile.USTAR_FORMAT) as archive:
+        for band in BANDS:
+            tiff_data = BytesIO()
+            write_tiff(tiff_data, images.pop(band), compress=tiff_compression)
+            _add_member(archive, '{0}_B{1:d}.TIF'.format(scene, band), tiff_data.getvalue())
+        _add_member(archive, '{0}_MTL.txt'.format(scene), text.encode('ascii'))
+    replace(path + '.tmp', path)
+    return path
+
+
+def make_series(directory, years, scenes_per_year=4, first_day=120, last_day=270, **kwargs):
+    """
+    Writes a time series of synthetic archives of the same area, spread
+    evenly over the growing season of each year
+
+    :param directory: directory to write the archives to
+    :param years: list of years
+    :param scenes_per_year: number of scenes in each year
+    :param first_day: day of the year of the first scene of a year
+    :param last_day: day of the year of the last scene of a year
+    :param kwargs: other arguments of make_archive (e.g. shape)
+    :return: list of archive paths
+    """
+
+    paths = []
+    for year in years:
+        for n in range(scenes_per_year):
+            day = first_day + (n*(last_day - first_day))//max(scenes_per_year - 1, 1)
+            acquired = date(year, 1, 1) + timedelta(days=day - 1)
+            paths.append(make_archive(directory, acquired=acquired, **kwargs))
+    return paths
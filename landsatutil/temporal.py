@@ -3,65 +3,225 @@ Tools for temporal data extraction
 """
 
 # Imports
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from os import listdir
-from os.path import join
-from numpy import min, max, average, zeros
+from os.path import join, dirname, abspath
+from numpy import nanmin, nanmax, average, array, full, nan, isnan, isfinite, zeros, uint16
 from skimage.util import img_as_uint
 
+from . import profiling
 from .scene import LandsatScene
+from .archive import DEFAULT_CACHE_DIR
+from .reducers import MeanVarianceReducer, reduce_stack, tile_bounds
 
+# Constants
+NODATA = 0
 
-def collect_bands(band, nw_coords, se_coords, year_list, directory):
+
+def _read_subimage(task):
     """
-    Collects sub-images of each band for each year and puts them
-    into a 3-dimensional array with the 3rd dimension being time
+    Opens a scene and reads a band sub-image from it (run in worker processes)
+
+    :param task: (archive path, band, nw_coords, se_coords, cache_dir) tuple
+    :return: (radiance sub-image as a numpy float array, validity mask) tuple, pixels
+             with the nodata value (zero fill at the scene edges) are not valid
+    """
+
+    archive_path, band, nw_coords, se_coords, cache_dir = task
+    scene = LandsatScene(archive_path, cache_dir=cache_dir)
+    subimage = scene.get_band_subimage(band, nw_coords, se_coords, convert=False)
+    valid = subimage != NODATA
+    return scene.calibrate(subimage, band, out=subimage), valid
+
+
+def _ordered_map(executor, function, tasks, depth):
+    """
+    Maps a function over tasks with an executor, yielding the results in task
+    order while keeping at most depth tasks in flight
+
+    :param executor: concurrent.futures executor
+    :param function: function to apply to each task
+    :param tasks: list of tasks
+    :param depth: maximum number of tasks submitted ahead of the consumer
+    :return: generator of results
+    """
+
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(function, task))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def find_archives(year_list, directory, catalog=None):
+    """
+    Finds the archives in a directory acquired in the given years
 
-    :param band: band of interest
-    :param nw_coords: UTM coordinates (meters) of the north west corner of interest
-    :param se_coords; UTM coordinates (meters) of the south east corner of interest
     :param year_list: list of years to collect
     :param directory: directory to search for available datasets
-    :return: A three dimensional numpy array with the images stacked in dimension 3
+    :param catalog: optional SceneCatalog, if given the years are looked up in it
+                    (after adding any new archives in the directory) instead of
+                    being sliced out of the file names
+    :return: sorted list of archive paths
     """
 
+    if catalog is not None:
+        catalog.update(directory)
+        directory = abspath(directory)
+        return [path for path in catalog.archive_paths(years=year_list) if dirname(path) == directory]
+
     # Convert year list items to stings
     year_list = [str(x) for x in year_list]
     # Get list of archives in directory
     archive_list = listdir(directory)
     # Get all files with the year specified
-    archive_list = [file for file in archive_list if file[9:13] in year_list]
-    # Create list to hold subimages before fusion
-    subimage_list = []
+    archive_list = sorted(file for file in archive_list if file[9:13] in year_list)
+    return [join(directory, archive) for archive in archive_list]
+
+
+def iter_subimages(archive_paths, band, nw_coords, se_coords, workers=1, prefetch=False,
+                   cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Reads a band sub-image from each archive, yielding them in archive order.
+    The result is the same whichever way the reads are scheduled.
+
+    :param archive_paths: list of archive paths
+    :param band: band of interest
+    :param nw_coords: UTM coordinates (meters) of the north west corner of interest
+    :param se_coords: UTM coordinates (meters) of the south east corner of interest
+    :param workers: number of worker processes to read the scenes with (1 reads in this process)
+    :param prefetch: if true (and workers is 1) read the next scene in a background
+                     thread while the current one is being used
+    :param cache_dir: directory to extract members of compressed archives to (see archive.LandsatArchive)
+    :return: generator of (sub-image, validity mask) tuples
+    """
+
+    tasks = [(archive_path, band, nw_coords, se_coords, cache_dir) for archive_path in archive_paths]
 
-    for archive in archive_list:
-        scene = LandsatScene(join(directory, archive))
-        subimage_list.append(scene.get_band_subimage(band, nw_coords, se_coords))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for subimage in _ordered_map(executor, _read_subimage, tasks, 2*workers):
+                yield subimage
+    elif prefetch:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for subimage in _ordered_map(executor, _read_subimage, tasks, 2):
+                yield subimage
+    else:
+        for task in tasks:
+            yield _read_subimage(task)
 
-    # Make sure that all images have the same shape (they should) but
-    # truncate extra values anyway (just in-case)
-    y_extent = min([image.shape[0] for image in subimage_list])
-    x_extent = min([image.shape[1] for image in subimage_list])
 
-    # Average on the fly
-    temporal_image = zeros((y_extent, x_extent))
-    for n, image in enumerate(subimage_list):
-        temporal_image = ((temporal_image * n) + image[0:y_extent, 0:x_extent])/(n + 1)
+@profiling.profiled('temporal.reduce_bands')
+def reduce_bands(band, nw_coords, se_coords, year_list, directory, reducer_factory,
+                 workers=1, prefetch=False, tile_size=None, out=None, catalog=None, cube=None,
+                 cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Streams the sub-images of a band for each year through a set of reducers
+    without holding the stack in memory. With a tile_size the region is
+    processed one tile at a time, so only one tile of accumulators exists at
+    once (useful for the histogram based percentile reducers).
+
+    :param band: band of interest
+    :param nw_coords: UTM coordinates (meters) of the north west corner of interest
+    :param se_coords: UTM coordinates (meters) of the south east corner of interest
+    :param year_list: list of years to collect
+    :param directory: directory to search for available datasets
+    :param reducer_factory: function with no arguments returning a list of Reducer objects
+    :param workers: number of worker processes used to read the scenes
+    :param prefetch: read the next scene in the background while reducing the current one
+    :param tile_size: optional tile edge length in pixels
+    :param out: optional dictionary of statistic name -> 2D array (e.g. memmaps) to write
+                the tiled results to, arrays are created for missing statistics
+    :param catalog: optional SceneCatalog used to find the archives
+    :param cube: optional DataCube to read the sub-images from instead of the archives
+                 (the directory and catalog are then not used)
+    :param cache_dir: directory to extract members of compressed archives to (see archive.LandsatArchive)
+    :return: dictionary of statistic name -> 2D numpy array
+    """
 
-    return temporal_image
+    if cube is None:
+        archive_paths = find_archives(year_list, directory, catalog)
+
+    def frames(frame_nw, frame_se):
+        if cube is not None:
+            return cube.frames(band, frame_nw, frame_se, years=year_list)
+        return iter_subimages(archive_paths, band, frame_nw, frame_se, workers, prefetch, cache_dir)
+
+    if tile_size is None:
+        return reduce_stack(frames(nw_coords, se_coords), reducer_factory())
+
+    # Pixel extent of the region
+    if cube is not None:
+        pixel_size = cube.pixel_size
+        rows, cols = cube.window(nw_coords, se_coords)
+        shape = (rows.stop - rows.start, cols.stop - cols.start)
+    else:
+        scene = LandsatScene(archive_paths[0], cache_dir=cache_dir)
+        pixel_size = scene.pixel_size
+        nw_pixel = scene.coords_to_pixel(nw_coords)
+        se_pixel = scene.coords_to_pixel(se_coords)
+        shape = (se_pixel[1] - nw_pixel[1], se_pixel[0] - nw_pixel[0])
+
+    results = {} if out is None else out
+    for row_start, row_stop, col_start, col_stop in tile_bounds(shape, tile_size):
+        tile_nw = nw_coords + pixel_size*array([col_start, -row_start])
+        tile_se = nw_coords + pixel_size*array([col_stop, -row_stop])
+        for name, value in reduce_stack(frames(tile_nw, tile_se), reducer_factory()).items():
+            if name not in results:
+                results[name] = full(shape, nan)
+            results[name][row_start:row_start + value.shape[0], col_start:col_start + value.shape[1]] = value
+
+    return results
+
+
+@profiling.profiled('temporal.collect_bands')
+def collect_bands(band, nw_coords, se_coords, year_list, directory, workers=1, prefetch=False, catalog=None,
+                  cube=None, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Collects sub-images of each band for each year and averages them over
+    time. Nodata pixels (the zero fill at scene edges) are left out of the
+    average, pixels without any valid data are nan.
+
+    :param band: band of interest
+    :param nw_coords: UTM coordinates (meters) of the north west corner of interest
+    :param se_coords; UTM coordinates (meters) of the south east corner of interest
+    :param year_list: list of years to collect
+    :param directory: directory to search for available datasets
+    :param workers: number of worker processes used to read the scenes
+    :param prefetch: read the next scene in the background while averaging the current one
+    :param catalog: optional SceneCatalog used to find the archives
+    :param cube: optional DataCube to read the sub-images from instead of the archives
+    :param cache_dir: directory to extract members of compressed archives to (see archive.LandsatArchive)
+    :return: A two dimensional numpy array with the temporal average
+    """
+
+    results = reduce_bands(band, nw_coords, se_coords, year_list, directory,
+                           lambda: [MeanVarianceReducer(fill_value=nan)], workers=workers, prefetch=prefetch,
+                           catalog=catalog, cube=cube, cache_dir=cache_dir)
+    return results['mean']
 
 
 def compress_temporal_image(temporal_image):
     """
     Averages frames in the image and then normalizes them to values between [0, 2^16]
 
-    :param temporal_image: Image to compress
-    :return: 2D numpy image array of type ubyte
+    :param temporal_image: Image to compress, nan where there is no data
+    :return: 2D numpy image array of type ubyte, zero where there is no data
     """
 
-    # Normalize the image to values between [-1 and 1]
-    image_center = average([min(temporal_image), max(temporal_image)])
+    if not isfinite(temporal_image).any():
+        return zeros(temporal_image.shape, dtype=uint16)
+
+    # Normalize the image to values between [-1 and 1], leaving out the pixels without data
+    image_center = average([nanmin(temporal_image), nanmax(temporal_image)])
     image_shift = temporal_image - image_center
-    image_normalized = image_shift/max([-min(image_shift), max(image_shift)])
+    image_normalized = image_shift/max(-nanmin(image_shift), nanmax(image_shift))
+
+    # Pixels without data map to zero
+    image_normalized[isnan(image_normalized)] = -1
 
     # Change image to a ubyte and return
     return img_as_uint(image_normalized)
\ No newline at end of file
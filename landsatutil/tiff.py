@@ -0,0 +1,325 @@
+"""
+Minimal TIFF reader for windowed access to Landsat band images, and a
+writer for single band strip TIFFs
+"""
+
+# Imports
+import zlib
+from io import BytesIO
+from struct import pack, unpack, calcsize
+from numpy import dtype as np_dtype, empty, frombuffer, memmap
+
+from . import profiling
+
+# Constants
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_PHOTOMETRIC = 262
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_ROWS_PER_STRIP = 278
+TAG_STRIP_BYTE_COUNTS = 279
+TAG_PREDICTOR = 317
+TAG_TILE_WIDTH = 322
+TAG_TILE_LENGTH = 323
+TAG_TILE_OFFSETS = 324
+TAG_TILE_BYTE_COUNTS = 325
+TAG_SAMPLE_FORMAT = 339
+
+COMPRESSION_NONE = 1
+COMPRESSION_DEFLATE = (8, 32946)
+
+# TIFF field type -> struct format character
+FIELD_TYPES = {1: 'B', 2: 's', 3: 'H', 4: 'I', 6: 'b', 7: 'B', 8: 'h', 9: 'i', 11: 'f', 12: 'd', 16: 'Q'}
+
+# (sample format, bits per sample) -> numpy type character
+SAMPLE_TYPES = {
+    (1, 8): 'u1', (1, 16): 'u2', (1, 32): 'u4',
+    (2, 8): 'i1', (2, 16): 'i2', (2, 32): 'i4',
+    (3, 32): 'f4', (3, 64): 'f8',
+}
+
+
+class TiffImage(object):
+
+    def __init__(self, path, offset=0):
+        """
+        Open a single band TIFF image for windowed reading. Only the image
+        file directory is parsed here, no pixel data is read.
+
+        :param path: path to the TIFF file, or a bytes object with its contents
+        :param offset: byte offset of the TIFF data in the file (e.g. a member
+                       of an uncompressed tar archive)
+        :return: TiffImage object
+        """
+
+        self.path = path
+        self.offset = offset
+
+        with self._open() as tiff_file:
+            tags = self._read_tags(tiff_file)
+
+        # Image layout
+        self.width = tags[TAG_IMAGE_WIDTH][0]
+        self.height = tags[TAG_IMAGE_LENGTH][0]
+        self.shape = (self.height, self.width)
+        self.compression = tags.get(TAG_COMPRESSION, (COMPRESSION_NONE,))[0]
+        self.predictor = tags.get(TAG_PREDICTOR, (1,))[0]
+        if tags.get(TAG_SAMPLES_PER_PIXEL, (1,))[0] != 1:
+            raise ValueError('Only single band TIFF images are supported')
+        if self.predictor not in (1, 2):
+            raise ValueError('Unsupported TIFF predictor {0}'.format(self.predictor))
+
+        # Pixel data type
+        bits = tags[TAG_BITS_PER_SAMPLE][0]
+        sample_format = tags.get(TAG_SAMPLE_FORMAT, (1,))[0]
+        try:
+            self.dtype = np_dtype(self.byte_order + SAMPLE_TYPES[(sample_format, bits)])
+        except KeyError:
+            raise ValueError('Unsupported sample format {0} with {1} bits'.format(sample_format, bits))
+
+        # Chunk (strip or tile) layout, strips are treated as full width tiles
+        if TAG_TILE_OFFSETS in tags:
+            self.chunk_shape = (tags[TAG_TILE_LENGTH][0], tags[TAG_TILE_WIDTH][0])
+            self.chunk_offsets = tags[TAG_TILE_OFFSETS]
+            self.chunk_byte_counts = tags[TAG_TILE_BYTE_COUNTS]
+        else:
+            rows_per_strip = min(tags.get(TAG_ROWS_PER_STRIP, (self.height,))[0], self.height)
+            self.chunk_shape = (rows_per_strip, self.width)
+            self.chunk_offsets = tags[TAG_STRIP_OFFSETS]
+            self.chunk_byte_counts = tags[TAG_STRIP_BYTE_COUNTS]
+        self.chunks_across = -(-self.width // self.chunk_shape[1])
+
+    def _read_tags(self, tiff_file):
+        """
+        Reads the tags of the first image file directory
+
+        :param tiff_file: open binary file positioned anywhere
+        :return: dictionary of tag -> tuple of values
+        """
+
+        tiff_file.seek(self.offset)
+        header = tiff_file.read(16)
+        self.byte_order = {b'II': '<', b'MM': '>'}[header[0:2]]
+        version = unpack(self.byte_order + 'H', header[2:4])[0]
+
+        # Classic TIFF uses 32 bit offsets, BigTIFF 64 bit offsets
+        if version == 42:
+            ifd_offset = unpack(self.byte_order + 'I', header[4:8])[0]
+            count_format, entry_format, entry_size, inline_size = 'H', 'HHI', 12, 4
+        elif version == 43:
+            ifd_offset = unpack(self.byte_order + 'Q', header[8:16])[0]
+            count_format, entry_format, entry_size, inline_size = 'Q', 'HHQ', 20, 8
+        else:
+            raise ValueError('Not a TIFF file')
+
+        tiff_file.seek(self.offset + ifd_offset)
+        count_size = calcsize(count_format)
+        num_entries = unpack(self.byte_order + count_format, tiff_file.read(count_size))[0]
+        entries = tiff_file.read(num_entries * entry_size)
+
+        tags = {}
+        for n in range(num_entries):
+            entry = entries[n*entry_size:(n+1)*entry_size]
+            tag, field_type, count = unpack(self.byte_order + entry_format, entry[0:4 + inline_size])
+            if field_type not in FIELD_TYPES:
+                continue
+            value_format = self.byte_order + '{0:d}{1}'.format(count, FIELD_TYPES[field_type])
+            value_size = calcsize(value_format)
+            if value_size <= inline_size:
+                data = entry[4 + inline_size:4 + inline_size + value_size]
+            else:
+                data_offset = unpack(self.byte_order + entry_format[-1], entry[4 + inline_size:])[0]
+                position = tiff_file.tell()
+                tiff_file.seek(self.offset + data_offset)
+                data = tiff_file.read(value_size)
+                tiff_file.seek(position)
+            tags[tag] = unpack(value_format, data)
+
+        return tags
+
+    def _open(self):
+        """
+        Opens the underlying file (or wraps the in memory contents)
+
+        :return: binary file object
+        """
+
+        if isinstance(self.path, (bytes, bytearray, memoryview)):
+            return BytesIO(self.path)
+        return open(self.path, 'rb')
+
+    def _is_contiguous(self):
+        """
+        Checks if the pixel data is stored uncompressed as one contiguous block
+        of full width strips, in which case it can be memory mapped directly.
+        """
+
+        if self.compression != COMPRESSION_NONE or self.chunk_shape[1] != self.width:
+            return False
+        strip_size = self.chunk_shape[0] * self.width * self.dtype.itemsize
+        for n in range(1, len(self.chunk_offsets)):
+            if self.chunk_offsets[n] != self.chunk_offsets[0] + n*strip_size:
+                return False
+        return True
+
+    def _read_chunk(self, tiff_file, index):
+        """
+        Reads and decodes a single strip or tile
+
+        :param tiff_file: open binary file
+        :param index: chunk index
+        :return: 2D numpy array of the chunk (padded to full chunk shape)
+        """
+
+        tiff_file.seek(self.offset + self.chunk_offsets[index])
+        data = tiff_file.read(self.chunk_byte_counts[index])
+
+        if self.compression in COMPRESSION_DEFLATE:
+            data = zlib.decompress(data)
+        elif self.compression != COMPRESSION_NONE:
+            raise ValueError('Unsupported TIFF compression {0}'.format(self.compression))
+
+        chunk = frombuffer(data, dtype=self.dtype)
+        chunk_rows = chunk.size // self.chunk_shape[1]
+        chunk = chunk[0:chunk_rows*self.chunk_shape[1]].reshape(chunk_rows, self.chunk_shape[1])
+
+        # Undo horizontal differencing
+        if self.predictor == 2:
+            chunk = chunk.cumsum(axis=1, dtype=self.dtype)
+
+        return chunk
+
+    def read_window(self, row_start, row_stop, col_start, col_stop):
+        """
+        Reads a window of the image, decoding only the strips or tiles that
+        overlap it. Bounds are clipped to the image.
+
+        :param row_start: first row of the window
+        :param row_stop: row after the last row of the window
+        :param col_start: first column of the window
+        :param col_stop: column after the last column of the window
+        :return: 2D numpy array with the window in native byte order
+        """
+
+        row_start, row_stop = max(row_start, 0), min(row_stop, self.height)
+        col_start, col_stop = max(col_start, 0), min(col_stop, self.width)
+        window = empty((max(row_stop - row_start, 0), max(col_stop - col_start, 0)),
+                       dtype=self.dtype.newbyteorder('='))
+        if window.size == 0:
+            return window
+
+        with profiling.span('tiff.read_window') as stage:
+            stage.add(pixels=window.size)
+
+            # Uncompressed contiguous data is sliced straight out of a memory map
+            if self._is_contiguous():
+                if isinstance(self.path, (bytes, bytearray, memoryview)):
+                    image = frombuffer(self.path, dtype=self.dtype, count=self.height*self.width,
+                                       offset=self.offset + self.chunk_offsets[0]).reshape(self.shape)
+                else:
+                    image = memmap(self.path, dtype=self.dtype, mode='r',
+                                   offset=self.offset + self.chunk_offsets[0], shape=self.shape)
+                window[:] = image[row_start:row_stop, col_start:col_stop]
+                del image
+                stage.add(bytes_read=window.nbytes)
+                return window
+
+            # Otherwise decode the chunks overlapping the window one at a time
+            chunk_rows, chunk_cols = self.chunk_shape
+            bytes_read = 0
+            with self._open() as tiff_file:
+                for chunk_r in range(row_start // chunk_rows, (row_stop - 1) // chunk_rows + 1):
+                    for chunk_c in range(col_start // chunk_cols, (col_stop - 1) // chunk_cols + 1):
+                        index = chunk_r*self.chunks_across + chunk_c
+                        chunk = self._read_chunk(tiff_file, index)
+                        bytes_read += self.chunk_byte_counts[index]
+                        r0, c0 = chunk_r*chunk_rows, chunk_c*chunk_cols
+                        r_lo, r_hi = max(row_start, r0), min(row_stop, r0 + chunk.shape[0])
+                        c_lo, c_hi = max(col_start, c0), min(col_stop, c0 + chunk_cols)
+                        window[r_lo - row_start:r_hi - row_start, c_lo - col_start:c_hi - col_start] = \
+                            chunk[r_lo - r0:r_hi - r0, c_lo - c0:c_hi - c0]
+            stage.add(bytes_read=bytes_read)
+
+        return window
+
+    def read(self):
+        """
+        Reads the whole image
+
+        :return: 2D numpy array of the image
+        """
+
+        return self.read_window(0, self.height, 0, self.width)
+
+
+def write_tiff(path, image, rows_per_strip=None, compress=False):
+    """
+    Writes a single band image as a little endian strip TIFF that TiffImage
+    (and other readers) can read
+
+    :param path: path of the TIFF file, or a writable binary file object
+    :param image: 2D numpy array (unsigned, signed integer or float)
+    :param rows_per_strip: rows in each strip (default: whole strips of about 64 kB)
+    :param compress: deflate compress the strips
+    :return: number of bytes written
+    """
+
+    image = image.astype(image.dtype.newbyteorder('<'), copy=False)
+    rows, cols = image.shape
+    sample_format = {'u': 1, 'i': 2, 'f': 3}[image.dtype.kind]
+    if (sample_format, 8*image.dtype.itemsize) not in SAMPLE_TYPES:
+        raise ValueError('Unsupported TIFF sample type {0}'.format(image.dtype))
+    if rows_per_strip is None:
+        rows_per_strip = max(65536 // max(cols*image.dtype.itemsize, 1), 1)
+    rows_per_strip = min(rows_per_strip, max(rows, 1))
+
+    # Encode the strips
+    strips = []
+    for row in range(0, rows, rows_per_strip):
+        data = image[row:row + rows_per_strip].tobytes()
+        strips.append(zlib.compress(data, 6) if compress else data)
+
+    # The strips follow the header, then the offset and byte count tables and the directory
+    offsets = []
+    position = 8
+    for strip in strips:
+        offsets.append(position)
+        position += len(strip)
+    tables_offset = position + position % 2
+    counts_offset = tables_offset + 4*len(strips)
+    ifd_offset = counts_offset + 4*len(strips)
+
+    def entry(tag, field_type, count, value):
+        return pack('<HHII', tag, field_type, count, value)
+
+    entries = [
+        entry(TAG_IMAGE_WIDTH, 4, 1, cols),
+        entry(TAG_IMAGE_LENGTH, 4, 1, rows),
+        entry(TAG_BITS_PER_SAMPLE, 3, 1, 8*image.dtype.itemsize),
+        entry(TAG_COMPRESSION, 3, 1, COMPRESSION_DEFLATE[0] if compress else COMPRESSION_NONE),
+        entry(TAG_PHOTOMETRIC, 3, 1, 1),
+        entry(TAG_STRIP_OFFSETS, 4, len(strips), offsets[0] if len(strips) == 1 else tables_offset),
+        entry(TAG_SAMPLES_PER_PIXEL, 3, 1, 1),
+        entry(TAG_ROWS_PER_STRIP, 4, 1, rows_per_strip),
+        entry(TAG_STRIP_BYTE_COUNTS, 4, len(strips), len(strips[0]) if len(strips) == 1 else counts_offset),
+        entry(TAG_SAMPLE_FORMAT, 3, 1, sample_format),
+    ]
+
+    contents = [b'II*\x00', pack('<I', ifd_offset)] + strips + [b'\x00' * (position % 2)]
+    contents.append(pack('<{0:d}I'.format(len(strips)), *offsets))
+    contents.append(pack('<{0:d}I'.format(len(strips)), *[len(strip) for strip in strips]))
+    contents.append(pack('<H', len(entries)))
+    contents.extend(entries)
+    contents.append(pack('<I', 0))
+
+    if hasattr(path, 'write'):
+        for part in contents:
+            path.write(part)
+    else:
+        with open(path, 'wb') as tiff_file:
+            for part in contents:
+                tiff_file.write(part)
+    return sum(len(part) for part in contents)
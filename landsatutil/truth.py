@@ -0,0 +1,160 @@
+"""
+Automatic truth labeling of fields from Cropland Data Layer (Cropscape)
+images by majority vote of the pixels of every field
+"""
+
+# Imports
+from numpy import asarray, arange, bincount, full, zeros, unique, argmax, searchsorted, minimum, nan
+from numpy import uint32, int64, float64
+
+# Constants
+TRUTH_DTYPE = [
+    ('label', int64),
+    ('crop', int64),
+    ('purity', float64),
+    ('count', int64),
+]
+
+# Label and key ranges up to this size are binned directly
+DENSE_SPAN = 1 << 24
+
+
+def align_to_mask(image, shape):
+    """
+    Resamples an image to the field mask grid by nearest neighbour, so the
+    class colors are never blended
+
+    :param image: 2D or 3D (rows x cols x channels) image
+    :param shape: (rows, cols) of the field mask
+    :return: image with the field mask shape
+    """
+
+    rows = minimum(((arange(shape[0]) + 0.5) * image.shape[0] / shape[0]).astype(int64), image.shape[0] - 1)
+    cols = minimum(((arange(shape[1]) + 0.5) * image.shape[1] / shape[1]).astype(int64), image.shape[1] - 1)
+    return image[rows[:, None], cols[None, :]]
+
+
+def encode_colors(image):
+    """
+    Encodes the color of each pixel of an RGB(A) image as one integer key
+    (alpha is ignored), images with one channel are returned as they are
+
+    :param image: 2D or 3D (rows x cols x channels) image
+    :return: 2D integer array of keys (r*65536 + g*256 + b)
+    """
+
+    image = asarray(image)
+    if image.ndim == 2:
+        return image.astype(int64, copy=False)
+    colors = image[..., 0:3].astype(uint32)
+    return ((colors[..., 0] << 16) | (colors[..., 1] << 8) | colors[..., 2]).astype(int64)
+
+
+def decode_color(key):
+    """
+    :return: (r, g, b) tuple of a color key
+    """
+
+    key = int(key)
+    return (key >> 16) & 255, (key >> 8) & 255, key & 255
+
+
+def _dense_index(values):
+    """
+    Numbers the distinct values of an array from zero, by binning when their
+    range is small enough and with a sort otherwise
+
+    :return: (sorted distinct values, index of each element)
+    """
+
+    if values.size > 0 and values.min() >= 0 and values.max() < DENSE_SPAN:
+        present = bincount(values).nonzero()[0]
+        lookup = full(present[-1] + 1, -1, dtype=int64)
+        lookup[present] = arange(present.size)
+        return present, lookup[values]
+    return unique(values, return_inverse=True)
+
+
+def majority_labels(field_mask, crop_keys, background=0, ignore=()):
+    """
+    Finds the crop of every field as the most common class of its pixels, in
+    one pass over the image
+
+    :param field_mask: 2D labeled field image
+    :param crop_keys: 2D array of crop class keys aligned with the field mask
+                      (e.g. encode_colors(align_to_mask(cdl_image, field_mask.shape)))
+    :param background: label value that is not a field
+    :param ignore: class keys that do not vote (e.g. the no data color)
+    :return: structured array with the columns of TRUTH_DTYPE, one row per field
+             with the majority class, the fraction of the field's voting pixels
+             in it and the number of voting pixels
+    """
+
+    labels = asarray(field_mask).ravel()
+    keys = asarray(crop_keys).ravel()
+    select = labels != background
+    for key in ignore:
+        select &= keys != key
+    labels = labels[select]
+    keys = keys[select]
+
+    field_labels, field_index = _dense_index(labels)
+    classes, class_index = _dense_index(keys)
+
+    # Pixel count of every (field, class) pair
+    num_classes = max(classes.size, 1)
+    counts = bincount(field_index*num_classes + class_index, minlength=field_labels.size*num_classes)
+    counts = counts.reshape(field_labels.size, num_classes)
+    majority = argmax(counts, axis=1)
+    total = counts.sum(axis=1)
+
+    table = zeros(field_labels.size, dtype=TRUTH_DTYPE)
+    table['label'] = field_labels
+    table['crop'] = classes[majority] if classes.size > 0 else 0
+    table['count'] = total
+    table['purity'] = counts[arange(field_labels.size), majority] / total
+    return table
+
+
+def join_truth(columns, truth_tables, palette=None, min_purity=0.0, min_count=1):
+    """
+    Joins the truth of each field and year to a feature table by (label, year)
+
+    :param columns: dictionary (or DataFrame) of feature columns with 'label' and 'year' columns
+    :param truth_tables: dictionary of year -> majority_labels table
+    :param palette: optional dictionary of crop key -> crop name (or code), crops
+                    missing from it keep their key
+    :param min_purity: rows of fields with a lower purity get no truth
+    :param min_count: rows of fields with fewer voting pixels get no truth
+    :return: dictionary of the feature columns with 'CropTruth', 'purity' and
+             'crop_pixels' columns added, and a boolean 'has_truth' column
+    """
+
+    labels = asarray(columns['label'], dtype=int64)
+    years = asarray(columns['year'], dtype=int64)
+    crop = zeros(labels.size, dtype=int64)
+    purity = full(labels.size, nan)
+    count = zeros(labels.size, dtype=int64)
+    has_truth = zeros(labels.size, dtype=bool)
+
+    for year, table in truth_tables.items():
+        rows = (years == int(year)).nonzero()[0]
+        if rows.size == 0 or table.size == 0:
+            continue
+        position = minimum(searchsorted(table['label'], labels[rows]), table.size - 1)
+        found = table['label'][position] == labels[rows]
+        rows, position = rows[found], position[found]
+        crop[rows] = table['crop'][position]
+        purity[rows] = table['purity'][position]
+        count[rows] = table['count'][position]
+        has_truth[rows] = (table['purity'][position] >= min_purity) & (table['count'][position] >= min_count)
+
+    result = dict((name, asarray(columns[name])) for name in columns)
+    if palette is not None:
+        result['CropTruth'] = asarray([palette.get(key, key) for key in crop.tolist()], dtype=object)
+    else:
+        result['CropTruth'] = crop
+    result['purity'] = purity
+    result['crop_pixels'] = count
+    result['has_truth'] = has_truth
+    return result
@@ -0,0 +1,158 @@
+"""
+Vectorized zonal statistics of band images over labeled field masks
+"""
+
+# Imports
+from numpy import asarray, unique, bincount, concatenate, zeros, full
+from numpy import minimum, maximum, searchsorted, nan, inf, int64, float64, errstate
+
+from . import profiling
+
+# Constants
+ZONAL_DTYPE = [
+    ('label', int64),
+    ('count', int64),
+    ('sum', float64),
+    ('sumsq', float64),
+    ('mean', float64),
+    ('var', float64),
+    ('min', float64),
+    ('max', float64),
+]
+
+# Label ranges up to this size are always binned directly
+DENSE_LABEL_SPAN = 1 << 20
+
+
+def _finish(table):
+    """
+    Fills in the mean and variance columns from the count, sum and sum of squares
+
+    :param table: zonal statistics table
+    :return: the same table
+    """
+
+    with errstate(invalid='ignore', divide='ignore'):
+        table['mean'] = table['sum']/table['count']
+        table['var'] = maximum(table['sumsq']/table['count'] - table['mean']**2, 0)
+    return table
+
+
+@profiling.profiled('zonal.zonal_stats')
+def zonal_stats(labels, values, valid=None, label_list=None, background=0):
+    """
+    Computes statistics of values for every label of a labeled mask with
+    bincount style accumulation instead of a loop over labels. Every pixel of
+    a label counts, including zero valued ones.
+
+    :param labels: 2D integer array of labels (e.g. the field mask)
+    :param values: array of values with the same shape as labels (e.g. a band)
+    :param valid: optional boolean array, pixels that are false are left out (nodata)
+    :param label_list: optional labels to report, in order (labels without valid
+                       pixels get a count of zero and nan statistics)
+    :param background: label value that is not a zone
+    :return: structured numpy array with the columns of ZONAL_DTYPE, one row per label
+    """
+
+    labels = asarray(labels).ravel()
+    values = asarray(values, dtype=float64).ravel()
+    select = labels != background
+    if valid is not None:
+        select &= asarray(valid).ravel()
+    labels = labels[select]
+    values = values[select]
+
+    # Zone index for every pixel, labels are used directly as bin numbers
+    # unless they are too sparse (then they are compacted with a sort)
+    if labels.size > 0 and labels.max() - labels.min() <= 4*labels.size + DENSE_LABEL_SPAN:
+        offset = labels.min()
+        zone_index = labels - offset
+        num_bins = zone_index.max() + 1
+    else:
+        zone_labels, zone_index = unique(labels, return_inverse=True)
+        offset = None
+        num_bins = zone_labels.size
+
+    count = bincount(zone_index, minlength=num_bins)
+    total = bincount(zone_index, weights=values, minlength=num_bins)
+    lowest = full(num_bins, inf)
+    highest = full(num_bins, -inf)
+    minimum.at(lowest, zone_index, values)
+    maximum.at(highest, zone_index, values)
+
+    # Variance from the deviations, more accurate than the sum of squares
+    with errstate(invalid='ignore', divide='ignore'):
+        mean = total/count
+    deviation = values - mean[zone_index]
+    squares = bincount(zone_index, weights=deviation*deviation, minlength=num_bins)
+
+    # Keep the bins that have pixels
+    present = count > 0
+    table = zeros(present.sum(), dtype=ZONAL_DTYPE)
+    table['label'] = (present.nonzero()[0] + offset) if offset is not None else zone_labels
+    table['count'] = count[present]
+    table['sum'] = total[present]
+    table['sumsq'] = bincount(zone_index, weights=values*values, minlength=num_bins)[present]
+    table['mean'] = mean[present]
+    table['var'] = squares[present]/count[present]
+    table['min'] = lowest[present]
+    table['max'] = highest[present]
+    profiling.current().add(pixels=select.size, zones=table.size)
+
+    if label_list is not None:
+        table = select_labels(table, label_list)
+
+    return table
+
+
+def select_labels(table, label_list):
+    """
+    Reorders a zonal statistics table to the given labels
+
+    :param table: zonal statistics table sorted by label
+    :param label_list: labels to report, in order
+    :return: zonal statistics table with one row per label in label_list
+    """
+
+    label_list = asarray(label_list, dtype=int64)
+    selected = zeros(label_list.size, dtype=ZONAL_DTYPE)
+    selected['label'] = label_list
+    for name in ('mean', 'var', 'min', 'max'):
+        selected[name] = nan
+
+    if table.size > 0:
+        position = minimum(searchsorted(table['label'], label_list), table.size - 1)
+        found = table['label'][position] == label_list
+        selected[found] = table[position[found]]
+    return selected
+
+
+def merge_zonal_stats(tables):
+    """
+    Combines zonal statistics tables computed over separate parts of an image
+    (e.g. tiles) into the statistics of the whole image
+
+    :param tables: list of zonal statistics tables
+    :return: zonal statistics table sorted by label
+    """
+
+    combined = concatenate(tables)
+    zone_labels, zone_index = unique(combined['label'], return_inverse=True)
+    num_zones = zone_labels.size
+
+    table = zeros(num_zones, dtype=ZONAL_DTYPE)
+    table['label'] = zone_labels
+    for name in ('count', 'sum', 'sumsq'):
+        table[name] = bincount(zone_index, weights=combined[name], minlength=num_zones)
+
+    has_data = combined['count'] > 0
+    table['min'] = full(num_zones, nan)
+    table['max'] = full(num_zones, nan)
+    lowest = full(num_zones, inf)
+    highest = full(num_zones, -inf)
+    minimum.at(lowest, zone_index[has_data], combined['min'][has_data])
+    maximum.at(highest, zone_index[has_data], combined['max'][has_data])
+    table['min'][table['count'] > 0] = lowest[table['count'] > 0]
+    table['max'][table['count'] > 0] = highest[table['count'] > 0]
+
+    return _finish(table)
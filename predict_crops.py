@@ -1,8 +1,9 @@
-from numpy import array, zeros
-from numpy import mean, var
-from random import sample
+from os import cpu_count
+from numpy import array
 from pandas import read_csv
-from sklearn.svm import SVC
+
+from landsatutil.classification import CropModel, crop_estimator
+from landsatutil.evaluation import evaluate
 
 # Very small area
 nw_corner = array([396210, 4175310])
@@ -25,43 +26,27 @@ explanatory_variables = [
 ]
 outcome_variable = 'CropTruth'
 data_set = read_csv(fname_template.format('field_data_truth', 'csv'))
-data_matrix = data_set[explanatory_variables].as_matrix()
-outcome_truth = data_set[outcome_variable].as_matrix()
+data_matrix = data_set[explanatory_variables].values
+outcome_truth = data_set[outcome_variable].values
 
 
-# Select random indices for each trial
+# Evaluate try a few time to see how well the crops can be predicted, the
+# trials are split up front and run in parallel. The estimator scales the
+# features like the saved CropModel so the accuracy is the saved model's
 n_trials = 100
 train_fraction = 0.8
-trial_outcomes = zeros(n_trials)
-data_length = data_set.shape[0]
-num_samples = int(data_length * train_fraction)
-num_tests = data_length - num_samples
-all_indices = range(data_length)
-
-# Evaluate try a few time to see how well the crops can be predicted.
-for trial in range(n_trials):
-    # Divide data array into training set and
-    training_indices = sample(all_indices, num_samples)
-    training_indices.sort()
-    test_indices = [x for x in all_indices if x not in training_indices]
-    test_indices.sort()
-
-    # Create the training data set
-    sampled_training_data = data_matrix[training_indices]
-    sampled_training_outcomes = outcome_truth[training_indices]
-    sampled_test_data = data_matrix[test_indices]
-    sampled_test_outcomes = outcome_truth[test_indices]
-
-    # Predict outcomes and save values
-    model = SVC()
-    model.fit(sampled_training_data, sampled_training_outcomes)
-    modeled_outcome = model.predict(sampled_test_data)
-    #print(modeled_outcome)
-
-    # Figure out how well the model has done
-    percent_correct = sum(modeled_outcome == sampled_test_outcomes) / num_tests
-    trial_outcomes[trial] = percent_correct
+results = evaluate(crop_estimator, data_matrix, outcome_truth, num_trials=n_trials,
+                   train_fraction=train_fraction, seed=0, workers=cpu_count())
 
 print('After {0} trials, correct outcome stats:\n\tMean: {1}\n\tVar:  {2}'.format(
-    n_trials, mean(trial_outcomes), var(trial_outcomes)
+    n_trials, results['mean'], results['var']
+))
+print('Mean fit time: {0:.4f} s, mean predict time: {1:.4f} s'.format(
+    results['fit_time'].mean(), results['predict_time'].mean()
 ))
+print('Confusion matrix (rows: truth, columns: predicted) for classes {0}:'.format(list(results['classes'])))
+print(results['confusion'])
+
+# Train the model on all of the data and save it for classify_fields.py
+model = CropModel(explanatory_variables).fit(data_set, outcome_truth)
+model.save(fname_template.format('crop_model', 'pkl'))
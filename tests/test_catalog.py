@@ -0,0 +1,38 @@
+"""
+Checks of the scene catalog updates
+"""
+
+# Imports
+from os import utime
+
+from landsatutil import catalog as catalog_module
+from landsatutil.catalog import SceneCatalog
+from landsatutil.synthetic import make_archive
+
+
+def test_update_skips_other_files_until_they_change(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    archive_dir = tmp_path / 'archives'
+    make_archive(str(archive_dir), shape=(100, 100))
+    (archive_dir / 'notes').mkdir()
+    broken = archive_dir / 'broken.tar.gz'
+    broken.write_bytes(b'not an archive')
+
+    # Count the archives that are opened
+    opened = []
+    scene_record = catalog_module.scene_record
+    monkeypatch.setattr(catalog_module, 'scene_record', lambda path: opened.append(path) or scene_record(path))
+
+    catalog = SceneCatalog(str(tmp_path / 'scenes.sqlite'))
+    assert catalog.update(str(archive_dir)) == 1
+    assert len(catalog) == 1
+    assert len(opened) == 2
+
+    # Nothing changed, nothing is opened again
+    assert catalog.update(str(archive_dir)) == 0
+    assert len(opened) == 2
+
+    # The broken file is retried once it changes
+    utime(str(broken), (0, 0))
+    assert catalog.update(str(archive_dir)) == 0
+    assert len(opened) == 3
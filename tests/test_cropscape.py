@@ -0,0 +1,104 @@
+"""
+Checks of the Cropland Data Layer fetcher against a local stand-in WMS server
+"""
+
+# Imports
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.error import HTTPError
+from urllib.parse import urlparse, parse_qs
+import imageio.v3 as iio
+import pytest
+from numpy import full, uint8
+
+from landsatutil import cropscape_tools
+from landsatutil.cropscape_tools import CropscapeFetcher
+
+# Constants
+BBOX = (-105.3, 37.6, -105.2, 37.7)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    GetMap requests of /ok return an image whose red and green values are its
+    width and height, /flaky fails with a 503 every other request and /missing
+    always fails with a 404
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append(url.path)
+        if url.path == '/missing' or (url.path == '/flaky' and len(self.server.requests) % 2 == 1):
+            self.send_error(404 if url.path == '/missing' else 503)
+            return
+
+        query = parse_qs(url.query)
+        width, height = int(query['WIDTH'][0]), int(query['HEIGHT'][0])
+        image = full((height, width, 3), 0, dtype=uint8)
+        image[..., 0] = width
+        image[..., 1] = height
+        data = iio.imwrite('<bytes>', image, extension='.png')
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(('127.0.0.1', 0), StandInHandler)
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def endpoint(server, path):
+    return 'http://127.0.0.1:{0:d}{1}'.format(server.server_address[1], path)
+
+
+def test_tiles_are_mosaicked(server, tmp_path):
+    fetcher = CropscapeFetcher(endpoint(server, '/ok'), cache_dir=str(tmp_path), tile_size=3)
+    image = fetcher.fetch(2011, BBOX, 7, 5)
+    assert image.shape == (5, 7, 3)
+    # Tiles of 3 x 3 pixels, the last column and row of tiles are smaller
+    assert tuple(image[0, 0, 0:2]) == (3, 3)
+    assert tuple(image[4, 6, 0:2]) == (1, 2)
+    assert len(server.requests) == 6
+
+
+def test_shared_tiles_are_downloaded_once(server, tmp_path):
+    fetcher = CropscapeFetcher(endpoint(server, '/ok'), cache_dir=str(tmp_path), tile_size=3)
+    first, second = fetcher.fetch_many([(2011, BBOX, 7, 5), (2011, BBOX, 7, 5)])
+    assert (first == second).all()
+    assert len(server.requests) == 6
+
+
+def test_server_errors_are_retried(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(cropscape_tools, 'sleep', lambda seconds: None)
+    fetcher = CropscapeFetcher(endpoint(server, '/flaky'), cache_dir=str(tmp_path), retries=1)
+    assert fetcher.fetch(2011, BBOX, 4, 4).shape == (4, 4, 3)
+    assert len(server.requests) == 2
+
+
+def test_client_errors_are_not_retried(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(cropscape_tools, 'sleep', lambda seconds: None)
+    fetcher = CropscapeFetcher(endpoint(server, '/missing'), cache_dir=str(tmp_path), retries=3)
+    with pytest.raises(HTTPError):
+        fetcher.fetch(2011, BBOX, 4, 4)
+    assert len(server.requests) == 1
+
+
+def test_cached_images_are_not_requested_again(server, tmp_path):
+    CropscapeFetcher(endpoint(server, '/ok'), cache_dir=str(tmp_path), tile_size=3).fetch(2011, BBOX, 7, 5)
+    requests = len(server.requests)
+    image = CropscapeFetcher(endpoint(server, '/ok'), cache_dir=str(tmp_path), tile_size=3).fetch(2011, BBOX, 7, 5)
+    assert image.shape == (5, 7, 3)
+    assert len(server.requests) == requests
+    assert not list(tmp_path.glob('*.tmp'))
@@ -0,0 +1,29 @@
+"""
+Checks of the data cube
+"""
+
+# Imports
+import pytest
+from numpy import array, may_share_memory
+
+from landsatutil.cube import build_cube
+from landsatutil.synthetic import make_archive
+
+# Constants
+UL_CORNER = array([390000.0, 4200000.0])
+
+
+def test_build_cube_without_scenes():
+    with pytest.raises(ValueError):
+        build_cube('cube', [], UL_CORNER, UL_CORNER + array([3000.0, -3000.0]))
+
+
+def test_cube_selection_is_a_view(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = make_archive(str(tmp_path / 'archives'), shape=(120, 120))
+    cube = build_cube(str(tmp_path / 'cube'), [path], UL_CORNER + array([300.0, -300.0]),
+                      UL_CORNER + array([3300.0, -3300.0]), bands=[3, 4, 5], chunk_rows=16)
+    assert cube.shape == (1, 3, 100, 100)
+    data, valid = cube.select(bands=[3, 5], nw_coords=UL_CORNER + array([900.0, -900.0]))
+    assert data.shape == (1, 2, 80, 80) and valid.shape == (1, 80, 80)
+    assert may_share_memory(data, cube.data)
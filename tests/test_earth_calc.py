@@ -0,0 +1,137 @@
+"""
+Accuracy checks of the vectorized UTM transforms against the original
+scalar implementation
+"""
+
+# Imports
+from math import pi, sin, cos, tan
+from numpy import array, abs, hypot, vectorize, where
+from numpy.random import default_rng
+import pytest
+
+from landsatutil.earth_calc import utm_to_latlon, latlon_to_utm
+
+
+def scalar_utm_to_latlon(zone, easting, northing, n_hemisphere=True):
+    """
+    The scalar implementation utm_to_latlon replaced, kept as the reference
+    """
+
+    if not n_hemisphere:
+        northing = 10000000 - northing
+
+    a = 6378137
+    e = 0.081819191
+    e1sq = 0.006739497
+    k0 = 0.9996
+
+    arc = northing / k0
+    mu = arc / (a * (1 - pow(e, 2) / 4.0 - 3 * pow(e, 4) / 64.0 - 5 * pow(e, 6) / 256.0))
+
+    ei = (1 - pow((1 - e * e), (1 / 2.0))) / (1 + pow((1 - e * e), (1 / 2.0)))
+
+    ca = 3 * ei / 2 - 27 * pow(ei, 3) / 32.0
+
+    cb = 21 * pow(ei, 2) / 16 - 55 * pow(ei, 4) / 32
+    cc = 151 * pow(ei, 3) / 96
+    cd = 1097 * pow(ei, 4) / 512
+    phi1 = mu + ca * sin(2 * mu) + cb * sin(4 * mu) + cc * sin(6 * mu) + cd * sin(8 * mu)
+
+    n0 = a / pow((1 - pow((e * sin(phi1)), 2)), (1 / 2.0))
+
+    r0 = a * (1 - e * e) / pow((1 - pow((e * sin(phi1)), 2)), (3 / 2.0))
+    fact1 = n0 * tan(phi1) / r0
+
+    _a1 = 500000 - easting
+    dd0 = _a1 / (n0 * k0)
+    fact2 = dd0 * dd0 / 2
+
+    t0 = pow(tan(phi1), 2)
+    Q0 = e1sq * pow(cos(phi1), 2)
+    fact3 = (5 + 3 * t0 + 10 * Q0 - 4 * Q0 * Q0 - 9 * e1sq) * pow(dd0, 4) / 24
+
+    fact4 = (61 + 90 * t0 + 298 * Q0 + 45 * t0 * t0 - 252 * e1sq - 3 * Q0 * Q0) * pow(dd0, 6) / 720
+
+    lof1 = _a1 / (n0 * k0)
+    lof2 = (1 + 2 * t0 + Q0) * pow(dd0, 3) / 6.0
+    lof3 = (5 - 2 * Q0 + 28 * t0 - 3 * pow(Q0, 2) + 8 * e1sq + 24 * pow(t0, 2)) * pow(dd0, 5) / 120
+    _a2 = (lof1 - lof2 + lof3) / cos(phi1)
+    _a3 = _a2 * 180 / pi
+
+    latitude = 180 * (phi1 - fact1 * (fact2 + fact3 + fact4)) / pi
+
+    if not n_hemisphere:
+        latitude = -latitude
+
+    longitude = ((zone > 0) and (6 * zone - 183.0) or 3.0) - _a3
+
+    return latitude, longitude
+
+
+def random_points(size=2000, seed=0, max_offset=1.2):
+    """
+    :return: (latitude, longitude, zone) arrays of points within max_offset
+             degrees of the central meridian of random zones
+    """
+
+    rng = default_rng(seed)
+    zone = rng.integers(1, 61, size)
+    latitude = rng.uniform(-80, 80, size)
+    longitude = 6*zone - 183.0 + rng.uniform(-max_offset, max_offset, size)
+    return latitude, longitude, zone
+
+
+def test_utm_to_latlon_matches_scalar():
+    rng = default_rng(1)
+    zone = rng.integers(1, 61, 2000)
+    easting = rng.uniform(200000, 800000, 2000)
+    n_hemisphere = rng.random(2000) < 0.5
+    # Northings of latitudes within 84 degrees north and 80 degrees south, where UTM is defined
+    northing = where(n_hemisphere, rng.uniform(0, 9300000, 2000), rng.uniform(1100000, 10000000, 2000))
+
+    latitude, longitude = utm_to_latlon(zone, easting, northing, n_hemisphere)
+    ref_latitude, ref_longitude = vectorize(scalar_utm_to_latlon)(zone, easting, northing, n_hemisphere)
+    assert abs(latitude - ref_latitude).max() < 1e-9
+    assert abs(longitude - ref_longitude).max() < 1e-9
+
+    # Scalars in, scalars out
+    latitude, longitude = utm_to_latlon(13, 396210.0, 4175310.0)
+    assert latitude.shape == () and longitude.shape == ()
+    assert latitude == pytest.approx(scalar_utm_to_latlon(13, 396210.0, 4175310.0)[0], abs=1e-12)
+
+
+def test_utm_to_latlon_broadcasts():
+    easting = array([396210.0, 400000.0, 410000.0])
+    latitude, longitude = utm_to_latlon(array([[13], [14]]), easting, 4175310.0)
+    assert latitude.shape == (2, 3) and longitude.shape == (2, 3)
+    for r, zone in enumerate((13, 14)):
+        for c in range(3):
+            ref = scalar_utm_to_latlon(zone, easting[c], 4175310.0)
+            assert latitude[r, c] == pytest.approx(ref[0], abs=1e-9)
+            assert longitude[r, c] == pytest.approx(ref[1], abs=1e-9)
+
+    latitude, longitude = utm_to_latlon(13, 396210.0, array([4175310.0, 4175000.0]), array([[True], [False]]))
+    assert latitude.shape == (2, 2) and longitude.shape == (2, 2)
+
+
+def test_latlon_round_trip():
+    latitude, longitude, zone = random_points()
+    utm_zone, easting, northing, n_hemisphere = latlon_to_utm(latitude, longitude)
+    assert utm_zone.dtype.kind == 'i'
+    assert (utm_zone == zone).all()
+    assert (n_hemisphere == (latitude >= 0)).all()
+
+    # Within about 130 km of the central meridian the inverse series is good to well under a metre
+    round_latitude, round_longitude = utm_to_latlon(utm_zone, easting, northing, n_hemisphere)
+    assert abs(round_latitude - latitude).max() < 1e-5
+    assert abs(round_longitude - longitude).max() < 1e-8
+    _, round_easting, round_northing, _ = latlon_to_utm(round_latitude, round_longitude, utm_zone)
+    assert hypot(round_easting - easting, round_northing - northing).max() < 1.0
+
+
+def test_latlon_to_utm_scalar_zone():
+    zone, easting, northing, n_hemisphere = latlon_to_utm(37.7, -105.2)
+    assert zone == 13 and isinstance(zone.item(), int)
+    assert n_hemisphere
+    assert easting == pytest.approx(482369.234, abs=1e-2)
+    assert northing == pytest.approx(4172549.065, abs=1e-2)
@@ -0,0 +1,35 @@
+"""
+Checks that the cross validation measures the model that is saved
+"""
+
+# Imports
+from numpy import column_stack
+from numpy.random import default_rng
+
+from landsatutil.classification import CropModel, crop_estimator
+from landsatutil.evaluation import evaluate, random_splits
+
+# Constants
+FEATURES = ['month', 'b4_ref']
+
+
+def training_set(rows=300):
+    # The features have very different scales, an unscaled SVC does poorly on them
+    rng = default_rng(0)
+    outcomes = rng.integers(0, 3, rows)
+    month = rng.integers(4, 10, rows).astype(float)
+    reflectance = 0.1 + 0.05*outcomes + rng.normal(0, 0.01, rows)
+    return {'month': month, 'b4_ref': reflectance}, outcomes
+
+
+def test_evaluate_matches_crop_model():
+    columns, outcomes = training_set()
+    data = column_stack([columns[name] for name in FEATURES])
+    splits = random_splits(outcomes.size, num_trials=3, seed=1)
+    results = evaluate(crop_estimator, data, outcomes, splits=splits, workers=2)
+
+    for accuracy, (_, training, test) in zip(results['accuracy'], splits):
+        model = CropModel(FEATURES).fit(dict((name, value[training]) for name, value in columns.items()),
+                                        outcomes[training])
+        predicted = model.predict(dict((name, value[test]) for name, value in columns.items()))
+        assert accuracy == (predicted == outcomes[test]).mean()
@@ -0,0 +1,52 @@
+"""
+Checks of the field registry queries against the field mask
+"""
+
+# Imports
+from numpy import array, zeros, int32, isinf
+from numpy.random import default_rng
+from skimage.measure import label
+
+from landsatutil.fields import field_registry, field_runs, load_registry
+
+# Constants
+NW_CORNER = array([390000.0, 4200000.0])
+PIXEL_SIZE = 30.0
+
+
+def field_mask(shape=(240, 300)):
+    # Irregular fields, so many background pixels are inside field boxes
+    return label(default_rng(0).random(shape) > 0.6, connectivity=1).astype(int32)
+
+
+def test_field_runs_cover_the_fields():
+    mask = field_mask()
+    start, stop, labels = field_runs(mask, chunk_rows=7)
+    rebuilt = zeros(mask.size, dtype=int32)
+    for first, last, field in zip(start, stop, labels):
+        rebuilt[first:last] = field
+    assert (rebuilt.reshape(mask.shape) == mask).all()
+
+
+def test_saved_registry_answers_point_queries_exactly(tmp_path):
+    mask = field_mask()
+    path = str(tmp_path / 'field_registry.npz')
+    field_registry(mask, NW_CORNER, PIXEL_SIZE).save(path)
+    registry = load_registry(path)
+
+    # Every pixel center, and points outside of the mask
+    rows, cols = (array(x) for x in zip(*[(r, c) for r in range(-2, mask.shape[0] + 2)
+                                          for c in range(-2, mask.shape[1] + 2)]))
+    x = NW_CORNER[0] + (cols + 0.5)*PIXEL_SIZE
+    y = NW_CORNER[1] - (rows + 0.5)*PIXEL_SIZE
+    inside = (rows >= 0) & (rows < mask.shape[0]) & (cols >= 0) & (cols < mask.shape[1])
+    expected = zeros(rows.size, dtype=int32)
+    expected[inside] = mask[rows[inside], cols[inside]]
+    assert (registry.field_at(x, y) == expected).all()
+
+
+def test_nearest_on_empty_registry():
+    registry = field_registry(zeros((10, 10), dtype=int32), NW_CORNER, PIXEL_SIZE)
+    labels, distance = registry.nearest([390100.0, 390200.0], [4199900.0, 4199800.0], k=2)
+    assert labels.shape == (2, 2) and (labels == 0).all() and isinf(distance).all()
+    assert (registry.field_at(390100.0, 4199900.0) == 0).all()
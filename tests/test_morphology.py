@@ -0,0 +1,32 @@
+"""
+Checks of the tiled morphology and labeling against the whole image versions
+"""
+
+# Imports
+from numpy.random import default_rng
+from skimage.measure import label
+
+from landsatutil.morphology import tiled_morphology, tiled_label, apply_operations
+
+# Constants
+OPERATIONS = [('erosion', 3, 3), ('closing', 7, 5)]
+
+
+def random_mask(shape=(300, 260)):
+    return default_rng(0).random(shape) > 0.45
+
+
+def test_tiled_morphology_matches_whole_image():
+    image = random_mask()
+    expected = apply_operations(image, OPERATIONS)
+    assert (tiled_morphology(image, OPERATIONS, tile_size=64) == expected).all()
+    assert (tiled_morphology(image, OPERATIONS, tile_size=64, workers=2) == expected).all()
+
+
+def test_tiled_label_matches_skimage():
+    image = random_mask()
+    expected = label(image, connectivity=2)
+    for workers in (1, 2):
+        labels, num_labels = tiled_label(image, connectivity=2, tile_size=64, workers=workers)
+        assert num_labels == expected.max()
+        assert (labels == expected).all()
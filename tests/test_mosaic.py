@@ -0,0 +1,37 @@
+"""
+Checks of the multi-scene mosaic
+"""
+
+# Imports
+from datetime import date
+import pytest
+from numpy import array
+
+from landsatutil.mosaic import mosaic
+from landsatutil.synthetic import make_archive
+
+# Constants
+UL_CORNER = array([390000.0, 4200000.0])
+SHAPE = (200, 200)
+
+
+def test_mosaic_reads_compressed_archives(tmp_path, monkeypatch):
+    # Archive members are extracted under tmp/ of the working directory
+    monkeypatch.chdir(tmp_path)
+    paths = [make_archive(str(tmp_path / 'a'), acquired=date(2008, 5, 9), shape=SHAPE),
+             make_archive(str(tmp_path / 'b'), acquired=date(2008, 6, 10), shape=SHAPE,
+                          ul_corner=UL_CORNER + array([3000.0, -3000.0]), wrs_path=34)]
+    se = UL_CORNER + array([9000.0, -9000.0])
+    image, source = mosaic(paths, [3, 4], UL_CORNER, se, tile_size=64)
+    assert image.shape == (2, 300, 300)
+    # The latest scene wins where the scenes overlap, the earlier one fills its corner
+    assert (source[150, 150] == 1) and (source[50, 50] == 0)
+    assert (source[250, 10] == -1)
+
+
+def test_mosaic_rejects_mixed_utm_zones(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    paths = [make_archive(str(tmp_path / 'a'), shape=SHAPE, utm_zone=13),
+             make_archive(str(tmp_path / 'b'), shape=SHAPE, utm_zone=14, wrs_path=34)]
+    with pytest.raises(ValueError, match='UTM zone'):
+        mosaic(paths, [4], UL_CORNER, UL_CORNER + array([3000.0, -3000.0]))
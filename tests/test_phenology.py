@@ -0,0 +1,95 @@
+"""
+Checks of the series interpolation and phenology metrics against per field
+loops
+"""
+
+# Imports
+import warnings
+from numpy import array, full, interp, isfinite, isnan, nan, sort, where
+from numpy.random import default_rng
+
+from landsatutil.phenology import DEFAULT_GRID, interpolate_series, phenology_metrics
+
+
+def reference_series(values, doy, grid, extrapolate=False):
+    # numpy.interp on the observations of each field
+    result = full((values.shape[0], grid.size), nan)
+    for n, row in enumerate(values):
+        known = isfinite(row)
+        if known.any():
+            left, right = (row[known][0], row[known][-1]) if extrapolate else (nan, nan)
+            result[n] = interp(grid, doy[known], row[known], left=left, right=right)
+    return result
+
+
+def test_interpolation_matches_numpy_interp():
+    rng = default_rng(0)
+    doy = sort(rng.choice(range(60, 340), 30, replace=False)).astype(float)
+    values = rng.random((500, doy.size))
+    values[rng.random(values.shape) < 0.4] = nan
+    # A field with a single observation and one with none
+    values[1, 1:] = nan
+    values[2] = nan
+
+    for extrapolate in (False, True):
+        result = interpolate_series(values, doy, DEFAULT_GRID, extrapolate)
+        expected = reference_series(values, doy, DEFAULT_GRID.astype(float), extrapolate)
+        assert (isnan(result) == isnan(expected)).all()
+        assert abs(where(isnan(expected), 0.0, result - expected)).max() < 1e-12
+        assert isnan(result[2]).all()
+
+
+def test_duplicate_dates():
+    # Two observations on day 120 (e.g. overlapping scenes not averaged)
+    doy = array([100.0, 120.0, 120.0, 150.0])
+    values = array([[0.2, 0.4, 0.6, 0.3], [0.2, nan, 0.6, 0.3]])
+    grid = array([110.0, 120.0, 130.0, 150.0])
+    result = interpolate_series(values, doy, grid)
+    assert abs(result - reference_series(values, doy, grid)).max() < 1e-12
+    assert abs(result[0] - [0.3, 0.6, 0.5, 0.3]).max() < 1e-12
+
+
+def reference_metrics(row, grid, threshold):
+    # Plain loop over the grid days of one series
+    days = [(day, value) for day, value in zip(grid, row) if isfinite(value)]
+    base, peak = min(value for _, value in days), max(value for _, value in days)
+    season = [day for day, value in days if value >= base + threshold*(peak - base)]
+    pairs = [(grid[n + 1] - grid[n], row[n], row[n + 1]) for n in range(grid.size - 1)
+             if isfinite(row[n]) and isfinite(row[n + 1])]
+    slopes = [(second - first)/step for step, first, second in pairs]
+    return {
+        'observations': len(days),
+        'base': base,
+        'peak': peak,
+        'peak_doy': [day for day, value in days if value == peak][0],
+        'greenup_doy': season[0],
+        'senescence_doy': season[-1],
+        'integral': sum(0.5*step*(first + second) for step, first, second in pairs),
+        'season_integral': sum(0.5*step*(first + second - 2*base) for step, first, second in pairs),
+        'greenup_rate': max(slopes) if slopes else nan,
+        'senescence_rate': -min(slopes) if slopes else nan,
+    }
+
+
+def test_phenology_metrics_match_a_loop():
+    rng = default_rng(1)
+    grid = DEFAULT_GRID.astype(float)
+    series = rng.random((3, 40, grid.size))
+    series[rng.random(series.shape) < 0.4] = nan
+    series[0, 0] = nan
+    series[0, 1] = nan
+    series[0, 1, 0] = 0.5
+
+    # Fields without observations are nan without warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        metrics = phenology_metrics(series, grid, threshold=0.4)
+    assert metrics['peak'].shape == (3, 40)
+    assert metrics['observations'][0, 0] == 0
+    assert all(isnan(value[0, 0]) for name, value in metrics.items() if name != 'observations')
+    assert isnan(metrics['greenup_rate'][0, 1]) and metrics['greenup_doy'][0, 1] == grid[0]
+
+    for index in zip(*where(metrics['observations'] > 0)):
+        expected = reference_metrics(series[index], grid, 0.4)
+        for name, value in expected.items():
+            assert (isnan(value) and isnan(metrics[name][index])) or abs(metrics[name][index] - value) < 1e-9
@@ -0,0 +1,86 @@
+"""
+Checks of the incremental pipeline runner
+"""
+
+# Imports
+from os import listdir
+from os.path import join, isdir
+import pytest
+
+from landsatutil.pipeline import Pipeline, Stage
+
+
+def write_stage(calls):
+    """
+    :return: stage function writing its parameters and inputs to a file and
+             recording its name in calls
+    """
+
+    def function(output_dir, inputs, params):
+        calls.append(params['name'])
+        with open(join(output_dir, 'value.txt'), 'w') as value_file:
+            print(params, sorted(inputs), file=value_file)
+        return {'name': params['name']}
+    return function
+
+
+def build(store_dir, calls, b_value=1, scenes=('s1', 's2')):
+    pipeline = Pipeline(str(store_dir))
+    function = write_stage(calls)
+    pipeline.add(Stage('a', function, params={'name': 'a', 'value': 0}))
+    pipeline.add(Stage('b', function, params={'name': 'b', 'value': b_value}))
+    for scene in scenes:
+        pipeline.add(Stage('features/' + scene, function, inputs=['a'], params={'name': 'features/' + scene}))
+    pipeline.add(Stage('c', function, inputs=['a', 'b'] + ['features/' + scene for scene in scenes],
+                       params={'name': 'c'}))
+    return pipeline
+
+
+def test_only_changed_stages_and_their_dependents_run(tmp_path):
+    calls = []
+    build(tmp_path, calls).run(log=None)
+    assert sorted(calls) == ['a', 'b', 'c', 'features/s1', 'features/s2']
+
+    # Nothing changed
+    del calls[:]
+    build(tmp_path, calls).run(log=None)
+    assert calls == []
+
+    # A new parameter of b reruns b and c only
+    pipeline = build(tmp_path, calls, b_value=2)
+    assert [name for name, needed in pipeline.plan() if needed] == ['b', 'c']
+    pipeline.run(log=None)
+    assert calls == ['b', 'c']
+    assert pipeline.manifest('c')['summary'] == {'name': 'c'}
+
+
+def test_prune_removes_old_artifacts_and_dropped_stages(tmp_path):
+    calls = []
+    build(tmp_path, calls).run(log=None)
+    pipeline = build(tmp_path, calls, b_value=2, scenes=('s1',))
+    pipeline.run(log=None)
+
+    # The old artifacts of b and c, and the artifact of the scene that is no longer selected
+    assert pipeline.prune() == 3
+    assert not isdir(join(str(tmp_path), 'features', 's2'))
+    for name in pipeline.stages:
+        assert listdir(join(str(tmp_path), name)) == [pipeline.key(name)]
+        assert pipeline.is_current(name)
+    assert pipeline.prune() == 0
+
+
+def test_failing_stage_leaves_no_artifact(tmp_path):
+    calls = []
+    pipeline = build(tmp_path, calls)
+
+    def fail(output_dir, inputs, params):
+        with open(join(output_dir, 'partial.txt'), 'w') as partial_file:
+            partial_file.write('partial')
+        raise RuntimeError('stage failed')
+    pipeline.stages['b'].function = fail
+
+    with pytest.raises(RuntimeError):
+        pipeline.run(log=None)
+    assert not isdir(join(str(tmp_path), 'b')) or listdir(join(str(tmp_path), 'b')) == []
+    assert not pipeline.is_current('b') and not pipeline.is_current('c')
+    assert 'c' not in calls
@@ -0,0 +1,66 @@
+"""
+Checks of the radiometric conversions against hand computed values
+"""
+
+# Imports
+from datetime import datetime
+from numpy import array, log, sin, pi, float32, float64
+
+from landsatutil.radiometry import calibrate
+from landsatutil.scene import LandsatScene, parse_metadata
+from landsatutil.synthetic import make_archive, metadata_text, scene_id
+
+# Constants
+ACQUIRED = datetime(2011, 7, 1, 17, 30)
+SUN_ELEVATION = 55.0
+# A different gain and bias for every band
+RESCALING = dict((band, (0.5 + 0.1*band, -1.0*band)) for band in range(1, 8))
+REFLECTANCE_RESCALING = dict((band, (0.001*band, -0.01*band)) for band in (1, 2, 3, 4, 5, 7))
+DN = array([[1, 50, 128], [200, 254, 255]], dtype=float64)
+
+
+def synthetic_metadata():
+    text = metadata_text(scene_id(33, 34, ACQUIRED), ACQUIRED, (390000.0, 4200000.0), (10, 10),
+                         sun_elevation=SUN_ELEVATION, rescaling=RESCALING)
+    # Add the reflectance rescaling coefficients of the newer MTL files
+    lines = ['    REFLECTANCE_MULT_BAND_{0:d} = {1:.5E}\n    REFLECTANCE_ADD_BAND_{0:d} = {2:.5f}'.format(
+        band, gain, bias) for band, (gain, bias) in sorted(REFLECTANCE_RESCALING.items())]
+    end = '  END_GROUP = RADIOMETRIC_RESCALING'
+    return parse_metadata(text.replace(end, '\n'.join(lines) + '\n' + end).splitlines())
+
+
+def test_every_band_has_its_own_coefficients(tmp_path, monkeypatch):
+    metadata = synthetic_metadata()
+    for band, (gain, bias) in RESCALING.items():
+        assert abs(calibrate(DN, metadata, band, dtype=float64) - (gain*DN + bias)).max() < 1e-9
+
+    # The band corrections of a scene are bound per band
+    monkeypatch.chdir(tmp_path)
+    scene = LandsatScene(make_archive(str(tmp_path), shape=(20, 20), rescaling=RESCALING))
+    for band, (gain, bias) in RESCALING.items():
+        assert abs(scene.band_correction[band](DN) - (gain*DN + bias)).max() < 1e-9
+
+
+def test_reflectance_uses_the_mtl_multiplier_and_sun_elevation():
+    metadata = synthetic_metadata()
+    gain, bias = REFLECTANCE_RESCALING[4]
+    expected = (gain*DN + bias)/sin(SUN_ELEVATION*pi/180.0)
+    assert abs(calibrate(DN, metadata, 4, 'reflectance', dtype=float64) - expected).max() < 1e-12
+
+
+def test_brightness_temperature():
+    metadata = synthetic_metadata()
+    gain, bias = RESCALING[6]
+    # Landsat 5 thermal constants, on digital numbers with a positive radiance
+    dn = DN[:, 1:]
+    expected = 1260.56/log(607.76/(gain*dn + bias) + 1)
+    assert abs(calibrate(dn, metadata, 6, 'reflectance', dtype=float64) - expected).max() < 1e-9
+
+
+def test_float32_in_place():
+    metadata = synthetic_metadata()
+    gain, bias = REFLECTANCE_RESCALING[3]
+    dn = DN.astype(float32)
+    out = calibrate(dn, metadata, 3, 'reflectance', out=dn)
+    assert out is dn and out.dtype == float32
+    assert abs(out - (gain*DN + bias)/sin(SUN_ELEVATION*pi/180.0)).max() < 1e-6
@@ -0,0 +1,46 @@
+"""
+Regression checks of the temporal averaging and the field mask
+"""
+
+# Imports
+from os.path import join
+from numpy import array, full, nan, load, unique, uint16
+
+from landsatutil.stages import mask_stage
+from landsatutil.synthetic import make_series
+from landsatutil.temporal import compress_temporal_image
+
+# Constants
+UL_CORNER = (390000.0, 4200000.0)
+SHAPE = (400, 400)
+
+
+def test_compress_temporal_image_nodata():
+    image = array([[0.1, 0.5], [nan, 0.9]])
+    compressed = compress_temporal_image(image)
+    assert compressed.dtype == uint16
+    assert compressed[1, 0] == 0
+    assert compressed[1, 1] == 65535
+    assert compress_temporal_image(full((2, 2), nan)).max() == 0
+
+
+def test_mask_with_nodata_pixels_finds_fields(tmp_path, monkeypatch):
+    # Archive members are extracted under tmp/ of the working directory
+    monkeypatch.chdir(tmp_path)
+    archive_dir = tmp_path / 'archives'
+    output_dir = tmp_path / 'mask'
+    archive_dir.mkdir()
+    output_dir.mkdir()
+    archives = make_series(str(archive_dir), [2008], shape=SHAPE)
+
+    params = {
+        'nw_corner': list(UL_CORNER),
+        'se_corner': [UL_CORNER[0] + SHAPE[1]*30.0, UL_CORNER[1] - SHAPE[0]*30.0],
+        'archives': archives,
+        'pixel_size': 30.0,
+        'min_field_area': 100,
+        'max_field_area': 3000,
+    }
+    summary = mask_stage(str(output_dir), {}, params)
+    assert summary['fields'] > 0
+    assert unique(load(join(str(output_dir), 'field_mask.npy'))).size > 1
@@ -0,0 +1,54 @@
+"""
+Checks of the majority vote truth labels against a loop over fields
+"""
+
+# Imports
+from collections import Counter
+from numpy import array, zeros, uint8
+from numpy.random import default_rng
+
+from landsatutil.truth import majority_labels, encode_colors, decode_color
+
+
+def reference(field_mask, crop_keys, ignore=()):
+    # Counter of the voting pixels of every field, ties go to the smallest key
+    votes = {}
+    for label, key in zip(field_mask.ravel().tolist(), crop_keys.ravel().tolist()):
+        if label != 0 and key not in ignore:
+            votes.setdefault(label, Counter())[key] += 1
+    rows = []
+    for label in sorted(votes):
+        crop, count = min(votes[label].items(), key=lambda item: (-item[1], item[0]))
+        rows.append((label, crop, count/sum(votes[label].values()), sum(votes[label].values())))
+    return rows
+
+
+def test_matches_a_loop():
+    rng = default_rng(0)
+    field_mask = rng.integers(0, 30, (50, 70))
+    # Mostly one crop per field, with noise and no data (0) pixels
+    crop_keys = array([1, 5, 24, 36, 61])[field_mask % 5]
+    noise = rng.random(field_mask.shape)
+    crop_keys[noise < 0.3] = rng.choice([0, 1, 5, 24], (noise < 0.3).sum())
+    # A field with only no data pixels does not get a row
+    crop_keys[field_mask == 7] = 0
+
+    for ignore in ((), (0,)):
+        table = majority_labels(field_mask, crop_keys, ignore=ignore)
+        expected = reference(field_mask, crop_keys, ignore)
+        assert table['label'].tolist() == [row[0] for row in expected]
+        assert table['crop'].tolist() == [row[1] for row in expected]
+        assert table['count'].tolist() == [row[3] for row in expected]
+        assert abs(table['purity'] - [row[2] for row in expected]).max() < 1e-12
+    assert 7 not in table['label'] and (table['crop'] != 0).all()
+
+
+def test_color_keys():
+    image = zeros((2, 3, 4), dtype=uint8)
+    image[0, 1] = (255, 211, 0, 255)
+    image[1, 2] = (38, 112, 0, 0)
+    keys = encode_colors(image)
+    assert decode_color(keys[0, 1]) == (255, 211, 0) and decode_color(keys[1, 2]) == (38, 112, 0)
+    table = majority_labels(array([[0, 1, 1], [2, 2, 2]]), keys, ignore=[0])
+    assert table['label'].tolist() == [1, 2] and table['count'].tolist() == [1, 1]
+    assert [decode_color(key) for key in table['crop']] == [(255, 211, 0), (38, 112, 0)]
@@ -0,0 +1,69 @@
+"""
+Checks of the zonal statistics against scipy.ndimage
+"""
+
+# Imports
+from numpy import array, errstate, isnan, where
+from numpy.random import default_rng
+from scipy import ndimage
+
+from landsatutil.zonal import zonal_stats, merge_zonal_stats
+
+
+def image(seed=0, shape=(60, 80), label_offset=0):
+    rng = default_rng(seed)
+    labels = rng.integers(0, 12, shape) + where(rng.random(shape) < 0.5, label_offset, 0)
+    # Offset zeros are background too
+    labels[labels == label_offset] = 0
+    values = rng.normal(100.0, 20.0, shape)
+    # Zero valued pixels count
+    values[rng.random(shape) < 0.1] = 0.0
+    return labels, values, rng.random(shape) < 0.8
+
+
+def reference(labels, values, label_list):
+    # ndimage divides by the count of every label up to the largest, present or not
+    with errstate(invalid='ignore'):
+        return dict((name, array(function(values, labels, label_list))) for name, function in
+                    [('sum', ndimage.sum_labels), ('mean', ndimage.mean), ('var', ndimage.variance),
+                     ('min', ndimage.minimum), ('max', ndimage.maximum)])
+
+
+def test_matches_ndimage():
+    # Dense labels and labels too sparse to be binned directly
+    for label_offset in (0, 1 << 40):
+        labels, values, _ = image(label_offset=label_offset)
+        table = zonal_stats(labels, values)
+        label_list = [label for label in sorted(set(labels.ravel().tolist())) if label != 0]
+        assert table['label'].tolist() == label_list
+
+        expected = reference(labels, values, label_list)
+        expected['count'] = ndimage.sum_labels(values*0 + 1, labels, label_list)
+        for name, value in expected.items():
+            assert abs(table[name] - value).max() < 1e-8*max(1.0, abs(value).max()), name
+
+
+def test_valid_pixels_and_absent_labels():
+    labels, values, valid = image(1)
+    # Label 3 has no valid pixels, 50 is not in the image
+    valid[labels == 3] = False
+    label_list = [50, 5, 3, 1]
+    table = zonal_stats(labels, values, valid=valid, label_list=label_list)
+    assert table['label'].tolist() == label_list
+    assert table['count'][0] == table['count'][2] == 0
+    assert isnan(table['mean'][[0, 2]]).all() and isnan(table['min'][[0, 2]]).all()
+
+    expected = reference(where(valid, labels, 0), values, [5, 1])
+    for name in ('sum', 'mean', 'var', 'min', 'max'):
+        assert abs(table[name][[1, 3]] - expected[name]).max() < 1e-8, name
+    assert table['count'][[1, 3]].tolist() == [int((valid & (labels == 5)).sum()), int((valid & (labels == 1)).sum())]
+
+
+def test_merged_tiles_match_the_whole_image():
+    labels, values, valid = image(2)
+    whole = zonal_stats(labels, values, valid=valid)
+    merged = merge_zonal_stats([zonal_stats(labels[rows], values[rows], valid=valid[rows])
+                                for rows in (slice(0, 25), slice(25, 60))])
+    assert (merged['label'] == whole['label']).all() and (merged['count'] == whole['count']).all()
+    for name in ('sum', 'mean', 'var', 'min', 'max'):
+        assert abs(merged[name] - whole[name]).max() < 1e-6, name
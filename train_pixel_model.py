@@ -0,0 +1,51 @@
+"""
+Trains the per pixel crop model used by classify_pixels.py on the band
+values of every pixel of a season, with the Cropland Data Layer as the truth
+"""
+
+from numpy import array, isfinite, flatnonzero
+from numpy.random import default_rng
+
+from landsatutil.catalog import SceneCatalog
+from landsatutil.classification import CropModel, pixel_features, pixel_feature_names
+from landsatutil.cropscape_tools import CropscapeFetcher, get_crop_data_years
+from landsatutil.truth import align_to_mask, encode_colors
+
+# Very small area
+nw_corner = array([396210, 4175310])
+se_corner = array([404460, 4167150])
+
+# Training season and the number of pixels the model is fit to (SVC training
+# time grows faster than linearly with the number of samples)
+year = 2011
+bands = list(range(1, 8))
+max_training_pixels = 20000
+
+# Scenes of the season covering the area, classify_pixels.py must use the same ones
+catalog = SceneCatalog('tmp/scenes.sqlite')
+catalog.update('tmp/')
+archive_list = catalog.archive_paths(years=[year], months=range(5, 10), nw_coords=nw_corner, se_coords=se_corner)
+
+# Read the band values of every pixel on every date
+print('Reading Pixel Features')
+feature_names = pixel_feature_names(len(archive_list), bands)
+features = pixel_features(archive_list, nw_corner, se_corner, bands=bands)
+shape = features[feature_names[0]].shape
+
+# Get the crop data of the season on the same grid (black is no data)
+fetcher = CropscapeFetcher(cache_dir='tmp/cdl_cache')
+crop_data = get_crop_data_years((shape[1], shape[0]), 13, nw_corner, se_corner, [year], fetcher=fetcher)[year]
+crop_keys = encode_colors(align_to_mask(crop_data, shape)).ravel()
+
+# Train on a random sample of the pixels with data on every date and a crop
+usable = crop_keys != 0
+for name in feature_names:
+    usable &= isfinite(features[name].ravel())
+training = flatnonzero(usable)
+if training.size > max_training_pixels:
+    training = default_rng(0).choice(training, max_training_pixels, replace=False)
+columns = dict((name, features[name].ravel()[training]) for name in feature_names)
+
+print('Training on {0} of {1} pixels'.format(training.size, crop_keys.size))
+model = CropModel(feature_names).fit(columns, crop_keys[training])
+model.save('tmp/pixel_crop_model.pkl')